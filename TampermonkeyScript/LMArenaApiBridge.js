@@ -16,17 +16,43 @@
 
     // --- 配置 ---
     const SERVER_URL = "ws://localhost:5102/ws"; // 与 api_server.py 中的端口匹配
+    // 二进制批量帧协议 (与 modules/ws_protocol.py 对应)。服务器不支持时自动回退到 JSON 文本帧。
+    const BINARY_PROTOCOL = "lmab1";
+    const BATCH_WINDOW_MS = 4; // 批量发送的时间窗口；设为 0 则在当前微任务结束时立即发送
+    const RECORD_KIND = { CHUNK: 0, DONE: 1, ERROR: 2 };
     let socket;
     let isCaptureModeActive = false; // ID捕获模式的开关
+    let useBinaryProtocol = false; // 是否已与服务器协商使用二进制协议
+    let outbox = []; // 等待批量发送的 [requestId, data] 记录
+    let flushScheduled = false;
+    const textEncoder = new TextEncoder();
+    const activeRequests = new Map(); // request_id -> AbortController，用于响应服务器的 abort 指令
+    // 附件缓存：内容哈希 -> data URI。服务器对已缓存的附件只发送 {ref: 哈希}。
+    // 使用 Map 的插入顺序实现 LRU，容量由服务器在协商时告知，与服务器端的索引保持一致。
+    const attachmentCache = new Map();
+    let attachmentCacheBytes = 0;
+    let attachmentCacheLimit = 0;
+    const pendingAttachmentRequests = new Map(); // request_id -> {resolve, reject}
+    // 服务器在发送请求之前分片发来的大附件：(请求 ID, 哈希) -> 已收到的分片 / 完整的 data URI。
+    // 按请求区分，两个并发请求分片发送同一个附件时不会互相混入或取走对方的数据。
+    const incomingAttachmentParts = new Map();
+    const stagedAttachments = new Map();
+    const ATTACHMENT_FETCH_TIMEOUT_MS = 30000;
 
     // --- 核心逻辑 ---
     function connect() {
         console.log(`[API Bridge] 正在连接到本地服务器: ${SERVER_URL}...`);
         socket = new WebSocket(SERVER_URL);
 
+        socket.binaryType = "arraybuffer";
+        useBinaryProtocol = false;
+        outbox = [];
+
         socket.onopen = () => {
             console.log("[API Bridge] ✅ 与本地服务器的 WebSocket 连接已建立。");
             document.title = "✅ " + document.title;
+            // 声明支持的协议，由服务器选择（旧版服务器会忽略此消息，继续使用 JSON）
+            socket.send(JSON.stringify({ command: "hello", protocols: [BINARY_PROTOCOL, "json"], features: ["attachment_refs", "attachment_parts"] }));
         };
 
         socket.onmessage = async (event) => {
@@ -39,6 +65,35 @@
                     if (message.command === 'refresh' || message.command === 'reconnect') {
                         console.log(`[API Bridge] 收到 '${message.command}' 指令，正在执行页面刷新...`);
                         location.reload();
+                    } else if (message.command === 'abort') {
+                        const controller = activeRequests.get(message.request_id);
+                        if (controller) {
+                            console.log(`[API Bridge] 🛑 客户端已断开，正在中止请求 ${message.request_id.substring(0, 8)}。`);
+                            controller.abort();
+                        }
+                    } else if (message.command === 'protocol') {
+                        useBinaryProtocol = message.protocol === BINARY_PROTOCOL;
+                        console.log(`[API Bridge] 上行协议: ${useBinaryProtocol ? "二进制批量帧" : "JSON 文本帧"}`);
+                        // 新连接上服务器的附件索引是空的，清空本地缓存以保持一致
+                        attachmentCacheLimit = message.attachment_cache_bytes || 0;
+                        attachmentCache.clear();
+                        attachmentCacheBytes = 0;
+                    } else if (message.command === 'attachment_part') {
+                        const key = stagedKey(message.request_id, message.hash);
+                        const parts = incomingAttachmentParts.get(key) || [];
+                        parts.push(message.data);
+                        if (message.final) {
+                            incomingAttachmentParts.delete(key);
+                            stagedAttachments.set(key, parts.join(""));
+                        } else {
+                            incomingAttachmentParts.set(key, parts);
+                        }
+                    } else if (message.command === 'attachments') {
+                        const pending = pendingAttachmentRequests.get(message.request_id);
+                        if (pending) {
+                            pendingAttachmentRequests.delete(message.request_id);
+                            pending.resolve(message.attachments || {});
+                        }
                     } else if (message.command === 'activate_id_capture') {
                         console.log("[API Bridge] ✅ ID 捕获模式已激活。请在页面上触发一次 'Retry' 操作。");
                         isCaptureModeActive = true;
@@ -64,7 +119,13 @@
         };
 
         socket.onclose = () => {
+            pendingAttachmentRequests.forEach(pending => pending.reject(new Error("与本地服务器的连接已断开。")));
+            pendingAttachmentRequests.clear();
+            incomingAttachmentParts.clear();
+            stagedAttachments.clear();
             console.warn("[API Bridge] 🔌 与本地服务器的连接已断开。将在5秒后尝试重新连接...");
+            // 服务器已经让这些请求失败了，继续读取上游的流没有意义
+            activeRequests.forEach(controller => controller.abort());
             if (document.title.startsWith("✅ ")) {
                 document.title = document.title.substring(2);
             }
@@ -87,7 +148,20 @@
             console.error(`[API Bridge] ${errorMsg}`);
             sendToServer(requestId, { error: errorMsg });
             sendToServer(requestId, "[DONE]");
+            discardStagedAttachments(requestId);
+            return;
+        }
+
+        let templates;
+        try {
+            templates = await resolveAttachments(requestId, message_templates || []);
+        } catch (error) {
+            console.error(`[API Bridge] ❌ 无法还原请求 ${requestId.substring(0, 8)} 的附件:`, error);
+            sendToServer(requestId, { error: error.message });
+            sendToServer(requestId, "[DONE]");
             return;
+        } finally {
+            discardStagedAttachments(requestId);
         }
 
         // URL 对于聊天和文生图是相同的
@@ -99,7 +173,7 @@
         const newMessages = [];
         let lastMsgIdInChain = null;
 
-        if (!message_templates || message_templates.length === 0) {
+        if (templates.length === 0) {
             const errorMsg = "从后端收到的消息列表为空。";
             console.error(`[API Bridge] ${errorMsg}`);
             sendToServer(requestId, { error: errorMsg });
@@ -108,14 +182,14 @@
         }
 
         // 这个循环逻辑对于聊天和文生图是通用的，因为后端已经准备好了正确的 message_templates
-        for (let i = 0; i < message_templates.length; i++) {
-            const template = message_templates[i];
+        for (let i = 0; i < templates.length; i++) {
+            const template = templates[i];
             const currentMsgId = crypto.randomUUID();
             const parentIds = lastMsgIdInChain ? [lastMsgIdInChain] : [];
             
             // 如果是文生图请求，状态总是 'success'
             // 否则，只有最后一条消息是 'pending'
-            const status = is_image_request ? 'success' : ((i === message_templates.length - 1) ? 'pending' : 'success');
+            const status = is_image_request ? 'success' : ((i === templates.length - 1) ? 'pending' : 'success');
 
             newMessages.push({
                 role: template.role,
@@ -142,6 +216,10 @@
 
         console.log("[API Bridge] 准备发送到 LMArena API 的最终载荷:", JSON.stringify(body, null, 2));
 
+        // 每个请求一个 AbortController，服务器发来 abort 指令时可以立即中止上游的 fetch
+        const controller = new AbortController();
+        activeRequests.set(requestId, controller);
+
         // 设置一个标志，让我们的 fetch 拦截器知道这个请求是脚本自己发起的
         window.isApiBridgeRequest = true;
         try {
@@ -152,7 +230,8 @@
                     'Accept': '*/*',
                 },
                 body: JSON.stringify(body),
-                credentials: 'include' // 必须包含 cookie
+                credentials: 'include', // 必须包含 cookie
+                signal: controller.signal
             });
 
             if (!response.ok || !response.body) {
@@ -176,25 +255,196 @@
             }
 
         } catch (error) {
+            if (controller.signal.aborted) {
+                // 服务器已经清理了该请求，无需再回传任何数据
+                console.log(`[API Bridge] 请求 ${requestId.substring(0, 8)} 已按服务器指令中止。`);
+                return;
+            }
             console.error(`[API Bridge] ❌ 在为请求 ${requestId.substring(0, 8)} 执行 fetch 时出错:`, error);
             sendToServer(requestId, { error: error.message });
             sendToServer(requestId, "[DONE]");
         } finally {
             // 请求结束后，无论成功与否，都重置标志
             window.isApiBridgeRequest = false;
+            activeRequests.delete(requestId);
+        }
+    }
+
+    // --- 附件缓存 ---
+    function rememberAttachment(hash, url) {
+        if (attachmentCache.has(hash)) {
+            attachmentCache.delete(hash);
+            attachmentCache.set(hash, url);
+            return;
+        }
+        attachmentCache.set(hash, url);
+        attachmentCacheBytes += url.length;
+        // 与服务器端相同的规则淘汰最久未使用的附件（至少保留一个）
+        while (attachmentCacheBytes > attachmentCacheLimit && attachmentCache.size > 1) {
+            const [oldHash, oldUrl] = attachmentCache.entries().next().value;
+            attachmentCache.delete(oldHash);
+            attachmentCacheBytes -= oldUrl.length;
+        }
+    }
+
+    function requestMissingAttachments(requestId, refs) {
+        return new Promise((resolve, reject) => {
+            const timer = setTimeout(() => {
+                pendingAttachmentRequests.delete(requestId);
+                reject(new Error("等待服务器补发附件超时。"));
+            }, ATTACHMENT_FETCH_TIMEOUT_MS);
+            pendingAttachmentRequests.set(requestId, {
+                resolve: (attachments) => { clearTimeout(timer); resolve(attachments); },
+                reject: (error) => { clearTimeout(timer); reject(error); }
+            });
+            socket.send(JSON.stringify({ command: "attachment_miss", request_id: requestId, refs: refs }));
+        });
+    }
+
+    function stagedKey(requestId, hash) {
+        return `${requestId}:${hash}`;
+    }
+
+    // 丢弃某个请求剩余的分片附件（请求已处理完或无法处理）
+    function discardStagedAttachments(requestId) {
+        const prefix = `${requestId}:`;
+        for (const map of [incomingAttachmentParts, stagedAttachments]) {
+            for (const key of [...map.keys()]) {
+                if (key.startsWith(prefix)) {
+                    map.delete(key);
+                }
+            }
+        }
+    }
+
+    // 将服务器发来的附件 ({hash, url}、{hash, staged} 或 {ref}) 还原为 LMArena 需要的 {name, contentType, url}
+    async function resolveAttachments(requestId, messageTemplates) {
+        // 第一遍：按顺序存入新附件、查找引用（与服务器端索引的更新顺序一致）
+        const resolved = new Map();
+        const missing = [];
+        for (const template of messageTemplates) {
+            for (const attachment of template.attachments || []) {
+                if (attachment.staged) {
+                    // 分片发送的附件在请求之前就已经全部到达
+                    attachment.ref = attachment.hash;
+                    const key = stagedKey(requestId, attachment.hash);
+                    const url = stagedAttachments.get(key);
+                    stagedAttachments.delete(key);
+                    if (url) {
+                        rememberAttachment(attachment.hash, url);
+                        resolved.set(attachment.hash, url);
+                    } else if (!resolved.has(attachment.hash)) {
+                        missing.push(attachment.hash);
+                    }
+                } else if (attachment.hash && attachment.url) {
+                    rememberAttachment(attachment.hash, attachment.url);
+                    resolved.set(attachment.hash, attachment.url);
+                } else if (attachment.ref && !resolved.has(attachment.ref)) {
+                    const url = attachmentCache.get(attachment.ref);
+                    if (url) {
+                        rememberAttachment(attachment.ref, url);
+                        resolved.set(attachment.ref, url);
+                    } else {
+                        missing.push(attachment.ref);
+                    }
+                }
+            }
+        }
+
+        if (missing.length > 0) {
+            console.log(`[API Bridge] 附件缓存未命中 ${missing.length} 个，正在向服务器请求完整内容...`);
+            const fetched = await requestMissingAttachments(requestId, missing);
+            for (const hash of missing) {
+                if (!fetched[hash]) {
+                    throw new Error(`服务器也无法提供附件 ${hash.substring(0, 12)}，请重新发送请求。`);
+                }
+                rememberAttachment(hash, fetched[hash]);
+                resolved.set(hash, fetched[hash]);
+            }
         }
+
+        // 第二遍：构建最终的附件列表
+        return messageTemplates.map(template => ({
+            ...template,
+            attachments: (template.attachments || []).map(attachment => ({
+                name: attachment.name,
+                contentType: attachment.contentType,
+                url: attachment.ref ? resolved.get(attachment.ref) : attachment.url
+            }))
+        }));
     }
 
     function sendToServer(requestId, data) {
-        if (socket && socket.readyState === WebSocket.OPEN) {
+        if (!socket || socket.readyState !== WebSocket.OPEN) {
+            console.error("[API Bridge] 无法发送数据，WebSocket 连接未打开。");
+            return;
+        }
+        if (!useBinaryProtocol) {
             const message = {
                 request_id: requestId,
                 data: data
             };
             socket.send(JSON.stringify(message));
-        } else {
-            console.error("[API Bridge] 无法发送数据，WebSocket 连接未打开。");
+            return;
+        }
+        // 二进制协议：先放入发件箱，在同一时间窗口内的多个数据块会被打包进一个帧
+        outbox.push([requestId, data]);
+        if (!flushScheduled) {
+            flushScheduled = true;
+            if (BATCH_WINDOW_MS > 0) {
+                setTimeout(flushOutbox, BATCH_WINDOW_MS);
+            } else {
+                queueMicrotask(flushOutbox);
+            }
+        }
+    }
+
+    function uuidToBytes(requestId, target, offset) {
+        const hex = requestId.replace(/-/g, "");
+        for (let i = 0; i < 16; i++) {
+            target[offset + i] = parseInt(hex.substr(i * 2, 2), 16);
+        }
+    }
+
+    function flushOutbox() {
+        flushScheduled = false;
+        const records = outbox;
+        outbox = [];
+        if (records.length === 0) return;
+        if (!socket || socket.readyState !== WebSocket.OPEN) {
+            console.error(`[API Bridge] 无法发送 ${records.length} 条数据，WebSocket 连接未打开。`);
+            return;
+        }
+
+        // 每条记录: 16 字节 request_id | 1 字节类型 | 4 字节负载长度 (大端) | UTF-8 负载
+        let totalLength = 0;
+        const encoded = records.map(([requestId, data]) => {
+            let kind, payload;
+            if (data === "[DONE]") {
+                kind = RECORD_KIND.DONE;
+                payload = new Uint8Array(0);
+            } else if (typeof data === "string") {
+                kind = RECORD_KIND.CHUNK;
+                payload = textEncoder.encode(data);
+            } else {
+                kind = RECORD_KIND.ERROR;
+                payload = textEncoder.encode(JSON.stringify(data));
+            }
+            totalLength += 21 + payload.length;
+            return [requestId, kind, payload];
+        });
+
+        const frame = new Uint8Array(totalLength);
+        const view = new DataView(frame.buffer);
+        let offset = 0;
+        for (const [requestId, kind, payload] of encoded) {
+            uuidToBytes(requestId, frame, offset);
+            view.setUint8(offset + 16, kind);
+            view.setUint32(offset + 17, payload.length, false);
+            frame.set(payload, offset + 21);
+            offset += 21 + payload.length;
         }
+        socket.send(frame.buffer);
     }
 
     // --- 网络请求拦截 ---
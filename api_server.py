@@ -2,6 +2,7 @@
 # 新一代 LMArena Bridge 后端服务
 
 import asyncio
+import hashlib
 import json
 import logging
 import os
@@ -11,111 +12,211 @@ import time
 import uuid
 import re
 import threading
-import random
 import mimetypes
 from datetime import datetime
 from contextlib import asynccontextmanager
+from typing import Mapping
 
 import uvicorn
-import requests
-from packaging.version import parse as parse_version
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse, Response
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse, Response
 
 # --- 导入自定义模块 ---
 from modules import image_generation
+from modules.browser_pool import BrowserPool
+from modules import stream_parser
+from modules.streaming import ChunkEncoder, coalesce_content
+from modules.config_store import ConfigStore, parse_jsonc, thaw
+from modules import ws_protocol
+from modules.channels import ChannelRegistry, ClientDisconnected
+from modules.attachment_cache import AttachmentCache, BrowserAttachmentIndex, attachment_hash, compact_attachments
+from modules.image_preprocess import ImagePreprocessor
+from modules import request_ingest
+from modules.request_ingest import SpooledData
+from modules.response_cache import MODE_DEFAULT, MODE_NO_STORE, ResponseCache, cache_mode, make_cache_key
+from modules.response_cache import replay as replay_cached
+from modules.single_flight import SingleFlight
+from modules.endpoint_selector import EndpointSelector
+from modules.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, BridgeMetrics
+from modules.tracing import RequestTrace, Tracer
+from modules.stream_recorder import StreamRecorder
+from modules.image_scheduler import ImageJobScheduler
+from modules.image_cache import ImageFetchCache, ImageFetchError
+from modules.model_extractor import ModelExtractionPool
+from modules.state_store import StateWriter
+from modules.model_catalog import ModelCatalog, etag_matches, model_metadata_entry
 
 # --- 基础配置 ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # --- 全局状态与配置 ---
-CONFIG = {} # 存储从 config.jsonc 加载的配置
-# browser_ws 用于存储与单个油猴脚本的 WebSocket 连接。
-# 注意：此架构假定只有一个浏览器标签页在工作。
-# 如果需要支持多个并发标签页，需要将此扩展为字典管理多个连接。
-browser_ws: WebSocket | None = None
-# response_channels 用于存储每个 API 请求的响应队列。
-# 键是 request_id，值是 asyncio.Queue。
-response_channels: dict[str, asyncio.Queue] = {}
+# config_store 负责 config.jsonc / model_endpoint_map.json / models.json，
+# 只在文件变化时重新解析，并以不可变快照的形式发布。读取配置时请使用
+# config_store.config / config_store.model_endpoint_map / config_store.models。
+config_store = ConfigStore()
+# browser_pool 管理所有已连接的油猴脚本（每个 LMArena 标签页一个 WebSocket 连接），
+# 新请求会被分发给负载最低的健康标签页。
+browser_pool = BrowserPool()
+# response_channels 用于存储每个 API 请求的响应队列（有容量上限）。
+# 长时间没有活动的通道会被后台清理任务回收，详见 modules/channels.py。
+response_channels = ChannelRegistry()
+# 持有后台发送的 abort 指令等短任务的引用，防止它们在完成前被垃圾回收
+_background_tasks: set[asyncio.Task] = set()
+# attachment_cache 按内容哈希保存附件，在启动时根据 config.jsonc 创建（见 lifespan）。
+attachment_cache = AttachmentCache()
+# image_preprocessor 在进程池中缩小过大的图片附件（需要 Pillow）
+image_preprocessor = ImagePreprocessor()
+# model_extraction_pool 在子进程中从 /update_models 收到的页面提取模型列表
+model_extraction_pool = ModelExtractionPool()
+# response_cache 保存完整成功的聊天响应，用于重放完全相同的请求（在 lifespan 中根据配置创建）
+response_cache = ResponseCache()
+# image_cache 保存下载过的生成图片，用于 b64_json 与本地图片代理（在 lifespan 中根据配置创建）
+image_cache = ImageFetchCache("image_cache")
+# state_writer 在工作线程中原子地写入 config.jsonc 等状态文件，并合并短时间内的多次修改
+state_writer = StateWriter()
+# model_catalog 持有预先序列化的 /v1/models 响应，模型相关文件变化时重新构建
+model_catalog = ModelCatalog('models.json')
+# chat_flights 记录正在进行的上游流，完全相同的并发请求会共享同一个上游流
+chat_flights = SingleFlight()
+# endpoint_selector 记录 model_endpoint_map.json 中各会话的延迟与错误率，并据此选择会话
+endpoint_selector = EndpointSelector()
+# metrics 收集 /metrics 端点输出的 Prometheus 指标
+metrics = BridgeMetrics()
+# tracer 记录每个请求各阶段的耗时（正在进行的与最近结束的请求），见 /debug/requests
+tracer = Tracer()
+# 浏览器原始数据流录制（可选，用于解析器的回放基准测试）
+stream_recorder = StreamRecorder()
+# 文生图任务的并发上限与会话分配
+image_scheduler = ImageJobScheduler()
 last_activity_time = None # 记录最后一次活动的时间
 idle_monitor_thread = None # 空闲监控线程
 main_event_loop = None # 主事件循环
 
 # --- 模型映射 ---
-MODEL_NAME_TO_ID_MAP = {}
-MODEL_ENDPOINT_MAP = {} # 新增：用于存储模型到 session/message ID 的映射
 DEFAULT_MODEL_ID = None # 默认模型: Claude 3.5 Sonnet
 
-def load_model_endpoint_map():
-    """从 model_endpoint_map.json 加载模型到端点的映射。"""
-    global MODEL_ENDPOINT_MAP
-    try:
-        with open('model_endpoint_map.json', 'r', encoding='utf-8') as f:
-            content = f.read()
-            # 允许空文件
-            if not content.strip():
-                MODEL_ENDPOINT_MAP = {}
-            else:
-                MODEL_ENDPOINT_MAP = json.loads(content)
-        logger.info(f"成功从 'model_endpoint_map.json' 加载了 {len(MODEL_ENDPOINT_MAP)} 个模型端点映射。")
-    except FileNotFoundError:
-        logger.warning("'model_endpoint_map.json' 文件未找到。将使用空映射。")
-        MODEL_ENDPOINT_MAP = {}
-    except json.JSONDecodeError as e:
-        logger.error(f"加载或解析 'model_endpoint_map.json' 失败: {e}。将使用空映射。")
-        MODEL_ENDPOINT_MAP = {}
-
-def load_config():
-    """从 config.jsonc 加载配置，并处理 JSONC 注释。"""
-    global CONFIG
-    try:
-        with open('config.jsonc', 'r', encoding='utf-8') as f:
-            content = f.read()
-            # 移除 // 行注释和 /* */ 块注释
-            json_content = re.sub(r'//.*', '', content)
-            json_content = re.sub(r'/\*.*?\*/', '', json_content, flags=re.DOTALL)
-            CONFIG = json.loads(json_content)
-        logger.info("成功从 'config.jsonc' 加载配置。")
-        # 打印关键配置状态
-        logger.info(f"  - 酒馆模式 (Tavern Mode): {'✅ 启用' if CONFIG.get('tavern_mode_enabled') else '❌ 禁用'}")
-        logger.info(f"  - 绕过模式 (Bypass Mode): {'✅ 启用' if CONFIG.get('bypass_enabled') else '❌ 禁用'}")
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        logger.error(f"加载或解析 'config.jsonc' 失败: {e}。将使用默认配置。")
-        CONFIG = {}
-
-def load_model_map():
-    """从 models.json 加载模型映射。"""
-    global MODEL_NAME_TO_ID_MAP
-    try:
-        with open('models.json', 'r', encoding='utf-8') as f:
-            MODEL_NAME_TO_ID_MAP = json.load(f)
-        logger.info(f"成功从 'models.json' 加载了 {len(MODEL_NAME_TO_ID_MAP)} 个模型。")
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        logger.error(f"加载 'models.json' 失败: {e}。将使用空模型列表。")
-        MODEL_NAME_TO_ID_MAP = {}
+def _log_config_changes(snapshot, changed: set[str]):
+    """配置快照更新后，打印关键配置状态。"""
+    if "config" in changed:
+        config = snapshot.config
+        logger.info(f"  - 酒馆模式 (Tavern Mode): {'✅ 启用' if config.get('tavern_mode_enabled') else '❌ 禁用'}")
+        logger.info(f"  - 绕过模式 (Bypass Mode): {'✅ 启用' if config.get('bypass_enabled') else '❌ 禁用'}")
+
+def _run_in_background(coro) -> asyncio.Task:
+    """启动一个后台任务，并在其完成前持有引用。"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+def _apply_channel_settings(snapshot, changed: set[str]):
+    """将通道相关配置应用到 response_channels（只影响之后新建的通道）。"""
+    if "config" in changed:
+        config = snapshot.config
+        response_channels.max_queue_size = config.get("channel_max_queue_size", 4096)
+        response_channels.idle_ttl = config.get(
+            "channel_idle_ttl_seconds", config.get("stream_response_timeout_seconds", 360) + 60
+        )
+
+def _apply_response_cache_settings(snapshot, changed: set[str]):
+    """将响应缓存的容量与过期时间应用到 response_cache。"""
+    if "config" in changed:
+        response_cache.max_entries = snapshot.config.get("response_cache_max_entries", 1000)
+        response_cache.ttl = snapshot.config.get("response_cache_ttl_seconds", 3600)
+
+def _apply_endpoint_selection_settings(snapshot, changed: set[str]):
+    """将会话选择与熔断相关配置应用到 endpoint_selector。"""
+    if "config" in changed:
+        config = snapshot.config
+        endpoint_selector.strategy = config.get("endpoint_selection_strategy", "p2c")
+        endpoint_selector.alpha = config.get("endpoint_ewma_alpha", 0.3)
+        endpoint_selector.failure_threshold = config.get("endpoint_breaker_failure_threshold", 3)
+        endpoint_selector.cooldown = config.get("endpoint_breaker_cooldown_seconds", 60)
+        # 一个探测请求最长可能持续的时间，超过后视为已放弃
+        endpoint_selector.probe_timeout = config.get("stream_response_timeout_seconds", 360) + 60
+
+def _apply_tracing_settings(snapshot, changed: set[str]):
+    """将请求追踪相关配置应用到 tracer。"""
+    if "config" in changed:
+        tracer.capacity = max(1, snapshot.config.get("request_trace_buffer_size", 200))
+        tracer.export_path = snapshot.config.get("request_trace_export_file") or None
+
+def _apply_stream_recording_settings(snapshot, changed: set[str]):
+    """将流录制相关配置应用到 stream_recorder。"""
+    if "config" in changed:
+        config = snapshot.config
+        stream_recorder.sample_rate = config.get("stream_recording_sample_rate", 1.0)
+        stream_recorder.max_bytes = int(config.get("stream_recording_max_mb", 200) * 1048576)
+        stream_recorder.set_directory(config.get("stream_recording_dir") or None)
+
+def _apply_image_scheduler_settings(snapshot, changed: set[str]):
+    """将文生图任务的并发上限应用到 image_scheduler。"""
+    if "config" in changed:
+        image_scheduler.configure(
+            max_concurrent=snapshot.config.get("image_max_concurrent_jobs", 4),
+            per_session_limit=snapshot.config.get("image_max_jobs_per_session", 2)
+        )
+
+# 以下回调都在主事件循环中执行（见 ConfigStore.bind_loop），可以直接操作事件循环中的对象
+config_store.add_listener(_log_config_changes)
+config_store.add_listener(_apply_channel_settings)
+config_store.add_listener(_apply_response_cache_settings)
+config_store.add_listener(_apply_endpoint_selection_settings)
+config_store.add_listener(_apply_tracing_settings)
+config_store.add_listener(_apply_stream_recording_settings)
+config_store.add_listener(_apply_image_scheduler_settings)
+config_store.add_listener(model_catalog.on_snapshot)
 
 # --- 更新检查 ---
+# 更新检查在服务器开始接受连接之后于后台线程中进行，不会拖慢启动；
+# requests、packaging 和 zipfile 只在检查更新时才导入。
 GITHUB_REPO = "Lianues/LMArenaBridge"
+UPDATE_CHECK_TIMEOUT = (3, 5)        # 获取远程版本号: (连接, 读取) 超时秒数
+UPDATE_DOWNLOAD_TIMEOUT = (5, 30)    # 下载压缩包: (连接, 两个数据块之间) 超时秒数
+UPDATE_DOWNLOAD_DEADLINE = 120       # 下载压缩包的总时长上限（秒）
+UPDATE_MAX_BYTES = 100 * 1048576     # 压缩包大小上限
+UPDATE_DRAIN_SECONDS = 300           # 应用更新前最多等待正在进行的请求完成的时长（秒）
+
+def _parse_version(version: str):
+    try:
+        from packaging.version import parse
+        return parse(version)
+    except ImportError:
+        # 未安装 packaging 时按数字逐段比较
+        return tuple(int(part) if part.isdigit() else 0 for part in re.split(r'[.\-]', version))
 
 def download_and_extract_update(version):
-    """下载并解压最新版本到临时文件夹。"""
+    """以流式方式下载最新版本的压缩包到磁盘，然后解压到临时文件夹。"""
+    import requests
+    import zipfile
+
     update_dir = "update_temp"
-    if not os.path.exists(update_dir):
-        os.makedirs(update_dir)
+    os.makedirs(update_dir, exist_ok=True)
+    zip_path = os.path.join(update_dir, "main.zip")
+    part_path = zip_path + ".part"
 
     try:
         zip_url = f"https://github.com/{GITHUB_REPO}/archive/refs/heads/main.zip"
         logger.info(f"正在从 {zip_url} 下载新版本...")
-        response = requests.get(zip_url, timeout=60)
-        response.raise_for_status()
-
-        # 需要导入 zipfile 和 io
-        import zipfile
-        import io
-        with zipfile.ZipFile(io.BytesIO(response.content)) as z:
+        deadline = time.monotonic() + UPDATE_DOWNLOAD_DEADLINE
+        size = 0
+        with requests.get(zip_url, timeout=UPDATE_DOWNLOAD_TIMEOUT, stream=True) as response:
+            response.raise_for_status()
+            with open(part_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1 << 16):
+                    size += len(chunk)
+                    if size > UPDATE_MAX_BYTES:
+                        raise IOError(f"压缩包超过 {UPDATE_MAX_BYTES // 1048576} MB")
+                    if time.monotonic() > deadline:
+                        raise IOError(f"下载超过 {UPDATE_DOWNLOAD_DEADLINE} 秒")
+                    f.write(chunk)
+        os.replace(part_path, zip_path)
+
+        with zipfile.ZipFile(zip_path) as z:
             z.extractall(update_dir)
+        os.remove(zip_path)
         
         logger.info(f"新版本已成功下载并解压到 '{update_dir}' 文件夹。")
         return True
@@ -124,49 +225,47 @@ def download_and_extract_update(version):
     except zipfile.BadZipFile:
         logger.error("下载的文件不是一个有效的zip压缩包。")
     except Exception as e:
-        logger.error(f"解压更新时发生未知错误: {e}")
+        logger.error(f"下载或解压更新时发生错误: {e}")
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
     
     return False
 
-def check_for_updates():
-    """从 GitHub 检查新版本。"""
-    if not CONFIG.get("enable_auto_update", True):
+def check_for_updates() -> bool:
+    """
+    从 GitHub 检查新版本，发现新版本时下载并解压。会做阻塞的网络 I/O，应在工作线程中调用。
+    返回是否已准备好应用更新。
+    """
+    import requests
+
+    if not config_store.config.get("enable_auto_update", True):
         logger.info("自动更新已禁用，跳过检查。")
-        return
+        return False
 
-    current_version = CONFIG.get("version", "0.0.0")
+    current_version = config_store.config.get("version", "0.0.0")
     logger.info(f"当前版本: {current_version}。正在从 GitHub 检查更新...")
 
     try:
         config_url = f"https://raw.githubusercontent.com/{GITHUB_REPO}/main/config.jsonc"
-        response = requests.get(config_url, timeout=10)
+        response = requests.get(config_url, timeout=UPDATE_CHECK_TIMEOUT)
         response.raise_for_status()
 
-        jsonc_content = response.text
-        json_content = re.sub(r'//.*', '', jsonc_content)
-        json_content = re.sub(r'/\*.*?\*/', '', json_content, flags=re.DOTALL)
-        remote_config = json.loads(json_content)
+        remote_config = parse_jsonc(response.text)
         
         remote_version_str = remote_config.get("version")
         if not remote_version_str:
             logger.warning("远程配置文件中未找到版本号，跳过更新检查。")
-            return
+            return False
 
-        if parse_version(remote_version_str) > parse_version(current_version):
+        if _parse_version(remote_version_str) > _parse_version(current_version):
             logger.info("="*60)
             logger.info(f"🎉 发现新版本! 🎉")
             logger.info(f"  - 当前版本: {current_version}")
             logger.info(f"  - 最新版本: {remote_version_str}")
             if download_and_extract_update(remote_version_str):
-                logger.info("准备应用更新。服务器将在5秒后关闭并启动更新脚本。")
-                time.sleep(5)
-                update_script_path = os.path.join("modules", "update_script.py")
-                # 使用 Popen 启动独立进程
-                subprocess.Popen([sys.executable, update_script_path])
-                # 优雅地退出当前服务器进程
-                os._exit(0)
-            else:
-                logger.error(f"自动更新失败。请访问 https://github.com/{GITHUB_REPO}/releases/latest 手动下载。")
+                return True
+            logger.error(f"自动更新失败。请访问 https://github.com/{GITHUB_REPO}/releases/latest 手动下载。")
             logger.info("="*60)
         else:
             logger.info("您的程序已是最新版本。")
@@ -177,64 +276,34 @@ def check_for_updates():
         logger.error("解析远程配置文件失败。")
     except Exception as e:
         logger.error(f"检查更新时发生未知错误: {e}")
+    return False
 
-# --- 模型更新 ---
-def extract_models_from_html(html_content):
-    """
-    从 HTML 内容中提取模型数据，采用更健壮的解析方法。
-    """
-    script_contents = re.findall(r'<script>(.*?)</script>', html_content, re.DOTALL)
-    
-    for script_content in script_contents:
-        if 'self.__next_f.push' in script_content and 'initialState' in script_content and 'publicName' in script_content:
-            match = re.search(r'self\.__next_f\.push\(\[1,"(.*?)"\]\)', script_content, re.DOTALL)
-            if not match:
-                continue
-            
-            full_payload = match.group(1)
-            
-            payload_string = full_payload.split('\\n')[0]
-            
-            json_start_index = payload_string.find(':')
-            if json_start_index == -1:
-                continue
-            
-            json_string_with_escapes = payload_string[json_start_index + 1:]
-            json_string = json_string_with_escapes.replace('\\"', '"')
-            
-            try:
-                data = json.loads(json_string)
-                
-                def find_initial_state(obj):
-                    if isinstance(obj, dict):
-                        for key, value in obj.items():
-                            if key == 'initialState' and isinstance(value, list):
-                                if value and isinstance(value[0], dict) and 'publicName' in value[0]:
-                                    return value
-                            result = find_initial_state(value)
-                            if result is not None:
-                                return result
-                    elif isinstance(obj, list):
-                        for item in obj:
-                            result = find_initial_state(item)
-                            if result is not None:
-                                return result
-                    return None
-
-                models = find_initial_state(data)
-                if models:
-                    logger.info(f"成功从脚本块中提取到 {len(models)} 个模型。")
-                    return models
-            except json.JSONDecodeError as e:
-                logger.error(f"解析提取的JSON字符串时出错: {e}")
-                continue
+async def run_update_check():
+    """后台任务：检查更新；更新已下载时，等待正在进行的请求完成后启动更新脚本并退出。"""
+    try:
+        if not await asyncio.to_thread(check_for_updates):
+            return
+    except Exception as e:
+        logger.error(f"检查更新时发生未知错误: {e}")
+        return
 
-    logger.error("错误：在HTML响应中找不到包含有效模型数据的脚本块。")
-    return None
+    logger.info("准备应用更新。等待正在进行的请求完成后，服务器将关闭并启动更新脚本。")
+    deadline = time.monotonic() + UPDATE_DRAIN_SECONDS
+    await asyncio.sleep(5)
+    while sum(w.load for w in browser_pool.workers()) > 0 and time.monotonic() < deadline:
+        await asyncio.sleep(1)
+    logger.info("="*60)
+    update_script_path = os.path.join("modules", "update_script.py")
+    # 使用 Popen 启动独立进程
+    subprocess.Popen([sys.executable, update_script_path])
+    # 退出当前服务器进程，由更新脚本完成替换
+    os._exit(0)
 
-def compare_and_update_models(new_models_list, models_path):
+# --- 模型更新 ---
+def compare_models(new_models_list, models_path):
     """
-    比较新旧模型列表，打印差异，并用新列表更新本地 models.json 文件。
+    比较新旧模型列表并打印差异。有变化时返回应写入 models.json 的新内容，否则返回 None。
+    会读取文件，应在工作线程中调用；写入由 _save_models_update 在事件循环中提交。
     """
     try:
         with open(models_path, 'r', encoding='utf-8') as f:
@@ -281,19 +350,49 @@ def compare_and_update_models(new_models_list, models_path):
     if not has_changes:
         logger.info("\n结论: 模型列表无任何变化，无需更新文件。")
         logger.info("--- 检查完毕 ---")
-        return
+        return None
 
-    logger.info("\n结论: 检测到模型变更，正在更新 'models.json'...")
-    updated_model_map = {model['publicName']: model.get('id') for model in new_models_list if 'publicName' in model and 'id' in model}
-    try:
-        with open(models_path, 'w', encoding='utf-8') as f:
-            json.dump(updated_model_map, f, indent=4, ensure_ascii=False)
-        logger.info(f"'{models_path}' 已成功更新，包含 {len(updated_model_map)} 个模型。")
-        load_model_map()
-    except IOError as e:
-        logger.error(f"写入 '{models_path}' 文件时出错: {e}")
-    
-    logger.info("--- 检查与更新完毕 ---")
+    logger.info(f"\n结论: 检测到模型变更，需要更新 '{models_path}'。")
+    logger.info("--- 检查完毕 ---")
+    return {model['publicName']: model.get('id') for model in new_models_list if 'publicName' in model and 'id' in model}
+
+def build_model_metadata(new_models_list):
+    """
+    根据页面中提取到的组织、提供方和能力等信息构建 models_metadata.json 的内容（供 /v1/models 使用）。
+    保留已有模型首次出现的时间。与当前内容相同时返回 None。
+    """
+    previous = config_store.model_metadata
+    now = int(time.time())
+    metadata = {
+        model['publicName']: model_metadata_entry(
+            model, (previous.get(model['publicName']) or {}).get('created') or now
+        )
+        for model in new_models_list if 'publicName' in model
+    }
+    return None if metadata == thaw(previous) else metadata
+
+async def _save_models_update(models_map, metadata) -> bool:
+    """
+    通过 state_writer 原子地写入 models.json / models_metadata.json（短时间内的多次更新会被合并为一次写入），
+    写入完成后刷新配置快照。返回是否全部写入成功。
+    """
+    writes = {}
+    if metadata is not None:
+        writes['models_metadata.json'] = state_writer.write_json('models_metadata.json', metadata)
+    if models_map is not None:
+        writes['models.json'] = state_writer.write_json('models.json', models_map)
+    if not writes:
+        return True
+    ok = True
+    for path, result in zip(writes, await asyncio.gather(*writes.values(), return_exceptions=True)):
+        if isinstance(result, BaseException):
+            ok = False
+            logger.error(f"写入 '{path}' 文件时出错: {result}")
+        else:
+            count = len(models_map if path == 'models.json' else metadata)
+            logger.info(f"'{path}' 已成功更新，包含 {count} 个模型。")
+    await config_store.areload()
+    return ok
 
 # --- 自动重启逻辑 ---
 def restart_server():
@@ -302,19 +401,19 @@ def restart_server():
     logger.warning("检测到服务器空闲超时，准备自动重启...")
     logger.warning("="*60)
     
-    # 1. (异步) 通知浏览器刷新
+    # 1. (异步) 通知所有已连接的标签页刷新
     async def notify_browser_refresh():
-        if browser_ws:
+        for worker in browser_pool.healthy_workers():
             try:
                 # 优先发送 'reconnect' 指令，让前端知道这是一个计划内的重启
-                await browser_ws.send_text(json.dumps({"command": "reconnect"}, ensure_ascii=False))
-                logger.info("已向浏览器发送 'reconnect' 指令。")
+                await worker.send_command("reconnect")
+                logger.info(f"已向标签页 #{worker.worker_id} 发送 'reconnect' 指令。")
             except Exception as e:
-                logger.error(f"发送 'reconnect' 指令失败: {e}")
+                logger.error(f"向标签页 #{worker.worker_id} 发送 'reconnect' 指令失败: {e}")
     
     # 在主事件循环中运行异步通知函数
     # 使用`asyncio.run_coroutine_threadsafe`确保线程安全
-    if browser_ws and browser_ws.client_state.name == 'CONNECTED' and main_event_loop:
+    if main_event_loop:
         asyncio.run_coroutine_threadsafe(notify_browser_refresh(), main_event_loop)
     
     # 2. 延迟几秒以确保消息发送
@@ -335,8 +434,8 @@ def idle_monitor():
     logger.info("空闲监控线程已启动。")
     
     while True:
-        if CONFIG.get("enable_idle_restart", False):
-            timeout = CONFIG.get("idle_restart_timeout_seconds", 300)
+        if config_store.config.get("enable_idle_restart", False):
+            timeout = config_store.config.get("idle_restart_timeout_seconds", 300)
             
             # 如果超时设置为-1，则禁用重启检查
             if timeout == -1:
@@ -357,13 +456,14 @@ def idle_monitor():
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """在服务器启动时运行的生命周期函数。"""
-    global idle_monitor_thread, last_activity_time, main_event_loop
+    global idle_monitor_thread, last_activity_time, main_event_loop, attachment_cache, response_cache, image_cache
     main_event_loop = asyncio.get_running_loop() # 获取主事件循环
-    load_config() # 首先加载配置
+    config_store.bind_loop(main_event_loop) # 配置变更回调总是在主事件循环中执行
+    config_store.reload(force=True) # 首先加载配置、模型列表与模型端点映射
     
     # --- 打印当前的操作模式 ---
-    mode = CONFIG.get("id_updater_last_mode", "direct_chat")
-    target = CONFIG.get("id_updater_battle_target", "A")
+    mode = config_store.config.get("id_updater_last_mode", "direct_chat")
+    target = config_store.config.get("id_updater_battle_target", "A")
     logger.info("="*60)
     logger.info(f"  当前操作模式: {mode.upper()}")
     if mode == 'battle':
@@ -371,29 +471,74 @@ async def lifespan(app: FastAPI):
     logger.info("  (可通过运行 id_updater.py 修改模式)")
     logger.info("="*60)
 
-    check_for_updates() # 检查程序更新
-    # load_model_map() # 已禁用：不再从 models.json 加载模型 ID
-    load_model_endpoint_map() # 加载模型端点映射
+    # 在后台检查程序更新（不阻塞启动）
+    update_check_task = _run_in_background(run_update_check())
+    # 后台监视配置文件，变化时自动发布新快照
+    config_watch_task = asyncio.create_task(
+        config_store.watch(config_store.config.get("config_reload_interval_seconds", 2))
+    )
     logger.info("服务器启动完成。等待油猴脚本连接...")
 
     # 在模型更新后，标记活动时间的起点
     last_activity_time = datetime.now()
     
     # 启动空闲监控线程
-    if CONFIG.get("enable_idle_restart", False):
+    if config_store.config.get("enable_idle_restart", False):
         idle_monitor_thread = threading.Thread(target=idle_monitor, daemon=True)
         idle_monitor_thread.start()
         
+    # 生成图片的本地缓存（目录与容量的变更需要重启才能生效）
+    image_cache = ImageFetchCache(
+        directory=config_store.config.get("image_cache_dir") or "image_cache",
+        max_bytes=int(config_store.config.get("image_cache_max_mb", 512) * 1048576),
+    )
+
     # --- 初始化自定义模块 ---
     image_generation.initialize_image_module(
         app_logger=logger,
         channels=response_channels,
-        app_config=CONFIG,
-        model_map=MODEL_NAME_TO_ID_MAP,
-        default_model_id=DEFAULT_MODEL_ID
+        store=config_store,
+        default_model_id=DEFAULT_MODEL_ID,
+        pool=browser_pool,
+        app_metrics=metrics,
+        recorder=stream_recorder,
+        scheduler=image_scheduler,
+        fetch_cache=image_cache
     )
 
+    # 按内容哈希缓存附件（磁盘缓存目录的变更需要重启才能生效）
+    attachment_cache = AttachmentCache(
+        max_memory_bytes=int(config_store.config.get("attachment_cache_memory_mb", 256) * 1048576),
+        disk_dir=config_store.config.get("attachment_cache_disk_dir") or None,
+        max_disk_bytes=int(config_store.config.get("attachment_cache_disk_mb", 1024) * 1048576),
+    )
+
+    # 精确匹配的响应缓存（磁盘目录的变更需要重启才能生效）
+    response_cache = ResponseCache(
+        max_entries=config_store.config.get("response_cache_max_entries", 1000),
+        ttl=config_store.config.get("response_cache_ttl_seconds", 3600),
+        disk_dir=config_store.config.get("response_cache_disk_dir") or None,
+    )
+
+    # 后台回收泄漏的响应通道
+    channel_reaper_task = asyncio.create_task(
+        response_channels.reap_forever(config_store.config.get("channel_reap_interval_seconds", 30))
+    )
+
+    # 图片预处理
+    image_preprocessor.max_workers = config_store.config.get("image_preprocess_workers", 2)
+    image_preprocessor.cache_bytes = int(config_store.config.get("image_preprocess_cache_mb", 64) * 1048576)
+    if config_store.config.get("image_preprocess_enabled", True) and not image_preprocessor.available:
+        logger.warning("图片预处理已启用，但未安装 Pillow (pip install Pillow)，过大的图片将按原样上传。")
+
     yield
+    update_check_task.cancel()
+    config_watch_task.cancel()
+    channel_reaper_task.cancel()
+    image_preprocessor.shutdown()
+    model_extraction_pool.shutdown()
+    await image_cache.close()
+    await state_writer.flush()
     logger.info("服务器正在关闭。")
 
 app = FastAPI(lifespan=lifespan)
@@ -409,30 +554,14 @@ app.add_middleware(
 )
 
 # --- 辅助函数 ---
-def save_config():
-    """将当前的 CONFIG 对象写回 config.jsonc 文件，保留注释。"""
+async def save_config():
+    """将当前配置快照中的会话信息写回 config.jsonc 文件，保留注释。写入在工作线程中原子地进行。"""
     try:
-        # 读取原始文件以保留注释等
-        with open('config.jsonc', 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-
-        # 使用正则表达式安全地替换值
-        def replacer(key, value, content):
-            # 这个正则表达式会找到 key，然后匹配它的 value 部分，直到逗号或右花括号
-            pattern = re.compile(rf'("{key}"\s*:\s*").*?("?)(,?\s*)$', re.MULTILINE)
-            replacement = rf'\g<1>{value}\g<2>\g<3>'
-            if not pattern.search(content): # 如果 key 不存在，就添加到文件末尾（简化处理）
-                 content = re.sub(r'}\s*$', f'  ,"{key}": "{value}"\n}}', content)
-            else:
-                 content = pattern.sub(replacement, content)
-            return content
-
-        content_str = "".join(lines)
-        content_str = replacer("session_id", CONFIG["session_id"], content_str)
-        content_str = replacer("message_id", CONFIG["message_id"], content_str)
-        
-        with open('config.jsonc', 'w', encoding='utf-8') as f:
-            f.write(content_str)
+        await state_writer.update_jsonc_values('config.jsonc', {
+            "session_id": config_store.config["session_id"],
+            "message_id": config_store.config["message_id"],
+        })
+        await config_store.areload()
         logger.info("✅ 成功将会话信息更新到 config.jsonc。")
     except Exception as e:
         logger.error(f"❌ 写入 config.jsonc 时发生错误: {e}", exc_info=True)
@@ -464,9 +593,11 @@ def _process_openai_message(message: dict) -> dict:
                 # detail 字段是 OpenAI Vision API 的一部分，这里我们复用它
                 original_filename = image_url_data.get("detail")
 
-                if url and url.startswith("data:"):
+                # 流式解析请求体时，data URI 已被暂存到临时文件 (SpooledData)
+                header = url.head if isinstance(url, SpooledData) else url
+                if header and header.startswith("data:"):
                     try:
-                        content_type = url.split(';')[0].split(':')[1]
+                        content_type = header.split(';')[0].split(':')[1]
                         
                         # 如果客户端提供了原始文件名，直接使用它
                         if original_filename and isinstance(original_filename, str):
@@ -495,7 +626,7 @@ def _process_openai_message(message: dict) -> dict:
                             "url": url
                         })
                     except (IndexError, ValueError) as e:
-                        logger.warning(f"无法解析的 base64 data URI: {url[:60]}... 错误: {e}")
+                        logger.warning(f"无法解析的 base64 data URI: {header[:60]}... 错误: {e}")
 
         text_content = "\n\n".join(text_parts)
     elif isinstance(content, str):
@@ -511,6 +642,64 @@ def _process_openai_message(message: dict) -> dict:
         "attachments": attachments
     }
 
+async def _preprocess_openai_images(messages: list, config: Mapping):
+    """
+    可选的图片预处理阶段：在 _process_openai_message 之前，把超过大小或尺寸上限的
+    图片 data URI 缩小并重新编码（在进程池中进行），以避免上传后才收到 413 错误。
+    """
+    if not config.get("image_preprocess_enabled", True) or not image_preprocessor.available:
+        return
+    max_bytes = int(config.get("image_preprocess_max_kb", 4500) * 1024)
+    max_dimension = config.get("image_preprocess_max_dimension", 0)
+    quality = config.get("image_preprocess_quality", 85)
+
+    for message in messages:
+        content = message.get("content")
+        if not isinstance(content, list):
+            continue
+        for part in content:
+            if not isinstance(part, dict) or part.get("type") != "image_url":
+                continue
+            image_url = part.get("image_url") or {}
+            url = image_url.get("url")
+            if isinstance(url, SpooledData):
+                header, size, digest = url.head, url.size, url.digest
+                async def load(data=url):
+                    return await asyncio.to_thread(data.read_text)
+            elif isinstance(url, str) and url.startswith("data:"):
+                header, size, digest = url, len(url), None
+                async def load(data=url):
+                    return data
+            else:
+                continue
+            content_type = header.split(';')[0][5:]
+            # base64 编码后的长度约为原始字节数的 4/3；未限制尺寸时，小图片无需解码
+            if not image_preprocessor.supports(content_type) or (not max_dimension and size * 3 // 4 <= max_bytes):
+                continue
+            result = await image_preprocessor.process(
+                digest or attachment_hash(url), load, max_bytes, max_dimension, quality
+            )
+            if result:
+                image_url["url"] = result
+                _rename_for_content_type(image_url, result.split(';')[0][5:])
+
+def _rename_for_content_type(image_url: dict, content_type: str):
+    """
+    图片被重新编码为其他格式后，同步修改客户端通过 detail 字段传递的原始文件名的扩展名，
+    使文件名与新的 contentType 一致（如 photo.png -> photo.jpg）。没有扩展名的 detail 保持不变。
+    """
+    name = image_url.get("detail")
+    if not isinstance(name, str):
+        return
+    stem, extension = os.path.splitext(name)
+    if not stem or not extension:
+        return
+    new_extension = mimetypes.guess_extension(content_type) or '.' + content_type.split('/')[-1]
+    if new_extension == '.jpg' and extension.lower() in ('.jpg', '.jpeg'):
+        return
+    if extension.lower() != new_extension:
+        image_url["detail"] = stem + new_extension
+
 def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str, message_id: str, mode_override: str = None, battle_target_override: str = None) -> dict:
     """
     将 OpenAI 请求体转换为油猴脚本所需的简化载荷，并应用酒馆模式、绕过模式以及对战模式。
@@ -528,7 +717,7 @@ def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str, messag
     processed_messages = [_process_openai_message(msg.copy()) for msg in messages]
 
     # 2. 应用酒馆模式 (Tavern Mode)
-    if CONFIG.get("tavern_mode_enabled"):
+    if config_store.config.get("tavern_mode_enabled"):
         system_prompts = [msg['content'] for msg in processed_messages if msg['role'] == 'system']
         other_messages = [msg for msg in processed_messages if msg['role'] != 'system']
         
@@ -556,14 +745,24 @@ def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str, messag
         })
 
     # 5. 应用绕过模式 (Bypass Mode)
-    if CONFIG.get("bypass_enabled"):
+    if config_store.config.get("bypass_enabled"):
         # 绕过模式总是添加一个 position 'a' 的用户消息
         message_templates.append({"role": "user", "content": " ", "participantPosition": "a", "attachments": []})
 
     # 6. 应用参与者位置 (Participant Position)
-    # 优先使用覆盖的模式，否则回退到全局配置
-    mode = mode_override or CONFIG.get("id_updater_last_mode", "direct_chat")
-    target_participant = battle_target_override or CONFIG.get("id_updater_battle_target", "A")
+    apply_participant_positions(message_templates, mode_override, battle_target_override)
+
+    return {
+        "message_templates": message_templates,
+        "target_model_id": target_model_id,
+        "session_id": session_id,
+        "message_id": message_id
+    }
+
+def apply_participant_positions(message_templates: list, mode_override: str = None, battle_target_override: str = None):
+    """按模式设置每条消息的 participantPosition。优先使用覆盖的模式，否则回退到全局配置。"""
+    mode = mode_override or config_store.config.get("id_updater_last_mode", "direct_chat")
+    target_participant = battle_target_override or config_store.config.get("id_updater_battle_target", "A")
     target_participant = target_participant.lower() # 确保是小写
 
     logger.info(f"正在根据模式 '{mode}' (目标: {target_participant if mode == 'battle' else 'N/A'}) 设置 Participant Positions...")
@@ -583,37 +782,48 @@ def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str, messag
             # DirectChat 模式下，非 system 消息使用默认的 'a'
             msg['participantPosition'] = 'a'
 
-    return {
-        "message_templates": message_templates,
-        "target_model_id": target_model_id,
-        "session_id": session_id,
-        "message_id": message_id
-    }
-
-# --- OpenAI 格式化辅助函数 (确保JSON序列化稳健) ---
-def format_openai_chunk(content: str, model: str, request_id: str) -> str:
-    """格式化为 OpenAI 流式块。"""
-    chunk = {
-        "id": request_id, "object": "chat.completion.chunk",
-        "created": int(time.time()), "model": model,
-        "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
-    }
-    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
-
-def format_openai_finish_chunk(model: str, request_id: str, reason: str = 'stop') -> str:
-    """格式化为 OpenAI 结束块。"""
-    chunk = {
-        "id": request_id, "object": "chat.completion.chunk",
-        "created": int(time.time()), "model": model,
-        "choices": [{"index": 0, "delta": {}, "finish_reason": reason}]
-    }
-    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\ndata: [DONE]\n\n"
+def _spooled_attachments(lmarena_payload: dict):
+    """遍历载荷中仍以 SpooledData 形式存在的附件内容。"""
+    for template in lmarena_payload["message_templates"]:
+        for attachment in template.get("attachments") or ():
+            if isinstance(attachment.get("url"), SpooledData):
+                yield attachment["url"]
 
-def format_openai_error_chunk(error_message: str, model: str, request_id: str) -> str:
-    """格式化为 OpenAI 错误块。"""
-    content = f"\n\n[LMArena Bridge Error]: {error_message}"
-    return format_openai_chunk(content, model, request_id)
+async def _stage_spooled_attachments(worker, request_id: str, lmarena_payload: dict, config: Mapping):
+    """
+    处理载荷中暂存到临时文件的附件。油猴脚本支持分片接收时，先把附件内容按块
+    以 attachment_part 指令发送，载荷中只保留 {"hash": ..., "staged": true}；
+    否则把内容读回并内联到载荷中。这样服务器在发送期间只需持有一个分片。
+    """
+    part_size = int(config.get("attachment_part_size_kb", 1024) * 1024)
+    staged = set()
+    for template in lmarena_payload["message_templates"]:
+        for attachment in template.get("attachments") or ():
+            data = attachment.get("url")
+            if not isinstance(data, SpooledData):
+                continue
+            if "attachment_parts" not in worker.features:
+                attachment["url"] = await asyncio.to_thread(data.read_text)
+                continue
+            if data.digest not in staged:
+                staged.add(data.digest)
+                parts = data.iter_text(part_size)
+                part = await asyncio.to_thread(next, parts, None)
+                while part is not None:
+                    next_part = await asyncio.to_thread(next, parts, None)
+                    await worker.send_command(
+                        "attachment_part", request_id=request_id, hash=data.digest,
+                        data=part, final=next_part is None
+                    )
+                    part = next_part
+            del attachment["url"]
+            attachment["hash"] = data.digest
+            attachment["staged"] = True
+    if staged:
+        logger.info(f"API CALL [ID: {request_id[:8]}]: 已分片发送 {len(staged)} 个暂存的附件。")
 
+# --- OpenAI 格式化辅助函数 (确保JSON序列化稳健) ---
+# 流式块由 modules/streaming.py 中的 ChunkEncoder 按流预编码，这里只保留非流式响应的构建。
 def format_openai_non_stream_response(content: str, model: str, request_id: str, reason: str = 'stop') -> dict:
     """构建符合 OpenAI 规范的非流式响应体。"""
     return {
@@ -633,6 +843,67 @@ def format_openai_non_stream_response(content: str, model: str, request_id: str,
         },
     }
 
+async def _request_browser_refresh(request_id: str):
+    """让负责该请求的标签页刷新页面（用于 Cloudflare 人机验证）。"""
+    worker = browser_pool.owner_of(request_id)
+    if not worker:
+        return
+    try:
+        await worker.send_command("refresh")
+        logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 已向标签页 #{worker.worker_id} 发送页面刷新指令。")
+    except Exception as e:
+        logger.error(f"PROCESSOR [ID: {request_id[:8]}]: 发送刷新指令失败: {e}")
+
+async def _send_abort_command(worker, request_id: str):
+    try:
+        await worker.send_command("abort", request_id=request_id)
+        logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 已通知标签页 #{worker.worker_id} 中止上游请求。")
+    except Exception as e:
+        logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: 发送中止指令失败: {e}")
+
+_BROWSER_DISCONNECTED_ERROR = "Browser disconnected during operation"
+
+def _is_session_error(message) -> bool:
+    """会话选择器使用：附件过大 (413) 与标签页断开不说明会话本身有问题，不计为该会话的失败。"""
+    message = str(message)
+    return "附件大小超过了" not in message and message != _BROWSER_DISCONNECTED_ERROR
+
+def _abort_browser_request(request_id: str, reason: str, client_gone: bool = False):
+    """
+    客户端已经不再需要该请求的结果：立即释放标签页、清理响应通道，
+    并让油猴脚本中止仍在进行的 fetch。可以重复调用。
+    client_gone 为 True 时，仍在等待的处理器以 ClientDisconnected 结束，而不是产出上游错误。
+    此函数是同步的（指令在后台任务中发送），因此可以安全地在被取消的任务的 finally 中调用。
+    """
+    worker = browser_pool.owner_of(request_id)
+    browser_pool.release(request_id)
+    # 同时唤醒可能仍在等待浏览器数据的处理器
+    if response_channels.close(request_id, reason, client_gone=client_gone):
+        logger.info(f"PROCESSOR [ID: {request_id[:8]}]: {reason}，响应通道已清理。")
+    if worker and worker.is_healthy():
+        _run_in_background(_send_abort_command(worker, request_id))
+
+# 被清理任务回收或溢出的通道同样需要释放标签页并中止浏览器端的请求
+response_channels.on_evict = _abort_browser_request
+
+async def _watch_client_disconnect(request: Request, request_id: str, subscription=None):
+    """
+    等待 HTTP 客户端断开连接。如果此时请求仍未完成，则中止它。
+    这样即使流式生成器从未开始迭代，或者正在等待非流式响应，通道也不会残留。
+    对于合并的请求 (subscription)，只让该客户端退出订阅，上游流在所有订阅者都离开后才会被取消。
+    """
+    try:
+        while True:
+            message = await request.receive()
+            if message["type"] == "http.disconnect":
+                break
+    except Exception:
+        pass
+    if subscription is not None:
+        subscription.cancel()
+    elif request_id in response_channels:
+        _abort_browser_request(request_id, "客户端已断开连接", client_gone=True)
+
 async def _process_lmarena_stream(request_id: str):
     """
     核心内部生成器：处理来自浏览器的原始数据流，并产生结构化事件。
@@ -644,12 +915,11 @@ async def _process_lmarena_stream(request_id: str):
         yield 'error', 'Internal server error: response channel not found.'
         return
 
-    buffer = ""
-    timeout = CONFIG.get("stream_response_timeout_seconds",360)
-    text_pattern = re.compile(r'[ab]0:"((?:\\.|[^"\\])*)"')
-    finish_pattern = re.compile(r'[ab]d:(\{.*?"finishReason".*?\})')
-    error_pattern = re.compile(r'(\{\s*"error".*?\})', re.DOTALL)
+    # 增量解析器只缓存当前未完成的一行，每个数据块只扫描一次
+    parser = stream_parser.LMArenaStreamParser()
+    timeout = config_store.config.get("stream_response_timeout_seconds",360)
     cloudflare_patterns = [r'<title>Just a moment...</title>', r'Enable JavaScript and cookies to continue']
+    browser_finished = False # 浏览器是否已经结束了它的 fetch（收到 [DONE] 或错误）
 
     try:
         while True:
@@ -657,11 +927,18 @@ async def _process_lmarena_stream(request_id: str):
                 raw_data = await asyncio.wait_for(queue.get(), timeout=timeout)
             except asyncio.TimeoutError:
                 logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: 等待浏览器数据超时（{timeout}秒）。")
+                metrics.upstream_errors.inc("timeout")
                 yield 'error', f'Response timed out after {timeout} seconds.'
                 return
+            response_channels.touch(request_id)
+
+            # 客户端已断开（见 _abort_browser_request）：不是上游错误，不计入错误统计
+            if isinstance(raw_data, ClientDisconnected):
+                raise raw_data
 
             # 1. 检查来自 WebSocket 端的直接错误或终止信号
             if isinstance(raw_data, dict) and 'error' in raw_data:
+                browser_finished = True
                 error_msg = raw_data.get('error', 'Unknown browser error')
                 
                 # 增强错误处理
@@ -670,124 +947,164 @@ async def _process_lmarena_stream(request_id: str):
                     if '413' in error_msg or 'too large' in error_msg.lower():
                         friendly_error_msg = "上传失败：附件大小超过了 LMArena 服务器的限制 (通常是 5MB左右)。请尝试压缩文件或上传更小的文件。"
                         logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: 检测到附件过大错误 (413)。")
+                        metrics.upstream_errors.inc("attachment_too_large")
                         yield 'error', friendly_error_msg
                         return
 
                     # 2. 检查 Cloudflare 验证页面
                     if any(re.search(p, error_msg, re.IGNORECASE) for p in cloudflare_patterns):
                         friendly_error_msg = "检测到 Cloudflare 人机验证页面。请在浏览器中刷新 LMArena 页面并手动完成验证，然后重试请求。"
-                        if browser_ws:
-                            try:
-                                await browser_ws.send_text(json.dumps({"command": "refresh"}, ensure_ascii=False))
-                                logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 在错误消息中检测到CF并已发送刷新指令。")
-                            except Exception as e:
-                                logger.error(f"PROCESSOR [ID: {request_id[:8]}]: 发送刷新指令失败: {e}")
+                        metrics.upstream_errors.inc("cloudflare")
+                        await _request_browser_refresh(request_id)
                         yield 'error', friendly_error_msg
                         return
 
                 # 3. 其他未知错误
+                metrics.upstream_errors.inc("other")
                 yield 'error', error_msg
                 return
-            if raw_data == "[DONE]":
-                break
 
-            buffer += "".join(str(item) for item in raw_data) if isinstance(raw_data, list) else raw_data
-
-            if any(re.search(p, buffer, re.IGNORECASE) for p in cloudflare_patterns):
-                error_msg = "检测到 Cloudflare 人机验证页面。请在浏览器中刷新 LMArena 页面并手动完成验证，然后重试请求。"
-                if browser_ws:
-                    try:
-                        await browser_ws.send_text(json.dumps({"command": "refresh"}, ensure_ascii=False))
-                        logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 已向浏览器发送页面刷新指令。")
-                    except Exception as e:
-                        logger.error(f"PROCESSOR [ID: {request_id[:8]}]: 发送刷新指令失败: {e}")
-                yield 'error', error_msg
-                return
-            
-            if (error_match := error_pattern.search(buffer)):
-                try:
-                    error_json = json.loads(error_match.group(1))
-                    yield 'error', error_json.get("error", "来自 LMArena 的未知错误")
+            is_done = raw_data == "[DONE]"
+            if is_done:
+                browser_finished = True
+                # 流结束时，处理缓冲区中可能没有换行符的最后一行
+                events = parser.close()
+            else:
+                chunk = "".join(str(item) for item in raw_data) if isinstance(raw_data, list) else raw_data
+                events = parser.feed(chunk)
+
+            for event_type, value in events:
+                if event_type == stream_parser.TEXT:
+                    yield 'content', value
+                elif event_type == stream_parser.FINISH:
+                    yield 'finish', value
+                elif event_type == stream_parser.ERROR:
+                    metrics.upstream_errors.inc("other")
+                    yield 'error', value
+                    return
+                elif event_type == stream_parser.CLOUDFLARE:
+                    error_msg = "检测到 Cloudflare 人机验证页面。请在浏览器中刷新 LMArena 页面并手动完成验证，然后重试请求。"
+                    metrics.upstream_errors.inc("cloudflare")
+                    await _request_browser_refresh(request_id)
+                    yield 'error', error_msg
                     return
-                except json.JSONDecodeError: pass
-
-            while (match := text_pattern.search(buffer)):
-                try:
-                    text_content = json.loads(f'"{match.group(1)}"')
-                    if text_content: yield 'content', text_content
-                except (ValueError, json.JSONDecodeError): pass
-                buffer = buffer[match.end():]
 
-            if (finish_match := finish_pattern.search(buffer)):
-                try:
-                    finish_data = json.loads(finish_match.group(1))
-                    yield 'finish', finish_data.get("finishReason", "stop")
-                except (json.JSONDecodeError, IndexError): pass
-                buffer = buffer[finish_match.end():]
+            if is_done:
+                break
 
     except asyncio.CancelledError:
+        # 通常是客户端断开了流式连接
         logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 任务被取消。")
+        raise
     finally:
-        if request_id in response_channels:
-            del response_channels[request_id]
+        if not browser_finished:
+            # 提前结束（客户端断开、超时或流中出错）：让浏览器停止读取上游的流
+            _abort_browser_request(request_id, "请求已提前结束")
+        browser_pool.release(request_id)
+        stream_recorder.end(request_id)
+        if response_channels.close(request_id):
             logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 响应通道已清理。")
 
-async def stream_generator(request_id: str, model: str):
-    """将内部事件流格式化为 OpenAI SSE 响应。"""
-    response_id = f"chatcmpl-{uuid.uuid4()}"
+def _resolve_stream_coalescing(request: Request) -> tuple[float, int] | None:
+    """
+    根据请求头 `X-Stream-Coalesce` 和 config.jsonc 决定是否合并流式 token。
+    返回 (合并窗口秒数, 合并阈值字符数)，不合并时返回 None。
+    """
+    interval_ms = config_store.config.get("stream_coalescing_interval_ms", 50)
+    enabled = config_store.config.get("stream_coalescing_enabled", False)
+
+    header = request.headers.get("x-stream-coalesce", "").strip().lower()
+    if header in ("on", "true", "1", "yes"):
+        enabled = True
+    elif header in ("off", "false", "0", "no"):
+        enabled = False
+    elif header:
+        try:
+            interval_ms = float(header)
+            enabled = interval_ms > 0
+        except ValueError:
+            logger.warning(f"无法识别的 X-Stream-Coalesce 请求头: '{header}'，将使用配置文件中的设置。")
+
+    if not enabled:
+        return None
+    return interval_ms / 1000, config_store.config.get("stream_coalescing_max_chars", 512)
+
+async def stream_generator(request_id: str, model: str, coalescing: tuple[float, int] | None = None, events=None):
+    """
+    将内部事件流格式化为 OpenAI SSE 响应，直接产出编码好的 bytes。
+    events 默认为该请求的浏览器响应流，也可以传入缓存重放等其他事件源。
+    """
+    encoder = ChunkEncoder(f"chatcmpl-{uuid.uuid4()}", model)
     logger.info(f"STREAMER [ID: {request_id[:8]}]: 流式生成器启动。")
     
     finish_reason_to_send = 'stop'  # 默认的结束原因
 
-    async for event_type, data in _process_lmarena_stream(request_id):
-        if event_type == 'content':
-            yield format_openai_chunk(data, model, response_id)
-        elif event_type == 'finish':
-            # 记录结束原因，但不要立即返回，等待浏览器发送 [DONE]
-            finish_reason_to_send = data
-            if data == 'content-filter':
-                warning_msg = "\n\n响应被终止，可能是上下文超限或者模型内部审查（大概率）的原因"
-                yield format_openai_chunk(warning_msg, model, response_id)
-        elif event_type == 'error':
-            logger.error(f"STREAMER [ID: {request_id[:8]}]: 流中发生错误: {data}")
-            yield format_openai_error_chunk(str(data), model, response_id)
-            yield format_openai_finish_chunk(model, response_id, reason='stop')
-            return # 发生错误时，可以立即终止
+    if events is None:
+        events = _process_lmarena_stream(request_id)
+    if coalescing:
+        # 合并相邻的小 token，首个 token 仍立即发送
+        events = coalesce_content(events, *coalescing)
+
+    try:
+        async for event_type, data in events:
+            if event_type == 'content':
+                yield encoder.content(data)
+            elif event_type == 'finish':
+                # 记录结束原因，但不要立即返回，等待浏览器发送 [DONE]
+                finish_reason_to_send = data
+                if data == 'content-filter':
+                    warning_msg = "\n\n响应被终止，可能是上下文超限或者模型内部审查（大概率）的原因"
+                    yield encoder.content(warning_msg)
+            elif event_type == 'error':
+                logger.error(f"STREAMER [ID: {request_id[:8]}]: 流中发生错误: {data}")
+                yield encoder.error(str(data))
+                yield encoder.finish('stop')
+                return # 发生错误时，可以立即终止
+    except ClientDisconnected:
+        logger.info(f"STREAMER [ID: {request_id[:8]}]: 客户端已断开，流式生成器结束。")
+        return
 
     # 只有在 _process_lmarena_stream 自然结束后 (即收到 [DONE]) 才执行
-    yield format_openai_finish_chunk(model, response_id, reason=finish_reason_to_send)
+    yield encoder.finish(finish_reason_to_send)
     logger.info(f"STREAMER [ID: {request_id[:8]}]: 流式生成器正常结束。")
 
-async def non_stream_response(request_id: str, model: str):
-    """聚合内部事件流并返回单个 OpenAI JSON 响应。"""
+async def non_stream_response(request_id: str, model: str, events=None):
+    """聚合内部事件流并返回单个 OpenAI JSON 响应。events 的含义与 stream_generator 相同。"""
     response_id = f"chatcmpl-{uuid.uuid4()}"
     logger.info(f"NON-STREAM [ID: {request_id[:8]}]: 开始处理非流式响应。")
     
     full_content = []
     finish_reason = "stop"
     
-    async for event_type, data in _process_lmarena_stream(request_id):
-        if event_type == 'content':
-            full_content.append(data)
-        elif event_type == 'finish':
-            finish_reason = data
-            if data == 'content-filter':
-                full_content.append("\n\n响应被终止，可能是上下文超限或者模型内部审查（大概率）的原因")
-            # 不要在这里 break，继续等待来自浏览器的 [DONE] 信号，以避免竞态条件
-        elif event_type == 'error':
-            logger.error(f"NON-STREAM [ID: {request_id[:8]}]: 处理时发生错误: {data}")
-            
-            # 统一流式和非流式响应的错误状态码
-            status_code = 413 if "附件大小超过了" in str(data) else 500
-
-            error_response = {
-                "error": {
-                    "message": f"[LMArena Bridge Error]: {data}",
-                    "type": "bridge_error",
-                    "code": "attachment_too_large" if status_code == 413 else "processing_error"
+    if events is None:
+        events = _process_lmarena_stream(request_id)
+    try:
+        async for event_type, data in events:
+            if event_type == 'content':
+                full_content.append(data)
+            elif event_type == 'finish':
+                finish_reason = data
+                if data == 'content-filter':
+                    full_content.append("\n\n响应被终止，可能是上下文超限或者模型内部审查（大概率）的原因")
+                # 不要在这里 break，继续等待来自浏览器的 [DONE] 信号，以避免竞态条件
+            elif event_type == 'error':
+                logger.error(f"NON-STREAM [ID: {request_id[:8]}]: 处理时发生错误: {data}")
+                
+                # 统一流式和非流式响应的错误状态码
+                status_code = 413 if "附件大小超过了" in str(data) else 500
+
+                error_response = {
+                    "error": {
+                        "message": f"[LMArena Bridge Error]: {data}",
+                        "type": "bridge_error",
+                        "code": "attachment_too_large" if status_code == 413 else "processing_error"
+                    }
                 }
-            }
-            return Response(content=json.dumps(error_response, ensure_ascii=False), status_code=status_code, media_type="application/json")
+                return Response(content=json.dumps(error_response, ensure_ascii=False), status_code=status_code, media_type="application/json")
+    except ClientDisconnected:
+        # 客户端已经收不到响应，这里的状态码只用于访问日志
+        logger.info(f"NON-STREAM [ID: {request_id[:8]}]: 客户端已断开，放弃响应。")
+        return Response(status_code=499)
 
     final_content = "".join(full_content)
     response_data = format_openai_non_stream_response(final_content, model, response_id, reason=finish_reason)
@@ -796,20 +1113,80 @@ async def non_stream_response(request_id: str, model: str):
     return Response(content=json.dumps(response_data, ensure_ascii=False), media_type="application/json")
 
 # --- WebSocket 端点 ---
+async def _send_missing_attachments(worker, request_id: str, refs: list):
+    """回应油猴脚本的 attachment_miss：按哈希取回附件内容并发送给它。"""
+    attachments = {}
+    for digest in refs:
+        if isinstance(digest, str):
+            attachments[digest] = await attachment_cache.get(digest)
+            if attachments[digest] is not None and worker.attachments is not None:
+                worker.attachments.touch(digest, len(attachments[digest]))
+    found = sum(1 for url in attachments.values() if url is not None)
+    logger.info(f"ATTACHMENTS [ID: {str(request_id)[:8]}]: 标签页 #{worker.worker_id} 缓存未命中，补发 {found}/{len(refs)} 个附件。")
+    try:
+        await worker.send_command("attachments", request_id=request_id, attachments=attachments)
+    except Exception as e:
+        logger.error(f"ATTACHMENTS [ID: {str(request_id)[:8]}]: 补发附件失败: {e}")
+
+def _dispatch_browser_data(request_id: str, data):
+    """将浏览器发回的数据放入对应的响应通道（不阻塞接收循环）。"""
+    if request_id not in response_channels:
+        logger.warning(f"⚠️ 收到未知或已关闭请求的响应: {request_id}")
+        return
+    tracer.mark(request_id, "first_chunk")
+    stream_recorder.record(request_id, data)
+    response_channels.deliver(request_id, data)
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    """处理来自油猴脚本的 WebSocket 连接。"""
-    global browser_ws
+    """处理来自油猴脚本的 WebSocket 连接。每个标签页都作为工作池中的一个独立工作者。"""
     await websocket.accept()
-    if browser_ws is not None:
-        logger.warning("检测到新的油猴脚本连接，旧的连接将被替换。")
-    logger.info("✅ 油猴脚本已成功连接 WebSocket。")
-    browser_ws = websocket
+    worker = browser_pool.register(websocket)
+    metrics.browser_connections.inc()
+    logger.info(f"✅ 油猴脚本已成功连接 WebSocket (标签页 #{worker.worker_id}，当前共 {len(browser_pool)} 个标签页)。")
     try:
         while True:
-            # 等待并接收来自油猴脚本的消息
-            message_str = await websocket.receive_text()
-            message = json.loads(message_str)
+            # 等待并接收来自油猴脚本的消息（JSON 文本帧或协商后的二进制批量帧）
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+
+            if frame.get("bytes") is not None:
+                try:
+                    records = ws_protocol.decode_frame(frame["bytes"])
+                except (ws_protocol.ProtocolError, ValueError) as e:
+                    logger.warning(f"标签页 #{worker.worker_id} 发送了无法解析的二进制帧: {e}")
+                    continue
+                metrics.ws_frames.inc(worker.protocol)
+                metrics.ws_records.inc(amount=len(records))
+                for request_id, data in records:
+                    _dispatch_browser_data(request_id, data)
+                continue
+
+            message = json.loads(frame.get("text") or "{}")
+
+            # 协议协商：油猴脚本声明自己支持的协议，服务器选择其一
+            if message.get("command") == "hello":
+                config = config_store.config
+                worker.protocol = ws_protocol.negotiate(
+                    message.get("protocols"),
+                    binary_enabled=config.get("websocket_binary_frames_enabled", True)
+                )
+                # 油猴脚本支持附件引用时，为该标签页建立附件索引，并告知它缓存容量
+                browser_cache_bytes = 0
+                worker.features = set(message.get("features") or ())
+                if "attachment_refs" in worker.features and config.get("attachment_cache_enabled", True):
+                    browser_cache_bytes = int(config.get("browser_attachment_cache_mb", 200) * 1048576)
+                    worker.attachments = BrowserAttachmentIndex(browser_cache_bytes)
+                await worker.send_command("protocol", protocol=worker.protocol, attachment_cache_bytes=browser_cache_bytes)
+                logger.info(f"标签页 #{worker.worker_id} 协商使用 '{worker.protocol}' 协议"
+                            f"{'，启用附件引用' if worker.attachments else ''}。")
+                continue
+
+            # 油猴脚本的附件缓存未命中：补发完整内容
+            if message.get("command") == "attachment_miss":
+                _run_in_background(_send_missing_attachments(worker, message.get("request_id"), message.get("refs") or []))
+                continue
             
             request_id = message.get("request_id")
             data = message.get("data")
@@ -818,44 +1195,86 @@ async def websocket_endpoint(websocket: WebSocket):
                 logger.warning(f"收到来自浏览器的无效消息: {message}")
                 continue
 
-            # 将收到的数据放入对应的响应通道
-            if request_id in response_channels:
-                await response_channels[request_id].put(data)
-            else:
-                logger.warning(f"⚠️ 收到未知或已关闭请求的响应: {request_id}")
+            metrics.ws_frames.inc("json")
+            metrics.ws_records.inc()
+            _dispatch_browser_data(request_id, data)
 
     except WebSocketDisconnect:
-        logger.warning("❌ 油猴脚本客户端已断开连接。")
+        logger.warning(f"❌ 油猴脚本客户端 (标签页 #{worker.worker_id}) 已断开连接。")
     except Exception as e:
         logger.error(f"WebSocket 处理时发生未知错误: {e}", exc_info=True)
     finally:
-        browser_ws = None
-        # 清理所有等待的响应通道，以防请求被挂起
-        for queue in response_channels.values():
-            await queue.put({"error": "Browser disconnected during operation"})
-        response_channels.clear()
-        logger.info("WebSocket 连接已清理。")
+        # 只让由该标签页负责的请求失败，其他标签页上的请求不受影响
+        orphaned = browser_pool.unregister(worker)
+        metrics.browser_disconnections.inc()
+        for request_id in orphaned:
+            response_channels.deliver(request_id, {"error": _BROWSER_DISCONNECTED_ERROR})
+        logger.info(f"标签页 #{worker.worker_id} 的 WebSocket 连接已清理 (中断了 {len(orphaned)} 个请求，剩余 {len(browser_pool)} 个标签页)。")
 
 # --- 模型更新端点 ---
+# 每个标签页每次加载页面都会上传完整的 HTML（几 MB）。按内容哈希跳过与上次相同的页面，
+# 提取到的模型列表也与上次相同时跳过比较和写入；同一时间只处理一个页面。
+_models_page_lock = asyncio.Lock()
+_last_models_page_digest = None
+_last_models_digest = None
+
+def _prepare_models_update(chunks: list[bytes]):
+    """
+    在工作线程中运行：在子进程中提取模型列表，再与当前文件比较。
+    返回 (提取到的模型列表的摘要, 新的 models.json 内容, 新的 models_metadata.json 内容)，
+    提取失败时返回 None；模型列表与上次相同、或文件不需要更新时对应的内容为 None。
+    """
+    new_models_list = model_extraction_pool.extract(chunks)
+    if not new_models_list:
+        return None
+    models_digest = hashlib.sha256(json.dumps(new_models_list, sort_keys=True).encode('utf-8')).hexdigest()
+    if models_digest == _last_models_digest:
+        return models_digest, None, None
+    return models_digest, compare_models(new_models_list, 'models.json'), build_model_metadata(new_models_list)
+
 @app.post("/update_models")
 async def update_models_endpoint(request: Request):
     """
     接收来自油猴脚本的页面 HTML，提取并更新模型列表。
+    事件循环上只做分块哈希，提取在子进程中、比较在工作线程中进行，文件由 state_writer 写入。
     """
-    html_content = await request.body()
-    if not html_content:
+    global _last_models_page_digest, _last_models_digest
+    hasher = hashlib.sha256()
+    chunks = []
+    async for chunk in request.stream():
+        if chunk:
+            hasher.update(chunk)
+            chunks.append(chunk)
+    if not chunks:
         logger.warning("模型更新请求未收到任何 HTML 内容。")
         return JSONResponse(
             status_code=400,
             content={"status": "error", "message": "No HTML content received."}
         )
-    
-    logger.info("收到来自油猴脚本的页面内容，开始检查并更新模型...")
-    new_models_list = extract_models_from_html(html_content.decode('utf-8'))
-    
-    if new_models_list:
-        compare_and_update_models(new_models_list, 'models.json')
-        # load_model_map() is now called inside compare_and_update_models
+
+    page_digest = hasher.hexdigest()
+    async with _models_page_lock:
+        if page_digest == _last_models_page_digest:
+            logger.info("收到的页面内容与上次相同，跳过模型提取。")
+            return JSONResponse({"status": "success", "message": "Page unchanged, skipped."})
+
+        logger.info("收到来自油猴脚本的页面内容，开始检查并更新模型...")
+        prepared = await asyncio.to_thread(_prepare_models_update, chunks)
+        if prepared is not None:
+            models_digest, models_map, metadata = prepared
+            if models_digest == _last_models_digest:
+                logger.info("提取到的模型列表与上次相同，无需比较和更新。")
+            _last_models_page_digest, _last_models_digest = page_digest, models_digest
+
+    if prepared is not None:
+        # 在锁外等待写入，期间到达的其他页面的更新可以与这次写入合并
+        if not await _save_models_update(models_map, metadata):
+            # 写入失败：下次收到相同的页面时重新处理
+            _last_models_page_digest = _last_models_digest = None
+            return JSONResponse(
+                status_code=500,
+                content={"status": "error", "message": "Failed to save the updated model list."}
+            )
         return JSONResponse({"status": "success", "message": "Model comparison and update complete."})
     else:
         logger.error("未能从油猴脚本提供的 HTML 中提取模型数据。")
@@ -866,26 +1285,22 @@ async def update_models_endpoint(request: Request):
 
 # --- OpenAI 兼容 API 端点 ---
 @app.get("/v1/models")
-async def get_models():
-    """提供兼容 OpenAI 的模型列表。"""
-    if not MODEL_NAME_TO_ID_MAP:
+async def get_models(request: Request):
+    """
+    提供兼容 OpenAI 的模型列表。响应在模型文件变化时预先构建好（见 modules/model_catalog.py），
+    这里只返回缓存的字节；If-None-Match 与当前 ETag 匹配时返回 304。
+    """
+    model_list = model_catalog.current
+    if model_list is None:
         return JSONResponse(
             status_code=404,
             content={"error": "模型列表为空或 'models.json' 未找到。"}
         )
-    
-    return {
-        "object": "list",
-        "data": [
-            {
-                "id": model_name, 
-                "object": "model",
-                "created": int(asyncio.get_event_loop().time()), 
-                "owned_by": "LMArenaBridge"
-            }
-            for model_name in MODEL_NAME_TO_ID_MAP.keys()
-        ],
-    }
+
+    headers = {"ETag": model_list.etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), model_list.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=model_list.body, media_type="application/json", headers=headers)
 
 @app.post("/v1/chat/completions")
 async def chat_completions(request: Request):
@@ -894,13 +1309,24 @@ async def chat_completions(request: Request):
     接收 OpenAI 格式的请求，将其转换为 LMArena 格式，
     通过 WebSocket 发送给油猴脚本，然后流式返回结果。
     """
+    started_at = time.monotonic()
+    try:
+        return await _handle_chat_completions(request, started_at)
+    except HTTPException as e:
+        # 在开始响应之前就被拒绝的请求；已开始的响应由 metrics.observe_chat 统计
+        metrics.chat_requests.inc(getattr(request.state, "metric_model", "unknown"), str(e.status_code))
+        raise
+
+async def _handle_chat_completions(request: Request, started_at: float):
     global last_activity_time
     last_activity_time = datetime.now() # 更新活动时间
     logger.info(f"API请求已收到，活动时间已更新为: {last_activity_time.strftime('%Y-%m-%d %H:%M:%S')}")
 
-    load_config()  # 实时加载最新配置，确保会话ID等信息是最新的
+    # 读取当前的配置快照（配置文件变化时由后台任务自动刷新，这里只是一次指针读取）
+    snapshot = config_store.snapshot
+    config = snapshot.config
     # --- API Key 验证 ---
-    api_key = CONFIG.get("api_key")
+    api_key = config.get("api_key")
     if api_key:
         auth_header = request.headers.get('Authorization')
         if not auth_header or not auth_header.startswith('Bearer '):
@@ -916,49 +1342,92 @@ async def chat_completions(request: Request):
                 detail="提供的 API Key 不正确。"
             )
 
-    if not browser_ws:
+    # 启用响应缓存时，即使没有标签页连接，缓存命中的请求也可以得到响应
+    if not config.get("response_cache_enabled", False) and not browser_pool.has_healthy_worker():
         raise HTTPException(status_code=503, detail="油猴脚本客户端未连接。请确保 LMArena 页面已打开并激活脚本。")
 
+    # 流式解析请求体：图片等 data URI 在到达时就被暂存到临时文件，不会在内存中保留多份副本
+    spooled: list[SpooledData] = []
     try:
-        openai_req = await request.json()
-    except json.JSONDecodeError:
+        if config.get("streaming_request_parsing_enabled", True):
+            openai_req, spooled = await request_ingest.read_json_body(
+                request, spool_max_memory=int(config.get("request_spool_memory_kb", 1024) * 1024)
+            )
+        else:
+            openai_req = await request.json()
+    except ValueError:
         raise HTTPException(status_code=400, detail="无效的 JSON 请求体")
+    request.state.metric_model = _metric_model_label(openai_req.get("model"), snapshot)
+
+    try:
+        return await _dispatch_chat_request(request, openai_req, snapshot, started_at)
+    finally:
+        # 载荷已经发送给浏览器（或请求失败），暂存的附件不再需要
+        for data in spooled:
+            data.close()
+
+def _metric_model_label(model_name, snapshot) -> str:
+    """指标中的模型标签。只使用已配置的模型名称，避免任意的客户端输入让指标无限增长。"""
+    if isinstance(model_name, str) and (model_name in snapshot.models or model_name in snapshot.model_endpoint_map):
+        return model_name
+    return "other"
+
+_INVALID_SESSION_DETAIL = "最终确定的会话ID或消息ID无效。请检查 'model_endpoint_map.json' 和 'config.jsonc' 中的配置，或运行 `id_updater.py` 来更新默认值。"
+
+def _valid_session(session_id, message_id) -> bool:
+    return bool(session_id and message_id and "YOUR_" not in session_id and "YOUR_" not in message_id)
+
+def _mapping_session(mapping: Mapping) -> tuple:
+    """从映射条目中取出 (session_id, message_id, mode, battle_target)。"""
+    session_id = mapping.get("session_id")
+    message_id = mapping.get("message_id")
+    # 关键：同时获取模式信息
+    mode_override = mapping.get("mode") # 可能为 None
+    battle_target_override = mapping.get("battle_target") # 可能为 None
+    log_msg = f"将使用 Session ID: ...{session_id[-6:] if session_id else 'N/A'}"
+    if mode_override:
+        log_msg += f" (模式: {mode_override}"
+        if mode_override == 'battle':
+            log_msg += f", 目标: {battle_target_override or 'A'}"
+        log_msg += ")"
+    logger.info(log_msg)
+    return session_id, message_id, mode_override, battle_target_override
+
+async def _dispatch_chat_request(request: Request, openai_req: dict, snapshot, started_at: float):
+    """根据模型映射选择会话，把请求发送给一个标签页，并返回流式或非流式响应。"""
+    config = snapshot.config
 
     # --- 模型与会话ID映射逻辑 ---
     model_name = openai_req.get("model")
     session_id, message_id = None, None
     mode_override, battle_target_override = None, None
+    # 映射到多个会话的模型：确认请求需要发往上游（没有命中缓存、也没有合并到进行中的请求）之后
+    # 才按延迟与错误率选择会话，避免为不会发出的请求占用熔断器的探测名额
+    mapping_pool = None
+    tracked_mapping = None # 从多个映射中选出的条目，其延迟与错误率会被记录
 
-    if model_name and model_name in MODEL_ENDPOINT_MAP:
-        mapping_entry = MODEL_ENDPOINT_MAP[model_name]
+    if model_name and model_name in snapshot.model_endpoint_map:
+        mapping_entry = snapshot.model_endpoint_map[model_name]
         selected_mapping = None
 
-        if isinstance(mapping_entry, list) and mapping_entry:
-            selected_mapping = random.choice(mapping_entry)
-            logger.info(f"为模型 '{model_name}' 从ID列表中随机选择了一个映射。")
-        elif isinstance(mapping_entry, dict):
+        if isinstance(mapping_entry, (list, tuple)) and len(mapping_entry) > 1:
+            mapping_pool = mapping_entry
+            logger.info(f"模型 '{model_name}' 映射到 {len(mapping_entry)} 个会话，将在发送前选择其中一个。")
+        elif isinstance(mapping_entry, (list, tuple)) and mapping_entry:
+            selected_mapping = mapping_entry[0]
+            logger.info(f"为模型 '{model_name}' 找到了单个端点映射。")
+        elif isinstance(mapping_entry, Mapping):
             selected_mapping = mapping_entry
             logger.info(f"为模型 '{model_name}' 找到了单个端点映射（旧格式）。")
         
         if selected_mapping:
-            session_id = selected_mapping.get("session_id")
-            message_id = selected_mapping.get("message_id")
-            # 关键：同时获取模式信息
-            mode_override = selected_mapping.get("mode") # 可能为 None
-            battle_target_override = selected_mapping.get("battle_target") # 可能为 None
-            log_msg = f"将使用 Session ID: ...{session_id[-6:] if session_id else 'N/A'}"
-            if mode_override:
-                log_msg += f" (模式: {mode_override}"
-                if mode_override == 'battle':
-                    log_msg += f", 目标: {battle_target_override or 'A'}"
-                log_msg += ")"
-            logger.info(log_msg)
+            session_id, message_id, mode_override, battle_target_override = _mapping_session(selected_mapping)
 
     # 如果经过以上处理，session_id 仍然是 None，则进入全局回退逻辑
-    if not session_id:
-        if CONFIG.get("use_default_ids_if_mapping_not_found", True):
-            session_id = CONFIG.get("session_id")
-            message_id = CONFIG.get("message_id")
+    if not session_id and mapping_pool is None:
+        if config.get("use_default_ids_if_mapping_not_found", True):
+            session_id = config.get("session_id")
+            message_id = config.get("message_id")
             # 当使用全局ID时，不设置模式覆盖，让其使用全局配置
             mode_override, battle_target_override = None, None
             logger.info(f"模型 '{model_name}' 未找到有效映射，根据配置使用全局默认 Session ID: ...{session_id[-6:] if session_id else 'N/A'}")
@@ -970,58 +1439,168 @@ async def chat_completions(request: Request):
             )
 
     # --- 验证最终确定的会话信息 ---
-    if not session_id or not message_id or "YOUR_" in session_id or "YOUR_" in message_id:
-        raise HTTPException(
-            status_code=400,
-            detail="最终确定的会话ID或消息ID无效。请检查 'model_endpoint_map.json' 和 'config.jsonc' 中的配置，或运行 `id_updater.py` 来更新默认值。"
-        )
+    if mapping_pool is None and not _valid_session(session_id, message_id):
+        raise HTTPException(status_code=400, detail=_INVALID_SESSION_DETAIL)
 
-    if not model_name or model_name not in MODEL_NAME_TO_ID_MAP:
+    if not model_name or model_name not in snapshot.models:
         logger.warning(f"请求的模型 '{model_name}' 不在 models.json 中，将使用默认模型ID。")
 
     request_id = str(uuid.uuid4())
-    response_channels[request_id] = asyncio.Queue()
-    logger.info(f"API CALL [ID: {request_id[:8]}]: 已创建响应通道。")
+    model = model_name or "default_model"
+    is_stream = openai_req.get("stream", True)
+    # 追踪该请求各阶段的耗时，见 /debug/requests
+    trace = tracer.start(request_id, started_at, kind="chat.completion", model=model, stream=bool(is_stream))
+    trace.add_span("read_body", 0.0, trace._now())
+    handed_off = False # 事件流建立之后，标签页、通道与录制由流处理器负责清理
+
+    def abandon_setup(status: str):
+        # 请求在开始响应之前结束：释放它占用的资源，并以对应的状态结束追踪
+        if not handed_off:
+            browser_pool.release(request_id)
+            response_channels.close(request_id)
+            stream_recorder.end(request_id)
+            if tracked_mapping is not None:
+                endpoint_selector.release_probe(model_name, tracked_mapping)
+        tracer.finish(trace, status)
 
     try:
+        # 0. 可选：缩小过大的图片附件
+        with trace.span("preprocess"):
+            await _preprocess_openai_images(openai_req.get("messages", []), config)
+
         # 1. 转换请求，传入可能存在的模式覆盖信息
-        lmarena_payload = convert_openai_to_lmarena_payload(
-            openai_req,
-            session_id,
-            message_id,
-            mode_override=mode_override,
-            battle_target_override=battle_target_override
-        )
-        
-        # 2. 包装成发送给浏览器的消息
+        with trace.span("convert"):
+            lmarena_payload = convert_openai_to_lmarena_payload(
+                openai_req,
+                session_id,
+                message_id,
+                mode_override=mode_override,
+                battle_target_override=battle_target_override
+            )
+
+        # 相同的请求（模型、会话、消息与附件内容都相同）具有相同的请求键
+        single_flight = config.get("single_flight_enabled", False)
+        request_key = None
+        if single_flight or config.get("response_cache_enabled", False):
+            request_key = make_cache_key(model, lmarena_payload)
+
+        # 2. 精确匹配的响应缓存：命中时直接重放，不占用任何标签页
+        cache_key, headers = None, None
+        if config.get("response_cache_enabled", False):
+            mode = cache_mode(request.headers.get("cache-control"))
+            headers = {"X-Bridge-Cache": "BYPASS" if mode != MODE_DEFAULT else "MISS"}
+            if mode != MODE_NO_STORE:
+                cache_key = request_key
+            if mode == MODE_DEFAULT:
+                cached = await response_cache.get(cache_key)
+                if cached is not None:
+                    logger.info(f"API CALL [ID: {request_id[:8]}]: 响应缓存命中 ({cache_key[:12]})，直接重放。")
+                    trace.attributes["cache"] = "hit"
+                    return await _build_response(request, trace, model, replay_cached(cached), is_stream,
+                                                 {"X-Bridge-Cache": "HIT"})
+
+        # 3. 相同的请求正在进行时，只订阅它的事件，不再占用标签页和上游
+        if single_flight:
+            subscription = chat_flights.join(request_key)
+            if subscription is not None:
+                logger.info(f"API CALL [ID: {request_id[:8]}]: 相同的请求正在进行，已合并到请求 {subscription.leader_id[:8]}。")
+                _run_in_background(_watch_client_disconnect(request, request_id, subscription))
+                trace.attributes["coalesced_into"] = subscription.leader_id
+                return await _build_response(request, trace, model, subscription.events(), is_stream, headers)
+
+        # 请求确实需要发往上游：现在才从多个映射中选择会话
+        if mapping_pool is not None:
+            tracked_mapping = endpoint_selector.select(model_name, mapping_pool)
+            session_id, message_id, mode_override, battle_target_override = _mapping_session(tracked_mapping)
+            if not _valid_session(session_id, message_id):
+                raise HTTPException(status_code=400, detail=_INVALID_SESSION_DETAIL)
+            lmarena_payload["session_id"] = session_id
+            lmarena_payload["message_id"] = message_id
+            apply_participant_positions(lmarena_payload["message_templates"], mode_override, battle_target_override)
+
+        worker = browser_pool.acquire(request_id)
+        if not worker:
+            raise HTTPException(status_code=503, detail="油猴脚本客户端未连接。请确保 LMArena 页面已打开并激活脚本。")
+        response_channels.open(request_id)
+        stream_recorder.begin(request_id, "chat", model)
+        trace.attributes["worker"] = worker.worker_id
+        logger.info(f"API CALL [ID: {request_id[:8]}]: 已创建响应通道，分配到标签页 #{worker.worker_id} (在途请求: {worker.load})。")
+
+        with trace.span("attachments"):
+            # 4. 该标签页已缓存的附件只发送内容哈希
+            if worker.attachments is not None and config.get("attachment_cache_enabled", True):
+                for data in _spooled_attachments(lmarena_payload):
+                    await attachment_cache.put_spooled(data)
+                refs, saved = compact_attachments(
+                    lmarena_payload["message_templates"], attachment_cache, worker.attachments,
+                    min_bytes=config.get("attachment_ref_min_bytes", 4096)
+                )
+                if refs:
+                    logger.info(f"API CALL [ID: {request_id[:8]}]: {refs} 个附件以引用方式发送，节省了 {saved / 1024:.1f} KB。")
+
+            # 5. 暂存的附件先分片发送（或内联到载荷中）
+            await _stage_spooled_attachments(worker, request_id, lmarena_payload, config)
+
+        # 6. 包装成发送给浏览器的消息，并通过 WebSocket 发送
         message_to_browser = {
             "request_id": request_id,
             "payload": lmarena_payload
         }
-        
-        # 3. 通过 WebSocket 发送
         logger.info(f"API CALL [ID: {request_id[:8]}]: 正在通过 WebSocket 发送载荷到油猴脚本。")
-        await browser_ws.send_text(json.dumps(message_to_browser))
-
-        # 4. 根据 stream 参数决定返回类型
-        is_stream = openai_req.get("stream", True)
-
-        if is_stream:
-            # 返回流式响应
-            return StreamingResponse(
-                stream_generator(request_id, model_name or "default_model"),
-                media_type="text/event-stream"
-            )
-        else:
-            # 返回非流式响应
-            return await non_stream_response(request_id, model_name or "default_model")
+        with trace.span("ws_send"):
+            await worker.send_text(json.dumps(message_to_browser))
+
+        events = _process_lmarena_stream(request_id)
+        handed_off = True
+        if tracked_mapping is not None:
+            events = endpoint_selector.observe(events, model_name, tracked_mapping, started_at,
+                                               is_session_error=_is_session_error)
+        # 完整、成功结束的响应会被写入缓存
+        if cache_key:
+            events = response_cache.record(events, cache_key, model)
+        # 上游流在独立的任务中运行，之后到达的相同请求可以订阅它
+        subscription = None
+        if single_flight:
+            subscription = chat_flights.start(request_key, request_id, events)
+            events = subscription.events()
+
+        # 客户端中途断开时，立即中止浏览器端的请求（或退出订阅）并清理通道
+        _run_in_background(_watch_client_disconnect(request, request_id, subscription))
+
+        # 7. 根据 stream 参数决定返回类型
+        return await _build_response(request, trace, model, events, is_stream, headers)
+    except HTTPException:
+        abandon_setup("rejected")
+        raise
+    except asyncio.CancelledError:
+        # 客户端在请求发出之前断开
+        abandon_setup("cancelled")
+        raise
     except Exception as e:
         # 如果在设置过程中出错，清理通道
-        if request_id in response_channels:
-            del response_channels[request_id]
+        abandon_setup("error")
         logger.error(f"API CALL [ID: {request_id[:8]}]: 处理请求时发生致命错误: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+async def _build_response(request: Request, trace: RequestTrace, model: str, events, is_stream: bool,
+                          headers: dict | None = None):
+    """把内部事件流格式化为流式 (SSE) 或非流式的 OpenAI 响应。"""
+    request_id = trace.request_id
+    events = metrics.observe_chat(events, request.state.metric_model, trace.started_at)
+    events = tracer.observe(events, trace)
+    if is_stream:
+        # 返回流式响应
+        return StreamingResponse(
+            stream_generator(request_id, model, _resolve_stream_coalescing(request), events=events),
+            media_type="text/event-stream",
+            headers=headers
+        )
+    # 返回非流式响应
+    response = await non_stream_response(request_id, model, events=events)
+    if headers:
+        response.headers.update(headers)
+    return response
+
 @app.post("/v1/images/generations")
 async def images_generations(request: Request):
     """
@@ -1033,10 +1612,85 @@ async def images_generations(request: Request):
     logger.info(f"文生图 API 请求已收到，活动时间已更新为: {last_activity_time.strftime('%Y-%m-%d %H:%M:%S')}")
     
     # 模块已经通过 `initialize_image_module` 初始化，可以直接调用
-    response_data, status_code = await image_generation.handle_image_generation_request(request, browser_ws)
+    response_data, status_code = await image_generation.handle_image_generation_request(request)
+    if not isinstance(response_data, dict):
+        # stream=true：每张图片完成时作为一个 SSE 事件发出
+        return StreamingResponse(response_data, media_type="text/event-stream")
     
     return JSONResponse(content=response_data, status_code=status_code)
 
+@app.get("/v1/images/files/{key}", name="image_file")
+async def image_file(key: str):
+    """本地图片代理：从磁盘缓存发送生成的图片，第一次访问时才从 LMArena 下载。"""
+    if not re.fullmatch(r"[0-9a-f]{32}", key):
+        raise HTTPException(status_code=404, detail="图片不存在。")
+    try:
+        cached = await image_cache.open_cached(key)
+    except ImageFetchError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+    if cached is None:
+        raise HTTPException(status_code=404, detail="图片不存在或已过期。")
+    path, content_type = cached
+    # 缓存键由原始 URL 决定，内容不会变化
+    return FileResponse(path, media_type=content_type, headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+# --- 调试端点 ---
+@app.get("/debug/channels")
+async def debug_channels():
+    """查看响应通道与浏览器标签页的实时状态，用于排查内存泄漏。"""
+    return {
+        "channels": response_channels.stats(),
+        "single_flight": chat_flights.stats(),
+        "stream_recorder": stream_recorder.stats(),
+        "image_jobs": image_scheduler.stats(),
+        "image_cache": image_cache.stats(),
+        "state_writer": state_writer.stats(),
+        "workers": browser_pool.snapshot(),
+    }
+
+def _register_state_metrics():
+    """注册在抓取时才计算的状态指标。"""
+    metrics.callback("bridge_response_channels", "当前存活的响应通道数。", lambda: len(response_channels))
+    metrics.callback("bridge_response_channels_leaked_total", "被清理任务回收的泄漏通道数。",
+                     lambda: response_channels.reaped, kind="counter")
+    metrics.callback("bridge_response_channels_overflowed_total", "因队列已满而被关闭的通道数。",
+                     lambda: response_channels.overflowed, kind="counter")
+    metrics.callback("bridge_response_queue_depth", "所有响应通道中等待读取的数据块总数。",
+                     lambda: sum(response_channels.queue_depths()))
+    metrics.callback("bridge_response_queue_depth_max", "单个响应通道中等待读取的最大数据块数。",
+                     lambda: max(response_channels.queue_depths(), default=0))
+    metrics.callback("bridge_browser_tabs", "已连接的油猴脚本标签页数，按是否健康统计。",
+                     lambda: {("true",): len(browser_pool.healthy_workers()),
+                              ("false",): len(browser_pool) - len(browser_pool.healthy_workers())},
+                     labelnames=("healthy",))
+    metrics.callback("bridge_in_flight_requests", "所有标签页上正在处理的请求数。",
+                     lambda: sum(w.load for w in browser_pool.workers()))
+    metrics.callback("bridge_single_flight_streams", "正在进行且可被合并的上游流数量。",
+                     lambda: chat_flights.stats()["in_flight"])
+    metrics.callback("bridge_response_cache_entries", "响应缓存中的条目数。",
+                     lambda: response_cache.stats()["entries"])
+    metrics.callback("bridge_image_jobs", "文生图任务数，按状态统计 (running / queued)。",
+                     lambda: {("running",): image_scheduler.stats()["running"],
+                              ("queued",): image_scheduler.stats()["queued"]},
+                     labelnames=("state",))
+
+_register_state_metrics()
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """以 Prometheus 文本格式输出指标。"""
+    return Response(content=metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
+@app.get("/debug/requests")
+async def debug_requests():
+    """查看正在进行和最近结束的请求的各阶段耗时（毫秒，相对于收到请求的时间）。"""
+    return tracer.snapshot()
+
+@app.get("/debug/endpoints")
+async def debug_endpoints():
+    """查看 model_endpoint_map.json 中各会话的延迟、错误率与熔断状态。"""
+    return endpoint_selector.snapshot()
+
 # --- 内部通信端点 ---
 @app.post("/internal/start_id_capture")
 async def start_id_capture():
@@ -1044,18 +1698,24 @@ async def start_id_capture():
     接收来自 id_updater.py 的通知，并通过 WebSocket 指令
     激活油猴脚本的 ID 捕获模式。
     """
-    if not browser_ws:
+    workers = browser_pool.healthy_workers()
+    if not workers:
         logger.warning("ID CAPTURE: 收到激活请求，但没有浏览器连接。")
         raise HTTPException(status_code=503, detail="Browser client not connected.")
     
-    try:
-        logger.info("ID CAPTURE: 收到激活请求，正在通过 WebSocket 发送指令...")
-        await browser_ws.send_text(json.dumps({"command": "activate_id_capture"}))
-        logger.info("ID CAPTURE: 激活指令已成功发送。")
-        return JSONResponse({"status": "success", "message": "Activation command sent."})
-    except Exception as e:
-        logger.error(f"ID CAPTURE: 发送激活指令时出错: {e}", exc_info=True)
+    # 向所有标签页发送指令，用户可以在任意一个标签页中点击 Retry
+    logger.info(f"ID CAPTURE: 收到激活请求，正在通过 WebSocket 向 {len(workers)} 个标签页发送指令...")
+    sent = 0
+    for worker in workers:
+        try:
+            await worker.send_command("activate_id_capture")
+            sent += 1
+        except Exception as e:
+            logger.error(f"ID CAPTURE: 向标签页 #{worker.worker_id} 发送激活指令时出错: {e}", exc_info=True)
+    if not sent:
         raise HTTPException(status_code=500, detail="Failed to send command via WebSocket.")
+    logger.info(f"ID CAPTURE: 激活指令已成功发送到 {sent} 个标签页。")
+    return JSONResponse({"status": "success", "message": "Activation command sent."})
 
 
 # --- 主程序入口 ---
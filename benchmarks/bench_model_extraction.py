@@ -0,0 +1,152 @@
+# benchmarks/bench_model_extraction.py
+# 对比旧版「正则遍历全部 <script> + 整行 JSON 解析」的模型提取与 modules/model_extractor 的定位提取，
+# 并测量 /update_models 对事件循环的影响（在循环中直接提取 / 放到工作线程 / 放到子进程）。
+# 页面是合成的 Next.js 页面：大量无关的 RSC 数据块，其中一个包含 initialState 模型列表。
+#
+# 事件循环延迟是 1ms 计时器的最大迟到时间，同时给出空闲时（不做任何提取）的基线：
+# 在只有一个 CPU 核心或负载较高的机器上，操作系统调度本身就会带来 1ms 以上的迟到，
+# 这时应当把子进程的结果与基线比较，而不是与 1ms 比较。
+#
+# 用法 (在项目根目录运行):
+#   python benchmarks/bench_model_extraction.py
+#   python benchmarks/bench_model_extraction.py --size-mb 8 --models 300 --repeat 5
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+logging.disable(logging.WARNING)
+
+from modules.model_extractor import ModelExtractionPool, extract_models, extract_models_legacy
+
+
+def _push(payload: str) -> str:
+    # 与页面中一样：RSC 载荷作为 JS 字符串字面量
+    return f'<script>self.__next_f.push([1,{json.dumps(payload)}])</script>'
+
+
+def build_page(size_mb: float, model_count: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    models = [
+        {
+            "id": f"{rng.getrandbits(64):016x}-model-{i}",
+            "publicName": f"model-{i}",
+            "organization": rng.choice(["openai", "google", "anthropic", "meta", "mistral"]),
+            "provider": "lmarena",
+            "capabilities": {"inputCapabilities": {"text": True, "image": i % 3 == 0},
+                             "outputCapabilities": {"text": i % 5 != 0, "image": i % 5 == 0}},
+        }
+        for i in range(model_count)
+    ]
+    filler_text = "lorem ipsum dolor sit amet " * 40
+    parts, size, index = ['<!DOCTYPE html><html><head></head><body>'], 0, 0
+    target = int(size_mb * 1048576)
+    model_position = rng.randint(target // 3, 2 * target // 3)
+    placed = False
+    while size < target:
+        if not placed and size >= model_position:
+            block = _push(f'{index:x}:["$","$L1",null,{json.dumps({"initialState": models, "theme": "dark"})}]\n')
+            placed = True
+        else:
+            block = _push(f'{index:x}:["$","div",null,{json.dumps({"className": "text-sm", "children": filler_text})}]\n')
+        parts.append(block)
+        size += len(block)
+        index += 1
+    if not placed:
+        parts.append(_push(f'{index:x}:["$","$L1",null,{json.dumps({"initialState": models})}]\n'))
+    parts.append('</body></html>')
+    return "".join(parts)
+
+
+def best_of(repeat: int, func, *args):
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+async def loop_lag(work) -> float:
+    """在执行 work 的同时以 1ms 间隔调度一个计时器，返回事件循环的最大延迟（秒）。"""
+    worst = 0.0
+    done = False
+
+    async def ticker():
+        nonlocal worst
+        while not done:
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            worst = max(worst, time.perf_counter() - start - 0.001)
+
+    tick = asyncio.create_task(ticker())
+    await asyncio.sleep(0.01)
+    await work()
+    done = True
+    await tick
+    return worst
+
+
+async def measure_loop(html_bytes: bytes, repeat: int) -> dict[str, list[float]]:
+    # 与 /update_models 一样，页面以 64KB 的分块到达
+    chunks = [html_bytes[i:i + 65536] for i in range(0, len(html_bytes), 65536)]
+    pool = ModelExtractionPool()
+    await asyncio.to_thread(pool.extract, chunks) # 启动子进程，不计入结果
+
+    async def idle():
+        await asyncio.sleep(0.05)
+
+    async def inline():
+        extract_models_legacy(html_bytes.decode('utf-8'))
+
+    async def threaded():
+        await asyncio.to_thread(lambda: extract_models(b"".join(chunks)))
+
+    async def process():
+        await asyncio.to_thread(pool.extract, chunks)
+
+    results = {"idle": [], "inline": [], "thread": [], "process": []}
+    try:
+        for _ in range(repeat):
+            for name, work in (("idle", idle), ("inline", inline), ("thread", threaded), ("process", process)):
+                results[name].append(await loop_lag(work))
+    finally:
+        pool.shutdown()
+    return results
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="模型提取基准测试")
+    arg_parser.add_argument("--size-mb", type=float, default=4.0, help="合成页面大小 (MB)")
+    arg_parser.add_argument("--models", type=int, default=200, help="模型数量")
+    arg_parser.add_argument("--repeat", type=int, default=3, help="重复次数，取最快一次")
+    args = arg_parser.parse_args()
+
+    html = build_page(args.size_mb, args.models)
+    html_bytes = html.encode('utf-8')
+    print(f"页面大小: {len(html_bytes) / 1048576:.2f} MB，模型数: {args.models}")
+
+    legacy_time, legacy_models = best_of(args.repeat, extract_models_legacy, html)
+    new_time, new_models = best_of(args.repeat, extract_models, html_bytes)
+    same = "✅" if legacy_models == new_models and legacy_models else "❌"
+    print(f"{'实现':<10}{'耗时 (ms)':>12}")
+    print(f"{'legacy':<10}{legacy_time * 1000:>12.1f}")
+    print(f"{'targeted':<10}{new_time * 1000:>12.1f}   加速 {legacy_time / new_time:.1f}x，输出一致 {same}")
+
+    labels = {"idle": "空闲（基线）", "inline": "循环内旧版提取", "thread": "工作线程中提取", "process": "子进程中提取"}
+    lags = asyncio.run(measure_loop(html_bytes, max(args.repeat, 5)))
+    print(f"\n{'事件循环延迟':<16}{'中位数 (ms)':>14}{'最大 (ms)':>12}")
+    for name, values in lags.items():
+        print(f"{labels[name]:<16}{statistics.median(values) * 1000:>14.2f}{max(values) * 1000:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# benchmarks/bench_sse_encoder.py
+# 对比旧版 format_openai_chunk（每个 token 重建字典 + time.time() + json.dumps）
+# 与按流预编码的 ChunkEncoder 的编码速度 (chunks/sec)。
+#
+# 用法 (在项目根目录运行):
+#   python benchmarks/bench_sse_encoder.py
+#   python benchmarks/bench_sse_encoder.py --chunks 500000
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules import streaming
+from modules.streaming import ChunkEncoder
+
+
+def format_openai_chunk(content: str, model: str, request_id: str) -> str:
+    """旧版实现，用作对照组。"""
+    chunk = {
+        "id": request_id, "object": "chat.completion.chunk",
+        "created": int(time.time()), "model": model,
+        "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
+    }
+    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+
+def bench_legacy(tokens, model, response_id):
+    # StreamingResponse 最终需要 bytes，旧版的 str 会在发送前被编码，这里一并计入
+    for token in tokens:
+        format_openai_chunk(token, model, response_id).encode('utf-8')
+
+
+def bench_encoder(tokens, model, response_id):
+    encoder = ChunkEncoder(response_id, model)
+    for token in tokens:
+        encoder.content(token)
+
+
+def measure(fn, tokens, model, response_id, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(tokens, model, response_id)
+        best = min(best, time.perf_counter() - start)
+    return len(tokens) / best
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="SSE chunk 编码器微基准测试")
+    arg_parser.add_argument("--chunks", type=int, default=200000, help="每轮编码的 chunk 数量")
+    arg_parser.add_argument("--repeat", type=int, default=3, help="重复次数，取最快一次")
+    args = arg_parser.parse_args()
+
+    rng = random.Random(42)
+    vocabulary = ["Hello", " world", "，你好", " \"quoted\"", "\n", " 🚀", " lorem ipsum dolor", "的", "`code`"]
+    tokens = [rng.choice(vocabulary) for _ in range(args.chunks)]
+    model = "claude-3-5-sonnet-20241022"
+    response_id = "chatcmpl-00000000-0000-0000-0000-000000000000"
+
+    # 确认两种实现产生语义相同的 JSON
+    encoder = ChunkEncoder(response_id, model, created=0)
+    for token in vocabulary:
+        new = json.loads(encoder.content(token)[len(b"data: "):])
+        old = json.loads(format_openai_chunk(token, model, response_id)[len("data: "):])
+        old["created"] = 0
+        assert new == old, (new, old)
+
+    legacy_rate = measure(bench_legacy, tokens, model, response_id, args.repeat)
+    results = [("旧版 format_openai_chunk", legacy_rate)]
+
+    backend = streaming.orjson
+    if backend is not None:
+        results.append(("ChunkEncoder (orjson)", measure(bench_encoder, tokens, model, response_id, args.repeat)))
+        streaming.orjson = None
+    results.append(("ChunkEncoder (json)", measure(bench_encoder, tokens, model, response_id, args.repeat)))
+    streaming.orjson = backend
+
+    print(f"{'实现':<28}{'chunks/sec':>14}{'相对旧版':>10}")
+    for name, rate in results:
+        print(f"{name:<28}{rate:>14,.0f}{rate / legacy_rate:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
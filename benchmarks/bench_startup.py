@@ -0,0 +1,134 @@
+# benchmarks/bench_startup.py
+# 测量服务器的冷启动时间：从启动进程到开始接受连接、以及第一个 HTTP 请求（GET /v1/models）成功返回。
+# 服务器在项目的临时副本中运行（不会修改当前目录下的配置和缓存），使用随机的空闲端口。
+# 更新检查在后台进行，无论网络是否可用都不应影响这里测得的时间。
+#
+# 用法 (在项目根目录运行):
+#   python benchmarks/bench_startup.py
+#   python benchmarks/bench_startup.py --repeat 10 --importtime
+
+import argparse
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 复制项目时跳过的目录（运行时产生的缓存与更新文件）
+_IGNORED = shutil.ignore_patterns(".git", "__pycache__", "benchmarks", "image_cache", "update_temp", "*.log")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until(check, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if check():
+            return True
+        time.sleep(0.005)
+    return False
+
+
+def accepting(port: int) -> bool:
+    try:
+        socket.create_connection(("127.0.0.1", port), 0.05).close()
+        return True
+    except OSError:
+        return False
+
+
+def models_ok(port: int) -> bool:
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/v1/models", timeout=1) as response:
+            return response.status == 200
+    except OSError:
+        return False
+
+
+def measure_once(workdir: str, timeout: float) -> tuple[float, float]:
+    """返回 (开始接受连接的时间, /v1/models 成功返回的时间)，单位为秒。"""
+    port = free_port()
+    code = f"import uvicorn, api_server; uvicorn.run(api_server.app, host='127.0.0.1', port={port}, log_level='warning')"
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-c", code], cwd=workdir,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not wait_until(lambda: accepting(port), timeout):
+            raise RuntimeError(f"服务器在 {timeout} 秒内没有开始接受连接")
+        accepted = time.perf_counter() - start
+        if not wait_until(lambda: models_ok(port), timeout):
+            raise RuntimeError("GET /v1/models 没有成功返回")
+        first_response = time.perf_counter() - start
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+    return accepted, first_response
+
+
+def interpreter_baseline(repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def print_importtime(workdir: str, top: int = 15):
+    """输出导入 api_server 时耗时最多的顶层模块。"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import uvicorn, api_server"],
+                            cwd=workdir, capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2]
+        if len(name) - len(name.lstrip()) <= 3: # 只看被直接导入的模块
+            rows.append((int(parts[1]), name.strip()))
+    print(f"\n导入耗时最多的模块 (累计):")
+    for cumulative, name in sorted(rows, reverse=True)[:top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="服务器冷启动时间基准测试")
+    arg_parser.add_argument("--repeat", type=int, default=5, help="启动次数")
+    arg_parser.add_argument("--timeout", type=float, default=30, help="单次启动的超时秒数")
+    arg_parser.add_argument("--importtime", action="store_true", help="同时列出导入耗时最多的模块")
+    args = arg_parser.parse_args()
+
+    workdir = os.path.join(tempfile.mkdtemp(prefix="lmarena-startup-"), "repo")
+    shutil.copytree(ROOT, workdir, ignore=_IGNORED)
+    try:
+        # 第一次启动会编译 .pyc，不计入结果
+        measure_once(workdir, args.timeout)
+        results = [measure_once(workdir, args.timeout) for _ in range(args.repeat)]
+        baseline = interpreter_baseline(args.repeat)
+
+        accepted = [r[0] for r in results]
+        responded = [r[1] for r in results]
+        print(f"Python 解释器启动 (python -c pass): {baseline * 1000:.0f} ms")
+        print(f"{'阶段':<24}{'最快 (ms)':>12}{'中位数 (ms)':>14}")
+        print(f"{'开始接受连接':<24}{min(accepted) * 1000:>12.0f}{statistics.median(accepted) * 1000:>14.0f}")
+        print(f"{'GET /v1/models 返回':<24}{min(responded) * 1000:>12.0f}{statistics.median(responded) * 1000:>14.0f}")
+        if args.importtime:
+            print_importtime(workdir)
+    finally:
+        shutil.rmtree(os.path.dirname(workdir), ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+# benchmarks/bench_stream_parser.py
+# 对比旧版「整块缓冲 + 正则反复扫描」的解析循环与新的增量行解析器。
+#
+# 用法 (在项目根目录运行):
+#   python benchmarks/bench_stream_parser.py
+#   python benchmarks/bench_stream_parser.py --size-mb 8 --repeat 5
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules import stream_parser
+
+
+def legacy_parse(chunks):
+    """改写自旧版 _process_lmarena_stream 的同步解析循环，用作对照组。"""
+    events = []
+    buffer = ""
+    text_pattern = re.compile(r'[ab]0:"((?:\\.|[^"\\])*)"')
+    finish_pattern = re.compile(r'[ab]d:(\{.*?"finishReason".*?\})')
+    error_pattern = re.compile(r'(\{\s*"error".*?\})', re.DOTALL)
+    cloudflare_patterns = [r'<title>Just a moment...</title>', r'Enable JavaScript and cookies to continue']
+
+    for chunk in chunks:
+        buffer += chunk
+        if any(re.search(p, buffer, re.IGNORECASE) for p in cloudflare_patterns):
+            events.append(('error', 'cloudflare'))
+            return events
+        if (error_match := error_pattern.search(buffer)):
+            try:
+                error_json = json.loads(error_match.group(1))
+                events.append(('error', error_json.get("error", "来自 LMArena 的未知错误")))
+                return events
+            except json.JSONDecodeError:
+                pass
+        while (match := text_pattern.search(buffer)):
+            try:
+                text_content = json.loads(f'"{match.group(1)}"')
+                if text_content:
+                    events.append(('content', text_content))
+            except (ValueError, json.JSONDecodeError):
+                pass
+            buffer = buffer[match.end():]
+        if (finish_match := finish_pattern.search(buffer)):
+            try:
+                finish_data = json.loads(finish_match.group(1))
+                events.append(('finish', finish_data.get("finishReason", "stop")))
+            except (json.JSONDecodeError, IndexError):
+                pass
+            buffer = buffer[finish_match.end():]
+    return events
+
+
+def incremental_parse(chunks):
+    """使用 LMArenaStreamParser，并把事件映射为与 legacy_parse 相同的形式。"""
+    events = []
+    parser = stream_parser.LMArenaStreamParser()
+    names = {stream_parser.TEXT: 'content', stream_parser.FINISH: 'finish', stream_parser.ERROR: 'error'}
+    for chunk in chunks:
+        for event_type, value in parser.feed(chunk):
+            if event_type == stream_parser.CLOUDFLARE:
+                events.append(('error', 'cloudflare'))
+                return events
+            events.append((names[event_type], value))
+            if event_type == stream_parser.ERROR:
+                return events
+    events.extend((names[t], v) for t, v in parser.close())
+    return events
+
+
+def build_stream(size_bytes, reasoning_ratio, noise_every, rng):
+    """生成一个合成的 LMArena 响应流：可选的推理行 (ag:)、文本行 (a0:) 和其他前缀的噪声行。"""
+    words = ["Hello", " world", "，你好", " \"quoted\"", "\\n", " 🚀", " lorem", " ipsum", "\n"]
+    lines = []
+    total = 0
+    reasoning_budget = int(size_bytes * reasoning_ratio)
+    while total < reasoning_budget:
+        line = "ag:" + json.dumps(rng.choice(words), ensure_ascii=False) + "\n"
+        lines.append(line)
+        total += len(line)
+    i = 0
+    while total < size_bytes:
+        line = "a0:" + json.dumps(rng.choice(words), ensure_ascii=False) + "\n"
+        lines.append(line)
+        total += len(line)
+        i += 1
+        if noise_every and i % noise_every == 0:
+            noise = 'a8:[{"type":"metadata","step":%d}]\n' % i
+            lines.append(noise)
+            total += len(noise)
+    # 注意：旧版正则 `\{.*?"finishReason".*?\}` 遇到嵌套对象 (如 usage) 会截断并丢失结束原因，
+    # 为了能对比两者的输出，这里使用不含嵌套对象的结束行。
+    lines.append('ad:{"finishReason":"stop"}\n')
+    return "".join(lines)
+
+
+def split_chunks(stream, rng, min_size=64, max_size=4096):
+    chunks = []
+    pos = 0
+    while pos < len(stream):
+        size = rng.randint(min_size, max_size)
+        chunks.append(stream[pos:pos + size])
+        pos += size
+    return chunks
+
+
+def timed(fn, chunks, repeat):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(chunks)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="LMArena 流解析器基准测试")
+    arg_parser.add_argument("--size-mb", type=float, default=4.0, help="每个场景的流大小 (MB)")
+    arg_parser.add_argument("--repeat", type=int, default=3, help="每个解析器的重复次数，取最快一次")
+    arg_parser.add_argument("--seed", type=int, default=1234)
+    args = arg_parser.parse_args()
+
+    size = int(args.size_mb * 1024 * 1024)
+    scenarios = [
+        ("纯文本流", 0.0, 0),
+        ("夹杂其他前缀的文本流", 0.0, 8),
+        ("推理模型 (前 25% 为 ag: 行)", 0.25, 0),
+    ]
+
+    print(f"{'场景':<28}{'旧版正则 (s)':>14}{'增量解析 (s)':>14}{'加速比':>10}{'MB/s (新)':>12}  结果一致")
+    for name, reasoning_ratio, noise_every in scenarios:
+        rng = random.Random(args.seed)
+        stream = build_stream(size, reasoning_ratio, noise_every, rng)
+        chunks = split_chunks(stream, rng)
+        legacy_time, legacy_events = timed(legacy_parse, chunks, args.repeat)
+        new_time, new_events = timed(incremental_parse, chunks, args.repeat)
+        mb = len(stream.encode('utf-8')) / (1024 * 1024)
+        same = "✅" if legacy_events == new_events else "❌"
+        print(f"{name:<28}{legacy_time:>14.3f}{new_time:>14.3f}{legacy_time / new_time:>9.1f}x{mb / new_time:>12.1f}  {same}")
+
+
+if __name__ == "__main__":
+    main()
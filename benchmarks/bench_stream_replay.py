@@ -0,0 +1,148 @@
+# benchmarks/bench_stream_replay.py
+# 用录制的真实 LMArena 流量（见 config.jsonc 中的 stream_recording_dir）回放并检验流处理器：
+# 聊天记录经过 api_server._process_lmarena_stream，文生图记录经过 image_generation._process_image_stream，
+# 报告吞吐量 (MB/s, events/s)，并检查输出是否一致：
+#   - 分块无关性：把每条记录的全部数据块合并为一个数据块后，输出的事件应与原始分块时完全相同；
+#   - 基线对比：--save-baseline 保存每条记录的输出摘要，修改解析器后用 --baseline 对比。
+#
+# 用法 (在项目根目录运行):
+#   python benchmarks/bench_stream_replay.py --corpus recordings/
+#   python benchmarks/bench_stream_replay.py --corpus recordings/ --save-baseline baseline.json
+#   python benchmarks/bench_stream_replay.py --corpus recordings/ --baseline baseline.json --repeat 5
+#
+# 未完成的记录（客户端中途断开，浏览器没有发出 [DONE]）回放时会在末尾补上 [DONE]。
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+logging.disable(logging.WARNING) # 回放时不输出处理器的日志
+
+import api_server
+from modules import image_generation
+from modules.stream_recorder import load_corpus
+
+
+def frames_of(record: dict) -> list:
+    frames = [data for _, data in record["frames"]]
+    last = frames[-1] if frames else None
+    if last != "[DONE]" and not (isinstance(last, dict) and 'error' in last):
+        frames.append("[DONE]")
+    return frames
+
+
+def merged_frames(frames: list) -> list:
+    """把相邻的文本数据块合并为一个，保留错误和 [DONE] 等控制数据。"""
+    merged, text = [], []
+    for data in frames:
+        if isinstance(data, str) and data != "[DONE]":
+            text.append(data)
+        elif isinstance(data, list):
+            text.append("".join(str(item) for item in data))
+        else:
+            if text:
+                merged.append("".join(text))
+                text = []
+            merged.append(data)
+    if text:
+        merged.append("".join(text))
+    return merged
+
+
+def frame_bytes(frames: list) -> int:
+    return sum(len(data.encode('utf-8')) if isinstance(data, str) else len(json.dumps(data)) for data in frames)
+
+
+async def replay(kind: str, frames: list) -> list:
+    """把数据块放入一个新的响应通道，并收集对应处理器产生的全部事件。"""
+    request_id = str(uuid.uuid4())
+    queue = api_server.response_channels.open(request_id)
+    for data in frames:
+        queue.put_nowait(data)
+    processor = image_generation._process_image_stream if kind == "image" else api_server._process_lmarena_stream
+    return [event async for event in processor(request_id)]
+
+
+def digest(events: list) -> str:
+    return hashlib.sha256(json.dumps(events, ensure_ascii=False).encode('utf-8')).hexdigest()[:16]
+
+
+async def run(args):
+    records = [r for r in load_corpus(args.corpus) if r.get("frames")]
+    if args.kind != "all":
+        records = [r for r in records if r.get("kind") == args.kind]
+    if not records:
+        print(f"在 {args.corpus} 中没有找到可回放的记录。")
+        return
+
+    api_server.response_channels.max_queue_size = 0 # 回放时一次性放入全部数据块
+    image_generation.initialize_image_module(
+        app_logger=logging.getLogger("bench"),
+        channels=api_server.response_channels,
+        store=api_server.config_store,
+        default_model_id=None,
+        pool=api_server.browser_pool,
+        app_metrics=api_server.metrics
+    )
+
+    prepared = [(r, frames_of(r)) for r in records]
+    outputs = {}
+    print(f"{'类型':<8}{'记录数':>8}{'数据量 (MB)':>13}{'耗时 (s)':>11}{'MB/s':>10}{'events/s':>12}{'分块无关':>10}")
+    for kind in ("chat", "image"):
+        group = [(r, frames) for r, frames in prepared if r.get("kind", "chat") == kind]
+        if not group:
+            continue
+        best = float('inf')
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            results = [await replay(kind, frames) for _, frames in group]
+            best = min(best, time.perf_counter() - start)
+        events = sum(len(e) for e in results)
+        mb = sum(frame_bytes(frames) for _, frames in group) / 1048576
+
+        mismatched = 0
+        for (record, frames), result in zip(group, results):
+            outputs[record["request_id"]] = digest(result)
+            if await replay(kind, merged_frames(frames)) != result:
+                mismatched += 1
+                if args.verbose:
+                    print(f"  分块后输出不一致: {record['request_id']}")
+        same = "✅" if not mismatched else f"❌ {mismatched}"
+        print(f"{kind:<8}{len(group):>8}{mb:>13.2f}{best:>11.3f}{mb / best:>10.1f}{events / best:>12.0f}{same:>10}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(outputs, f, indent=2)
+        print(f"\n已保存 {len(outputs)} 条记录的输出摘要到 {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        common = [rid for rid in outputs if rid in baseline]
+        changed = [rid for rid in common if outputs[rid] != baseline[rid]]
+        print(f"\n与基线对比: {len(common)} 条共同记录，{len(changed)} 条输出不同 {'✅' if not changed else '❌'}")
+        for rid in changed[:10]:
+            print(f"  {rid}")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="用录制的真实流量回放流处理器")
+    arg_parser.add_argument("--corpus", required=True, help="语料文件或目录 (stream_recording_dir)")
+    arg_parser.add_argument("--kind", choices=("all", "chat", "image"), default="all", help="只回放某一类记录")
+    arg_parser.add_argument("--repeat", type=int, default=3, help="重复次数，取最快一次")
+    arg_parser.add_argument("--save-baseline", help="保存每条记录的输出摘要")
+    arg_parser.add_argument("--baseline", help="与之前保存的输出摘要对比")
+    arg_parser.add_argument("--verbose", action="store_true", help="列出输出不一致的记录")
+    args = arg_parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
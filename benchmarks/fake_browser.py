@@ -0,0 +1,194 @@
+# benchmarks/fake_browser.py
+# 油猴脚本的本地替身：不需要真实的 LMArena 标签页即可对 api_server.py 做压力测试。
+#
+# 它像油猴脚本一样连接到 /ws（可以同时模拟多个标签页），收到载荷后回放合成的 LMArena 响应流
+# (a0:"..." / ad:{...finishReason...} / a2:[图片])，也可以按比例注入上游错误、Cloudflare 验证页面
+# 和内容审查终止。首字延迟和生成速度可配置，收到 abort 指令时立即停止对应的回放。完全离线运行。
+#
+# 用法 (在项目根目录运行，先启动 api_server.py):
+#   python benchmarks/fake_browser.py
+#   python benchmarks/fake_browser.py --tabs 4 --ttfb-ms 300 --tokens-per-sec 80 --tokens 200
+#   python benchmarks/fake_browser.py --binary --error-rate 0.05 --cloudflare-rate 0.01
+#   python benchmarks/fake_browser.py --corpus recordings/ --time-scale 0.5
+#
+# 指定 --corpus 时，按原始时间间隔（乘以 --time-scale）轮流回放录制的真实流（见 stream_recording_dir），
+# 此时 --ttfb-ms / --tokens 等合成流选项不生效。
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules import ws_protocol
+from modules.stream_recorder import load_corpus
+
+VOCABULARY = ["Hello", " world", "，你好", " \"quoted\"", "\n", " 🚀", " lorem", " ipsum", " dolor", "的", " `code`"]
+CLOUDFLARE_PAGE = "<!DOCTYPE html><html><head><title>Just a moment...</title></head>" \
+                  "<body>Enable JavaScript and cookies to continue</body></html>"
+
+
+def build_scenario(args, rng: random.Random) -> str:
+    """按配置的比例为一个请求抽取场景。"""
+    roll = rng.random()
+    for name, rate in (("error", args.error_rate), ("cloudflare", args.cloudflare_rate),
+                       ("content_filter", args.content_filter_rate)):
+        if roll < rate:
+            return name
+        roll -= rate
+    return "ok"
+
+
+class FakeTab:
+    """一个模拟的标签页（一个 WebSocket 连接）。"""
+
+    def __init__(self, tab_id: int, args, corpus: dict | None = None):
+        self.tab_id = tab_id
+        self.args = args
+        self.corpus = corpus
+        self.rng = random.Random(args.seed + tab_id)
+        self.protocol = ws_protocol.PROTOCOL_JSON
+        self.ws = None
+        self.active: dict[str, asyncio.Task] = {}
+        self.served = 0
+
+    async def send_records(self, records: list):
+        """发送 (request_id, data) 记录：二进制协议时打包为一帧，否则逐条发送 JSON 文本帧。"""
+        if self.protocol == ws_protocol.PROTOCOL_BINARY:
+            await self.ws.send_bytes(ws_protocol.encode_frame(records))
+        else:
+            for request_id, data in records:
+                await self.ws.send_str(json.dumps({"request_id": request_id, "data": data}, ensure_ascii=False))
+
+    async def replay_recorded(self, request_id: str, payload: dict):
+        """按原始时间间隔回放一条录制的流（聊天 / 文生图轮流取用对应类型的记录）。"""
+        records = self.corpus.get("image" if payload.get("is_image_request") else "chat") or self.corpus["all"]
+        record = records[self.served % len(records)]
+        elapsed = 0.0
+        for offset_ms, data in record["frames"]:
+            delay = offset_ms * self.args.time_scale / 1000 - elapsed
+            if delay > 0:
+                await asyncio.sleep(delay)
+                elapsed += delay
+            await self.send_records([(request_id, data)])
+        last = record["frames"][-1][1]
+        if last != "[DONE]" and not (isinstance(last, dict) and 'error' in last):
+            await self.send_records([(request_id, "[DONE]")])
+
+    async def replay(self, request_id: str, payload: dict):
+        args = self.args
+        try:
+            if self.corpus:
+                await self.replay_recorded(request_id, payload)
+                return
+            await asyncio.sleep(max(0.0, self.rng.gauss(args.ttfb_ms, args.ttfb_ms * args.jitter)) / 1000)
+            scenario = build_scenario(args, self.rng)
+            if scenario == "error":
+                await self.send_records([(request_id, {"error": "Upstream error: 500 Internal Server Error"})])
+                return
+            if scenario == "cloudflare":
+                await self.send_records([(request_id, {"error": CLOUDFLARE_PAGE})])
+                return
+
+            if payload.get("is_image_request"):
+                image = [{"type": "image", "image": f"https://example.invalid/{request_id}.png"}]
+                lines = [f"a2:{json.dumps(image)}\n", 'ad:{"finishReason":"stop"}\n']
+                await self.send_records([(request_id, line) for line in lines] + [(request_id, "[DONE]")])
+                return
+
+            interval = 1 / args.tokens_per_sec if args.tokens_per_sec > 0 else 0
+            batch = max(1, args.tokens_per_frame)
+            for start in range(0, args.tokens, batch):
+                count = min(batch, args.tokens - start)
+                tokens = [self.rng.choice(VOCABULARY) for _ in range(count)]
+                await self.send_records([(request_id, "".join(f"a0:{json.dumps(t, ensure_ascii=False)}\n" for t in tokens))])
+                if interval:
+                    await asyncio.sleep(interval * count)
+            reason = "content-filter" if scenario == "content_filter" else "stop"
+            await self.send_records([(request_id, 'ad:{"finishReason":"%s"}\n' % reason), (request_id, "[DONE]")])
+        except asyncio.CancelledError:
+            pass
+        except ConnectionError:
+            pass
+        finally:
+            self.active.pop(request_id, None)
+            self.served += 1
+
+    async def handle(self, message: dict):
+        command = message.get("command")
+        if command == "protocol":
+            self.protocol = message.get("protocol", ws_protocol.PROTOCOL_JSON)
+        elif command == "abort":
+            task = self.active.get(message.get("request_id"))
+            if task:
+                task.cancel()
+        elif command:
+            return # refresh / activate_id_capture 等指令与压测无关
+        elif "request_id" in message and "payload" in message:
+            request_id = message["request_id"]
+            self.active[request_id] = asyncio.create_task(self.replay(request_id, message["payload"]))
+
+    async def run(self, session: aiohttp.ClientSession):
+        async with session.ws_connect(self.args.url, max_msg_size=0) as ws:
+            self.ws = ws
+            protocols = [ws_protocol.PROTOCOL_BINARY, ws_protocol.PROTOCOL_JSON] if self.args.binary else [ws_protocol.PROTOCOL_JSON]
+            await ws.send_str(json.dumps({"command": "hello", "protocols": protocols, "features": []}))
+            print(f"[标签页 #{self.tab_id}] 已连接 {self.args.url}")
+            async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    await self.handle(json.loads(msg.data))
+                elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                    break
+        for task in list(self.active.values()):
+            task.cancel()
+
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="模拟油猴脚本的本地压测客户端")
+    parser.add_argument("--url", default="ws://127.0.0.1:5102/ws", help="api_server 的 WebSocket 地址")
+    parser.add_argument("--tabs", type=int, default=1, help="同时模拟的标签页数量")
+    parser.add_argument("--binary", action="store_true", help="声明支持二进制批量帧协议 (lmab1)")
+    parser.add_argument("--ttfb-ms", type=float, default=200, help="首字延迟的平均值（毫秒）")
+    parser.add_argument("--jitter", type=float, default=0.2, help="首字延迟的相对标准差")
+    parser.add_argument("--tokens", type=int, default=100, help="每个响应的 token 数")
+    parser.add_argument("--tokens-per-sec", type=float, default=50, help="生成速度，0 表示不限速")
+    parser.add_argument("--tokens-per-frame", type=int, default=1, help="每个数据块包含的 token 数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="上游错误的比例")
+    parser.add_argument("--cloudflare-rate", type=float, default=0.0, help="Cloudflare 验证页面的比例")
+    parser.add_argument("--content-filter-rate", type=float, default=0.0, help="内容审查终止的比例")
+    parser.add_argument("--corpus", help="回放录制的语料文件或目录，而不是合成流")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="回放语料时的时间缩放，0 表示不等待")
+    parser.add_argument("--seed", type=int, default=1234)
+    return parser
+
+
+async def run_tabs(args):
+    async with aiohttp.ClientSession() as session:
+        corpus = None
+        if args.corpus:
+            records = [r for r in load_corpus(args.corpus) if r.get("frames")]
+            if not records:
+                raise SystemExit(f"在 {args.corpus} 中没有找到可回放的记录。")
+            corpus = {"all": records}
+            for record in records:
+                corpus.setdefault(record.get("kind", "chat"), []).append(record)
+            print(f"已加载 {len(records)} 条录制的流。")
+        tabs = [FakeTab(i + 1, args, corpus) for i in range(args.tabs)]
+        await asyncio.gather(*(tab.run(session) for tab in tabs))
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    try:
+        asyncio.run(run_tabs(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
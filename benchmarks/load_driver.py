@@ -0,0 +1,184 @@
+# benchmarks/load_driver.py
+# 端到端 HTTP 压测：以固定并发向 api_server.py 发送 /v1/chat/completions（流式 / 非流式）
+# 和 /v1/images/generations 请求，报告吞吐量、首字延迟 (TTFT) 与总耗时的 p50 / p90 / p99。
+#
+# 配合 benchmarks/fake_browser.py 使用即可完全离线地测量桥接服务本身的开销：
+#   终端 1: python api_server.py
+#   终端 2: python benchmarks/fake_browser.py --tabs 4 --tokens-per-sec 0
+#   终端 3: python benchmarks/load_driver.py
+#
+# 用法 (在项目根目录运行):
+#   python benchmarks/load_driver.py --concurrency 32 --requests 1000
+#   python benchmarks/load_driver.py --mode nonstream --duration 30
+#   python benchmarks/load_driver.py --mode mix --json > result.json
+#
+# 默认每个请求的提示词都不相同，避免被响应缓存或相同请求合并 (single-flight) 吸收；
+# 加上 --identical 可以专门测量这两种路径。
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from collections import Counter
+
+import aiohttp
+
+STREAM_ERROR_MARKER = "[LMArena Bridge Error]"
+
+
+def percentile(values: list, p: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class Result:
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.status = None
+        self.ttft = None
+        self.latency = None
+        self.chunks = 0
+
+
+async def run_chat(session, args, stream: bool, prompt: str) -> Result:
+    result = Result("stream" if stream else "nonstream")
+    body = {"model": args.model, "stream": stream, "messages": [{"role": "user", "content": prompt}]}
+    start = time.perf_counter()
+    async with session.post(f"{args.base}/v1/chat/completions", json=body) as resp:
+        result.status = resp.status
+        if stream and resp.status == 200:
+            async for line in resp.content:
+                if not line.startswith(b"data: ") or line.startswith(b"data: [DONE]"):
+                    continue
+                chunk = json.loads(line[6:])
+                content = chunk["choices"][0].get("delta", {}).get("content") if chunk.get("choices") else None
+                if content and STREAM_ERROR_MARKER in content:
+                    # 流式响应中的错误以内容块的形式返回 (见 ChunkEncoder.error)
+                    result.status = "stream_error"
+                elif content:
+                    if result.ttft is None:
+                        result.ttft = time.perf_counter() - start
+                    result.chunks += 1
+        else:
+            await resp.read()
+            result.ttft = time.perf_counter() - start
+    result.latency = time.perf_counter() - start
+    return result
+
+
+async def run_image(session, args, prompt: str) -> Result:
+    result = Result("image")
+    body = {"model": args.image_model, "prompt": prompt, "n": 1}
+    start = time.perf_counter()
+    async with session.post(f"{args.base}/v1/images/generations", json=body) as resp:
+        result.status = resp.status
+        await resp.read()
+    result.latency = result.ttft = time.perf_counter() - start
+    return result
+
+
+async def worker(session, args, rng: random.Random, deadline: float, counter: list, results: list):
+    while True:
+        if args.duration:
+            if time.perf_counter() >= deadline:
+                return
+        elif counter[0] >= args.requests:
+            return
+        counter[0] += 1
+        mode = rng.choice(("stream", "nonstream", "image")) if args.mode == "mix" else args.mode
+        prompt = "load test" if args.identical else f"load test {uuid.uuid4()}"
+        try:
+            if mode == "image":
+                result = await run_image(session, args, prompt)
+            else:
+                result = await run_chat(session, args, mode == "stream", prompt)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            result = Result(mode)
+            result.status = type(e).__name__
+        results.append(result)
+
+
+def summarize(results: list, elapsed: float) -> dict:
+    summary = {"elapsed_s": round(elapsed, 3), "requests": len(results),
+               "throughput_rps": round(len(results) / elapsed, 2) if elapsed else None, "by_kind": {}}
+    for kind in sorted({r.kind for r in results}):
+        group = [r for r in results if r.kind == kind]
+        ok = [r for r in group if r.status == 200]
+        ttft = [r.ttft for r in ok if r.ttft is not None]
+        latency = [r.latency for r in ok]
+        summary["by_kind"][kind] = {
+            "requests": len(group),
+            "status": dict(Counter(str(r.status) for r in group)),
+            "chunks": sum(r.chunks for r in ok),
+            **{f"ttft_p{p}_ms": round(percentile(ttft, p) * 1000, 1) if ttft else None for p in (50, 90, 99)},
+            **{f"latency_p{p}_ms": round(percentile(latency, p) * 1000, 1) if latency else None for p in (50, 90, 99)},
+        }
+    return summary
+
+
+def print_summary(summary: dict):
+    print(f"\n总请求数: {summary['requests']}    耗时: {summary['elapsed_s']:.2f} s    "
+          f"吞吐量: {summary['throughput_rps']} req/s")
+    header = f"{'类型':<10}{'请求数':>8}{'TTFT p50':>10}{'p90':>9}{'p99':>9}{'耗时 p50':>10}{'p90':>9}{'p99':>9}   状态码"
+    print(header)
+    print("-" * (len(header) + 10))
+
+    def fmt(value):
+        return "-" if value is None else f"{value:.0f}"
+
+    for kind, s in summary["by_kind"].items():
+        print(f"{kind:<10}{s['requests']:>8}{fmt(s['ttft_p50_ms']):>10}{fmt(s['ttft_p90_ms']):>9}{fmt(s['ttft_p99_ms']):>9}"
+              f"{fmt(s['latency_p50_ms']):>10}{fmt(s['latency_p90_ms']):>9}{fmt(s['latency_p99_ms']):>9}   {s['status']}")
+    print("(时间单位: 毫秒；延迟只统计状态码为 200 的请求)")
+
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="api_server 端到端 HTTP 压测")
+    parser.add_argument("--base", default="http://127.0.0.1:5102", help="api_server 的地址")
+    parser.add_argument("--api-key", default="", help="config.jsonc 中设置了 api_key 时使用")
+    parser.add_argument("--mode", choices=("stream", "nonstream", "image", "mix"), default="stream", help="请求类型")
+    parser.add_argument("--model", default="gemini-2.0-flash-001", help="聊天请求使用的模型")
+    parser.add_argument("--image-model", default="dall-e-3", help="文生图请求使用的模型")
+    parser.add_argument("--concurrency", type=int, default=16, help="并发请求数")
+    parser.add_argument("--requests", type=int, default=200, help="请求总数（未指定 --duration 时）")
+    parser.add_argument("--duration", type=float, default=0, help="持续压测的秒数，优先于 --requests")
+    parser.add_argument("--timeout", type=float, default=300, help="单个请求的超时时间（秒）")
+    parser.add_argument("--identical", action="store_true", help="所有请求使用相同的提示词")
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    parser.add_argument("--seed", type=int, default=42)
+    return parser
+
+
+async def run(args) -> dict:
+    headers = {"Authorization": f"Bearer {args.api_key}"} if args.api_key else {}
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    results: list[Result] = []
+    counter = [0]
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers) as session:
+        start = time.perf_counter()
+        deadline = start + args.duration
+        await asyncio.gather(*(
+            worker(session, args, random.Random(args.seed + i), deadline, counter, results)
+            for i in range(args.concurrency)
+        ))
+        elapsed = time.perf_counter() - start
+    return summarize(results, elapsed)
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    summary = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+    else:
+        print_summary(summary)
+
+
+if __name__ == "__main__":
+    main()
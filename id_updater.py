@@ -12,6 +12,8 @@ import threading
 import os
 import requests
 
+from modules.state_store import update_jsonc_values
+
 # --- 配置 ---
 HOST = "127.0.0.1"
 PORT = 5103
@@ -32,37 +34,29 @@ def read_config():
         print(f"❌ 读取或解析 '{CONFIG_PATH}' 时发生错误: {e}")
         return None
 
-def save_config_value(key, value):
+def save_config_values(values):
     """
-    安全地更新 config.jsonc 中的单个键值对，保留原始格式和注释。
-    仅适用于值为字符串或数字的情况。
+    安全地更新 config.jsonc 中的若干个键值对，保留原始格式和注释。
+    所有修改一次性写入：先写临时文件再原子替换，正在运行的服务器不会读到写了一半的文件。
     """
     try:
-        with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
-            content = f.read()
-
-        # 使用正则表达式安全地替换值
-        # 它会查找 "key": "any value" 并替换 "any value"
-        pattern = re.compile(rf'("{key}"\s*:\s*")[^"]*(")')
-        new_content, count = pattern.subn(rf'\g<1>{value}\g<2>', content, 1)
-
-        if count == 0:
-            print(f"🤔 警告: 未能在 '{CONFIG_PATH}' 中找到键 '{key}'。")
-            return False
-
-        with open(CONFIG_PATH, 'w', encoding='utf-8') as f:
-            f.write(new_content)
+        update_jsonc_values(CONFIG_PATH, values, add_missing=False)
         return True
+    except KeyError as e:
+        print(f"🤔 警告: 未能在 '{CONFIG_PATH}' 中找到键 {e}。")
+        return False
     except Exception as e:
         print(f"❌ 更新 '{CONFIG_PATH}' 时发生错误: {e}")
         return False
 
+def save_config_value(key, value):
+    """更新 config.jsonc 中的单个键值对。"""
+    return save_config_values({key: value})
+
 def save_session_ids(session_id, message_id):
     """将新的会话ID更新到 config.jsonc 文件。"""
     print(f"\n📝 正在尝试将ID写入 '{CONFIG_PATH}'...")
-    res1 = save_config_value("session_id", session_id)
-    res2 = save_config_value("message_id", message_id)
-    if res1 and res2:
+    if save_config_values({"session_id": session_id, "message_id": message_id}):
         print(f"✅ 成功更新ID。")
         print(f"   - session_id: {session_id}")
         print(f"   - message_id: {message_id}")
@@ -0,0 +1,217 @@
+# modules/attachment_cache.py
+# 按内容寻址的附件缓存。
+#
+# 客户端每一轮都会重新发送完整的对话历史，其中的 base64 图片每次都要通过 WebSocket
+# 再传给油猴脚本一遍。这里按内容哈希记录附件：
+#   - AttachmentCache 在服务器端保存附件内容（内存 LRU，可选地溢出到磁盘），
+#     用于在油猴脚本缓存未命中时补发完整内容。
+#   - BrowserAttachmentIndex 记录某个标签页的油猴脚本缓存中应当已有哪些附件，
+#     与油猴脚本使用相同的容量上限和 LRU 顺序。
+# 对于标签页已有的附件，compact_attachments 只发送 {"ref": 哈希}；
+# 第一次出现的附件则带上 {"hash": 哈希}，让油猴脚本把它存入自己的缓存。
+
+import asyncio
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+
+from modules.request_ingest import SpooledData
+
+logger = logging.getLogger(__name__)
+
+
+def attachment_hash(url: str) -> str:
+    """计算附件 data URI 的内容哈希。"""
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+class AttachmentCache:
+    """服务器端的附件内容缓存：哈希 -> data URI。所有方法都应在主事件循环中调用。"""
+
+    def __init__(self, max_memory_bytes: int = 256 << 20, disk_dir: str | None = None,
+                 max_disk_bytes: int = 1 << 30):
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_dir = disk_dir or None
+        self._memory: OrderedDict[str, str] = OrderedDict()
+        self._memory_bytes = 0
+        self._disk: OrderedDict[str, int] = OrderedDict() # 哈希 -> 文件大小，按最近使用排序
+        self._disk_bytes = 0
+        if self.disk_dir:
+            self._load_disk_index()
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.disk_dir, f"{digest}.txt")
+
+    def _load_disk_index(self):
+        os.makedirs(self.disk_dir, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            if not name.endswith(".txt"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.disk_dir, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, name[:-4], st.st_size))
+        for _mtime, digest, size in sorted(entries):
+            self._disk[digest] = size
+            self._disk_bytes += size
+        if entries:
+            logger.info(f"附件磁盘缓存: 已索引 {len(entries)} 个文件 ({self._disk_bytes / 1048576:.1f} MB)。")
+
+    def put(self, url: str, digest: str | None = None) -> str:
+        """保存附件并返回其哈希。超出内存上限时，最久未使用的附件会被移到磁盘（如果启用）。"""
+        digest = digest or attachment_hash(url)
+        if digest in self._memory:
+            self._memory.move_to_end(digest)
+            return digest
+        self._memory[digest] = url
+        self._memory_bytes += len(url)
+        while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+            old_digest, old_url = self._memory.popitem(last=False)
+            self._memory_bytes -= len(old_url)
+            if self.disk_dir and old_digest not in self._disk:
+                self._spill(old_digest, old_url)
+        return digest
+
+    def _reserve_disk(self, digest: str, size: int) -> list[str]:
+        """在磁盘索引中登记一个附件，返回因超出磁盘上限而需要删除的旧附件。"""
+        self._disk[digest] = size
+        self._disk_bytes += size
+        doomed = []
+        while self._disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+            old_digest, old_size = self._disk.popitem(last=False)
+            self._disk_bytes -= old_size
+            doomed.append(old_digest)
+        return doomed
+
+    def _spill(self, digest: str, url: str):
+        """在线程池中把被逐出内存的附件写入磁盘，不阻塞事件循环。"""
+        doomed = self._reserve_disk(digest, len(url))
+        try:
+            asyncio.get_running_loop().run_in_executor(None, self._write_disk, digest, [url], doomed)
+        except RuntimeError:
+            self._write_disk(digest, [url], doomed)
+
+    async def put_spooled(self, data: SpooledData):
+        """
+        保存一个已暂存到临时文件的附件。启用磁盘缓存时直接分块复制到磁盘，
+        不经过内存；否则在线程中读入内存缓存。
+        """
+        digest = data.digest
+        if digest in self._memory:
+            self._memory.move_to_end(digest)
+            return
+        if self.disk_dir:
+            if digest in self._disk:
+                self._disk.move_to_end(digest)
+                return
+            doomed = self._reserve_disk(digest, data.size)
+            await asyncio.to_thread(self._write_disk, digest, data.iter_text(1 << 20), doomed)
+            return
+        self.put(await asyncio.to_thread(data.read_text), digest)
+
+    def _write_disk(self, digest: str, parts, doomed: list[str]):
+        try:
+            tmp_path = self._path(digest) + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for part in parts:
+                    f.write(part)
+            os.replace(tmp_path, self._path(digest))
+        except OSError as e:
+            logger.warning(f"附件磁盘缓存写入失败: {e}")
+        for old_digest in doomed:
+            try:
+                os.remove(self._path(old_digest))
+            except OSError:
+                pass
+
+    def _read_disk(self, digest: str) -> str | None:
+        try:
+            with open(self._path(digest), 'r', encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    async def get(self, digest: str) -> str | None:
+        """按哈希取回附件内容，依次查找内存和磁盘。"""
+        url = self._memory.get(digest)
+        if url is not None:
+            self._memory.move_to_end(digest)
+            return url
+        if self.disk_dir and digest in self._disk:
+            url = await asyncio.to_thread(self._read_disk, digest)
+            if url is not None:
+                self._disk.move_to_end(digest)
+                self.put(url, digest)
+            return url
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "memory_items": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "disk_items": len(self._disk),
+            "disk_bytes": self._disk_bytes,
+        }
+
+
+class BrowserAttachmentIndex:
+    """记录一个油猴脚本的附件缓存中（应当）已有的附件：与脚本相同的字节上限和 LRU 顺序。"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._bytes = 0
+
+    def __contains__(self, digest: str) -> bool:
+        return digest in self._entries
+
+    def touch(self, digest: str, size: int):
+        """记录一次存入或命中，并按与油猴脚本相同的规则淘汰最久未使用的条目。"""
+        if digest in self._entries:
+            self._entries.move_to_end(digest)
+            return
+        self._entries[digest] = size
+        self._bytes += size
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            _, old_size = self._entries.popitem(last=False)
+            self._bytes -= old_size
+
+    def discard(self, digest: str):
+        size = self._entries.pop(digest, None)
+        if size is not None:
+            self._bytes -= size
+
+
+def compact_attachments(message_templates: list[dict], cache: AttachmentCache,
+                        index: BrowserAttachmentIndex, min_bytes: int = 0) -> tuple[int, int]:
+    """
+    就地改写消息模板中的附件：标签页已缓存的附件替换为引用，其余的附件标记哈希。
+    小于 min_bytes 的附件保持原样。暂存的附件 (SpooledData) 应当已经通过
+    cache.put_spooled 保存。返回 (被替换为引用的附件数, 节省的字节数)。
+    """
+    refs, saved = 0, 0
+    for template in message_templates:
+        for attachment in template.get("attachments") or ():
+            url = attachment.get("url")
+            if isinstance(url, SpooledData):
+                digest, size = url.digest, url.size
+            elif isinstance(url, str):
+                digest, size = None, len(url)
+            else:
+                continue
+            if size < min_bytes:
+                continue
+            digest = digest or cache.put(url)
+            if digest in index:
+                del attachment["url"]
+                attachment["ref"] = digest
+                refs += 1
+                saved += size
+            else:
+                attachment["hash"] = digest
+            index.touch(digest, size)
+    return refs, saved
@@ -0,0 +1,124 @@
+# modules/browser_pool.py
+# 浏览器标签页工作池：管理多个并发的油猴脚本 WebSocket 连接，
+# 跟踪每个连接上正在处理的请求，并把新请求分发给负载最低的健康标签页。
+
+import itertools
+import json
+import logging
+import time
+
+from fastapi import WebSocket
+
+logger = logging.getLogger(__name__)
+
+
+class BrowserWorker:
+    """代表一个已连接的 LMArena 标签页（一个油猴脚本 WebSocket 连接）。"""
+
+    def __init__(self, worker_id: int, websocket: WebSocket):
+        self.worker_id = worker_id
+        self.websocket = websocket
+        self.in_flight: set[str] = set() # 当前分配给此标签页的 request_id
+        self.connected_at = time.time()
+        self.last_assigned = 0 # 最近一次分配请求的序号，用于负载相同时轮询
+        self.healthy = True # 发送失败后标记为不健康，不再接收新请求
+        self.protocol = "json" # 与油猴脚本协商的上行协议 ("json" 或 "lmab1")
+        self.features: set[str] = set() # 油猴脚本在 hello 消息中声明支持的可选功能
+        self.attachments = None # 该标签页的附件缓存索引 (BrowserAttachmentIndex)，油猴脚本支持附件引用时才会设置
+
+    @property
+    def load(self) -> int:
+        return len(self.in_flight)
+
+    def is_healthy(self) -> bool:
+        return self.healthy and self.websocket.client_state.name == 'CONNECTED'
+
+    async def send_text(self, text: str):
+        """通过此标签页的 WebSocket 发送文本；失败时将其标记为不健康。"""
+        try:
+            await self.websocket.send_text(text)
+        except Exception:
+            self.healthy = False
+            raise
+
+    async def send_command(self, command: str, **fields):
+        """向油猴脚本发送一条指令消息。"""
+        await self.send_text(json.dumps({"command": command, **fields}, ensure_ascii=False))
+
+    def __repr__(self):
+        return f"<BrowserWorker #{self.worker_id} load={self.load}>"
+
+
+class BrowserPool:
+    """油猴脚本连接注册表。所有方法都应在主事件循环中调用。"""
+
+    def __init__(self):
+        self._workers: dict[int, BrowserWorker] = {}
+        self._owners: dict[str, BrowserWorker] = {} # request_id -> 负责该请求的标签页
+        self._worker_ids = itertools.count(1)
+        self._assign_seq = itertools.count(1)
+
+    def __len__(self):
+        return len(self._workers)
+
+    def workers(self) -> list[BrowserWorker]:
+        return list(self._workers.values())
+
+    def healthy_workers(self) -> list[BrowserWorker]:
+        return [w for w in self._workers.values() if w.is_healthy()]
+
+    def has_healthy_worker(self) -> bool:
+        return any(w.is_healthy() for w in self._workers.values())
+
+    def register(self, websocket: WebSocket) -> BrowserWorker:
+        """登记一个新连接的标签页。"""
+        worker = BrowserWorker(next(self._worker_ids), websocket)
+        self._workers[worker.worker_id] = worker
+        return worker
+
+    def unregister(self, worker: BrowserWorker) -> list[str]:
+        """
+        移除一个已断开的标签页，并返回仍由它负责的 request_id 列表，
+        以便调用方只让这些请求失败。
+        """
+        self._workers.pop(worker.worker_id, None)
+        orphaned = list(worker.in_flight)
+        for request_id in orphaned:
+            if self._owners.get(request_id) is worker:
+                del self._owners[request_id]
+        worker.in_flight.clear()
+        return orphaned
+
+    def acquire(self, request_id: str) -> BrowserWorker | None:
+        """为请求选择负载最低的健康标签页（负载相同则轮询），没有可用标签页时返回 None。"""
+        candidates = self.healthy_workers()
+        if not candidates:
+            return None
+        worker = min(candidates, key=lambda w: (w.load, w.last_assigned))
+        worker.last_assigned = next(self._assign_seq)
+        worker.in_flight.add(request_id)
+        self._owners[request_id] = worker
+        return worker
+
+    def release(self, request_id: str):
+        """请求结束后，将其从所属标签页的在途集合中移除。"""
+        worker = self._owners.pop(request_id, None)
+        if worker:
+            worker.in_flight.discard(request_id)
+
+    def owner_of(self, request_id: str) -> BrowserWorker | None:
+        return self._owners.get(request_id)
+
+    def snapshot(self) -> list[dict]:
+        """返回各标签页的状态摘要，便于日志和调试。"""
+        return [
+            {
+                "worker_id": w.worker_id,
+                "healthy": w.is_healthy(),
+                "in_flight": w.load,
+                "protocol": w.protocol,
+                "attachment_refs": w.attachments is not None,
+                "connected_at": int(w.connected_at),
+            }
+            for w in self._workers.values()
+        ]
@@ -0,0 +1,159 @@
+# modules/channels.py
+# 响应通道注册表。
+#
+# 每个发往浏览器的请求都有一个响应通道（asyncio.Queue），WebSocket 端点把浏览器发回的
+# 数据块放进去，流处理器从中读取。通道通常由流处理器在 finally 中关闭，但如果生成器
+# 从未被迭代、或者在创建通道和发送请求之间出现异常，通道就会一直留在内存中。
+# ChannelRegistry 为每个通道记录最后活动时间，由后台清理任务回收长时间没有活动的通道，
+# 队列有容量上限，并统计打开、关闭、被回收（泄漏）和溢出的通道数量，便于调试。
+
+import asyncio
+import logging
+import time
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class ClientDisconnected(Exception):
+    """
+    客户端在响应结束之前断开，内部事件流因此提前结束。
+    由事件流抛出（而不是产出 'error' 事件），使各层包装把它记为取消，而不是上游错误。
+    """
+
+
+class _Channel:
+    __slots__ = ("queue", "created_at", "last_activity", "idle_ttl")
+
+    def __init__(self, queue: asyncio.Queue, idle_ttl: float):
+        self.queue = queue
+        self.created_at = time.monotonic()
+        self.last_activity = self.created_at
+        self.idle_ttl = idle_ttl
+
+
+class ChannelRegistry:
+    """request_id -> 有界响应队列。所有方法都应在主事件循环中调用。"""
+
+    def __init__(self, max_queue_size: int = 4096, idle_ttl: float = 420.0,
+                 on_evict: Callable[[str, str], None] | None = None):
+        self.max_queue_size = max_queue_size # 每个通道最多缓存的数据块数量
+        self.idle_ttl = idle_ttl # 通道在没有任何活动多少秒后被视为泄漏并回收
+        self.on_evict = on_evict # 通道被回收或溢出后的回调 (request_id, 原因)，用于释放标签页等
+        self._channels: dict[str, _Channel] = {}
+        self.opened = 0
+        self.closed = 0
+        self.reaped = 0 # 被清理任务回收的通道（即没有被正常关闭的泄漏通道）
+        self.overflowed = 0
+        self.peak_live = 0
+
+    def __len__(self):
+        return len(self._channels)
+
+    def __contains__(self, request_id: str) -> bool:
+        return request_id in self._channels
+
+    def open(self, request_id: str, idle_ttl: float | None = None) -> asyncio.Queue:
+        """为请求创建响应通道。idle_ttl 可以覆盖默认的空闲回收时间。"""
+        queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._channels[request_id] = _Channel(queue, self.idle_ttl if idle_ttl is None else idle_ttl)
+        self.opened += 1
+        self.peak_live = max(self.peak_live, len(self._channels))
+        return queue
+
+    def get(self, request_id: str) -> asyncio.Queue | None:
+        channel = self._channels.get(request_id)
+        return channel.queue if channel else None
+
+    def touch(self, request_id: str):
+        """记录一次活动（消费者读取了数据），推迟该通道的回收时间。"""
+        channel = self._channels.get(request_id)
+        if channel:
+            channel.last_activity = time.monotonic()
+
+    def deliver(self, request_id: str, data) -> bool:
+        """
+        将浏览器发回的数据放入通道，不会阻塞（WebSocket 接收循环由同一标签页的所有请求共享）。
+        通道不存在时返回 False；通道已满时视为消费者已失去响应，关闭该通道并返回 False。
+        """
+        channel = self._channels.get(request_id)
+        if channel is None:
+            return False
+        try:
+            channel.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            self.overflowed += 1
+            self._evict(request_id, f"响应通道已满 ({self.max_queue_size} 个数据块未被读取)")
+            return False
+        channel.last_activity = time.monotonic()
+        return True
+
+    def close(self, request_id: str, reason: str | None = None, client_gone: bool = False) -> bool:
+        """
+        关闭并移除通道，可以重复调用。
+        提供 reason 时，会向仍在等待的消费者投递一个错误，使其立即结束；
+        client_gone 为 True 时投递的是 ClientDisconnected（客户端断开，不是上游错误）。
+        """
+        channel = self._channels.pop(request_id, None)
+        if channel is None:
+            return False
+        self.closed += 1
+        if reason is not None:
+            queue = channel.queue
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(ClientDisconnected(reason) if client_gone else {"error": reason})
+        return True
+
+    def _evict(self, request_id: str, reason: str):
+        if not self.close(request_id, reason):
+            return
+        logger.warning(f"CHANNELS [ID: {request_id[:8]}]: {reason}，通道已被回收。")
+        if self.on_evict:
+            try:
+                self.on_evict(request_id, reason)
+            except Exception as e:
+                logger.error(f"CHANNELS [ID: {request_id[:8]}]: 回收回调执行失败: {e}", exc_info=True)
+
+    def reap(self, now: float | None = None) -> list[str]:
+        """回收所有超过空闲时间的通道，返回被回收的 request_id 列表。"""
+        now = time.monotonic() if now is None else now
+        expired = [rid for rid, ch in self._channels.items() if now - ch.last_activity > ch.idle_ttl]
+        for request_id in expired:
+            idle = now - self._channels[request_id].last_activity
+            self.reaped += 1
+            self._evict(request_id, f"通道空闲 {idle:.0f} 秒未被关闭")
+        return expired
+
+    async def reap_forever(self, interval: float = 30.0):
+        """后台清理任务：定期回收泄漏的通道。"""
+        while True:
+            await asyncio.sleep(interval)
+            self.reap()
+
+    def queue_depths(self) -> list[int]:
+        """每个存活通道中等待读取的数据块数量。"""
+        return [ch.queue.qsize() for ch in self._channels.values()]
+
+    def stats(self) -> dict:
+        """返回计数器与当前存活通道的摘要。"""
+        now = time.monotonic()
+        return {
+            "live": len(self._channels),
+            "peak_live": self.peak_live,
+            "opened": self.opened,
+            "closed": self.closed,
+            "leaked": self.reaped,
+            "overflowed": self.overflowed,
+            "max_queue_size": self.max_queue_size,
+            "idle_ttl_seconds": self.idle_ttl,
+            "channels": [
+                {
+                    "request_id": rid,
+                    "age_seconds": round(now - ch.created_at, 1),
+                    "idle_seconds": round(now - ch.last_activity, 1),
+                    "queued": ch.queue.qsize(),
+                }
+                for rid, ch in self._channels.items()
+            ],
+        }
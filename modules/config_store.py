@@ -0,0 +1,259 @@
+# modules/config_store.py
+# 配置快照存储。
+#
+# config.jsonc、model_endpoint_map.json、models.json 和 models_metadata.json 只会在文件的修改时间（或大小）
+# 变化时才被重新解析，解析结果以不可变快照 (ConfigSnapshot) 的形式整体发布。
+# 各模块在处理请求时只需读取 store.snapshot（一次属性访问），
+# 不会再在事件循环中同步读取文件，也不会因为全局变量被重新绑定而拿到过期的配置。
+#
+# 文件的读取与解析可以在任意线程中进行，但新快照的发布和变更回调总是在事件循环中执行
+# （绑定了事件循环之后），因此回调可以安全地操作 Future、队列等只属于事件循环的对象。
+
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Callable, Mapping
+
+try:
+    import watchfiles
+except ImportError:
+    watchfiles = None
+
+logger = logging.getLogger(__name__)
+
+_LINE_COMMENT_RE = re.compile(r'//.*')
+_BLOCK_COMMENT_RE = re.compile(r'/\*.*?\*/', re.DOTALL)
+_EMPTY = MappingProxyType({})
+
+
+def parse_jsonc(text: str) -> dict:
+    """解析 JSONC 文本：移除 // 行注释和 /* */ 块注释后按 JSON 解析。"""
+    json_content = _LINE_COMMENT_RE.sub('', text)
+    json_content = _BLOCK_COMMENT_RE.sub('', json_content)
+    return json.loads(json_content)
+
+
+def parse_json_allow_empty(text: str) -> dict:
+    """解析 JSON 文本，空文件视为空字典。"""
+    return json.loads(text) if text.strip() else {}
+
+
+def freeze(obj):
+    """递归地将 dict 转换为只读映射、将 list 转换为 tuple。"""
+    if isinstance(obj, dict):
+        return MappingProxyType({key: freeze(value) for key, value in obj.items()})
+    if isinstance(obj, list):
+        return tuple(freeze(item) for item in obj)
+    return obj
+
+
+def thaw(obj):
+    """freeze 的逆操作，返回可修改、可 JSON 序列化的副本。"""
+    if isinstance(obj, Mapping):
+        return {key: thaw(value) for key, value in obj.items()}
+    if isinstance(obj, tuple):
+        return [thaw(item) for item in obj]
+    return obj
+
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    """某一时刻所有配置文件的不可变视图。"""
+    config: Mapping = field(default_factory=lambda: _EMPTY)              # config.jsonc
+    model_endpoint_map: Mapping = field(default_factory=lambda: _EMPTY)  # model_endpoint_map.json
+    models: Mapping = field(default_factory=lambda: _EMPTY)              # models.json (模型名称 -> LMArena 模型 ID)
+    model_metadata: Mapping = field(default_factory=lambda: _EMPTY)      # models_metadata.json (模型名称 -> 组织、能力等)
+    version: int = 0                       # 每次发布新快照时递增
+    loaded_at: float = field(default_factory=time.time)
+
+
+class ConfigStore:
+    """按需重新解析配置文件并发布不可变快照。"""
+
+    # 快照字段 -> (文件名, 解析函数)
+    FILES = {
+        "config": ("config.jsonc", parse_jsonc),
+        "model_endpoint_map": ("model_endpoint_map.json", parse_json_allow_empty),
+        "models": ("models.json", parse_json_allow_empty),
+        "model_metadata": ("models_metadata.json", parse_json_allow_empty),
+    }
+    # 可以不存在的文件（由服务器自动生成），缺失时不输出警告
+    OPTIONAL = {"model_metadata"}
+
+    def __init__(self, base_dir: str = "."):
+        self.base_dir = base_dir
+        self.snapshot = ConfigSnapshot()
+        self._stamps: dict[str, tuple[int, int] | None] = {}
+        self._lock = threading.Lock()         # 保护文件状态 (_stamps, _sequence)
+        self._publish_lock = threading.Lock() # 保护快照的替换（未绑定事件循环时可能来自多个线程）
+        self._sequence = 0
+        self._published: dict[str, int] = {}  # 快照字段 -> 已发布的最新读取序号
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._listeners: list[Callable[[ConfigSnapshot, set[str]], None]] = []
+
+    # --- 便捷访问 ---
+    @property
+    def config(self) -> Mapping:
+        return self.snapshot.config
+
+    @property
+    def model_endpoint_map(self) -> Mapping:
+        return self.snapshot.model_endpoint_map
+
+    @property
+    def models(self) -> Mapping:
+        return self.snapshot.models
+
+    @property
+    def model_metadata(self) -> Mapping:
+        return self.snapshot.model_metadata
+
+    def path_of(self, name: str) -> str:
+        return os.path.join(self.base_dir, self.FILES[name][0])
+
+    def add_listener(self, callback: Callable[[ConfigSnapshot, set[str]], None]):
+        """
+        注册回调，在发布新快照后以 (新快照, 发生变化的字段集合) 调用。
+        绑定事件循环后，回调总是在事件循环中执行。
+        """
+        self._listeners.append(callback)
+
+    def bind_loop(self, loop: asyncio.AbstractEventLoop):
+        """指定发布快照与执行回调的事件循环（服务器启动时调用）。"""
+        self._loop = loop
+
+    def _stat(self, path: str) -> tuple[int, int] | None:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _load(self, name: str, stamp) -> Mapping | None:
+        """解析单个文件。文件缺失时返回空映射；解析失败时返回 None，保留上一次的有效值。"""
+        filename, parser = self.FILES[name]
+        if stamp is None:
+            if name not in self.OPTIONAL:
+                logger.warning(f"'{filename}' 文件未找到。将使用空配置。")
+            return _EMPTY
+        try:
+            with open(self.path_of(name), 'r', encoding='utf-8') as f:
+                data = parser(f.read())
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"加载或解析 '{filename}' 失败: {e}。继续使用上一次成功加载的内容。")
+            return None
+        if not isinstance(data, dict):
+            logger.error(f"'{filename}' 的顶层结构必须是 JSON 对象。继续使用上一次成功加载的内容。")
+            return None
+        logger.info(f"成功从 '{filename}' 加载了 {len(data)} 项配置。")
+        return freeze(data)
+
+    def _collect(self, force: bool) -> tuple[int, dict]:
+        """检查各文件的修改时间，只重新解析发生变化的文件。线程安全，会做阻塞 I/O。"""
+        with self._lock:
+            changes = {}
+            for name in self.FILES:
+                stamp = self._stat(self.path_of(name))
+                if not force and name in self._stamps and self._stamps[name] == stamp:
+                    continue
+                self._stamps[name] = stamp
+                value = self._load(name, stamp)
+                if value is not None:
+                    changes[name] = value
+            self._sequence += 1
+            return self._sequence, changes
+
+    def _publish(self, sequence: int, changes: dict):
+        """发布新快照并执行回调。绑定事件循环后只在事件循环中调用。"""
+        with self._publish_lock:
+            # 来自不同线程的读取结果可能乱序到达，只采用每个字段最新一次读取的内容
+            changes = {name: value for name, value in changes.items() if sequence > self._published.get(name, 0)}
+            if not changes:
+                return
+            for name in changes:
+                self._published[name] = sequence
+            previous = self.snapshot
+            self.snapshot = ConfigSnapshot(
+                config=changes.get("config", previous.config),
+                model_endpoint_map=changes.get("model_endpoint_map", previous.model_endpoint_map),
+                models=changes.get("models", previous.models),
+                model_metadata=changes.get("model_metadata", previous.model_metadata),
+                version=previous.version + 1,
+            )
+
+        for callback in self._listeners:
+            try:
+                callback(self.snapshot, set(changes))
+            except Exception as e:
+                logger.error(f"配置变更回调执行失败: {e}", exc_info=True)
+
+    def reload(self, force: bool = False) -> bool:
+        """
+        重新读取发生变化的文件，有变化时发布新的快照并返回 True。会做阻塞 I/O。
+        可以在任意线程中调用：在事件循环之外调用时，发布与回调会交给事件循环执行，
+        此方法等待其完成后返回。在事件循环中请使用 areload。
+        """
+        sequence, changes = self._collect(force)
+        if not changes:
+            return False
+        loop = self._loop
+        try:
+            on_loop = asyncio.get_running_loop() is loop
+        except RuntimeError:
+            on_loop = False
+        if loop is None or on_loop or not loop.is_running():
+            self._publish(sequence, changes)
+            return True
+
+        done = concurrent.futures.Future()
+
+        def publish():
+            try:
+                self._publish(sequence, changes)
+                done.set_result(None)
+            except BaseException as e:
+                done.set_exception(e)
+
+        loop.call_soon_threadsafe(publish)
+        done.result()
+        return True
+
+    async def areload(self, force: bool = False) -> bool:
+        """reload 的异步版本：在工作线程中读取文件，在当前事件循环中发布快照。"""
+        self._loop = asyncio.get_running_loop()
+        sequence, changes = await asyncio.to_thread(self._collect, force)
+        if not changes:
+            return False
+        self._publish(sequence, changes)
+        return True
+
+    async def watch(self, poll_interval: float = 2.0):
+        """
+        在后台持续监视配置文件。安装了 watchfiles 时使用文件系统事件，否则按固定间隔轮询。
+        实际的解析总是在工作线程中进行，不会阻塞事件循环；快照在事件循环中发布。
+        """
+        self._loop = asyncio.get_running_loop()
+        watched = {os.path.abspath(self.path_of(name)) for name in self.FILES}
+        if watchfiles is not None:
+            logger.info("配置热重载: 使用文件系统事件监视配置文件。")
+            try:
+                async for _changes in watchfiles.awatch(
+                    os.path.abspath(self.base_dir),
+                    watch_filter=lambda _change, path: os.path.abspath(path) in watched,
+                    recursive=False,
+                ):
+                    await self.areload()
+            except Exception as e:
+                logger.warning(f"文件系统事件监视失败 ({e})，改为轮询模式。")
+
+        logger.info(f"配置热重载: 每 {poll_interval} 秒检查一次配置文件的修改时间。")
+        while True:
+            await asyncio.sleep(poll_interval)
+            await self.areload()
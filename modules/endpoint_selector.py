@@ -0,0 +1,218 @@
+# modules/endpoint_selector.py
+# 模型端点（会话）选择：基于延迟与错误率的负载均衡和熔断。
+#
+# model_endpoint_map.json 可以为一个模型配置多个会话 (session_id/message_id)。
+# 随机选择会让失效或很慢的会话分到与正常会话相同的流量。EndpointSelector 为每个映射条目
+# 维护首字延迟 (TTFB)、生成速度 (tokens/s) 与错误率的指数加权移动平均 (EWMA)，
+# 使用“二选一” (power of two choices) 挑选预期代价更低的条目；
+# 连续失败达到阈值的条目会被熔断（暂时移出候选），冷却时间过后放行一个探测请求，
+# 探测成功则恢复，失败则再次熔断。
+#
+# 探测从 select() 开始，由 observe() 在请求结束时结算。在进入 observe() 之前就结束的请求
+# （被拒绝、设置失败等）必须调用 release_probe()；从未被读取的响应流无法结算，
+# 探测超过 probe_timeout 秒仍未结束时视为已放弃，允许下一个请求继续探测。
+
+import logging
+import random
+import time
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+# 估算预期耗时时使用的参考回复长度（token）
+_REFERENCE_TOKENS = 256
+
+
+def endpoint_key(model: str, entry) -> str:
+    """映射条目的标识：模型名称 + 会话 ID + 消息 ID。"""
+    return f"{model}|{entry.get('session_id')}|{entry.get('message_id')}"
+
+
+class EndpointStats:
+    """一个映射条目的统计数据与熔断状态。"""
+
+    def __init__(self):
+        self.ttfb = None # 首字延迟的 EWMA（秒）
+        self.tokens_per_second = None # 生成速度的 EWMA
+        self.error_rate = 0.0 # 错误率的 EWMA（在 error_updated_at 时的值）
+        self.error_updated_at = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probing = False # 半开状态下是否已有探测请求在进行
+        self.probe_pending = False # 探测请求已选出、但还没有进入 observe()
+        self.probe_started_at = 0.0
+
+    def current_error_rate(self, now: float, half_life: float) -> float:
+        """
+        错误率随时间衰减（半衰期为 half_life 秒），否则偶尔失败过一次的会话
+        可能再也不会被选中，也就永远没有机会证明自己已经恢复。
+        """
+        if not self.error_rate or half_life <= 0:
+            return self.error_rate
+        return self.error_rate * 0.5 ** ((now - self.error_updated_at) / half_life)
+
+    def expected_cost(self, now: float, half_life: float) -> float:
+        """预期耗时（秒），按当前并发和错误率放大。还没有数据的条目代价最低，会被优先尝试。"""
+        latency = self.ttfb or 0.0
+        if self.tokens_per_second:
+            latency += _REFERENCE_TOKENS / self.tokens_per_second
+        error_rate = self.current_error_rate(now, half_life)
+        return (latency + 0.1) * (1 + self.in_flight) / max(0.05, 1.0 - error_rate)
+
+
+class EndpointSelector:
+    """为映射到多个会话的模型选择条目。所有方法都应在主事件循环中调用。"""
+
+    def __init__(self, alpha: float = 0.3, failure_threshold: int = 3, cooldown: float = 60.0,
+                 strategy: str = "p2c", probe_timeout: float = 420.0):
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.strategy = strategy
+        self.probe_timeout = probe_timeout
+        self._stats: dict[str, EndpointStats] = {}
+
+    def _get(self, key: str) -> EndpointStats:
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = EndpointStats()
+        return stats
+
+    def _available(self, stats: EndpointStats, now: float) -> bool:
+        if stats.state == CLOSED:
+            return True
+        if stats.state == OPEN and now - stats.opened_at >= self.cooldown:
+            stats.state = HALF_OPEN
+            stats.probing = False
+        if stats.state == HALF_OPEN and stats.probing and now - stats.probe_started_at >= self.probe_timeout:
+            logger.warning("ENDPOINT: 探测请求超时未结束，允许重新探测。")
+            stats.probing = False
+        return stats.state == HALF_OPEN and not stats.probing
+
+    def select(self, model: str, entries):
+        """
+        从 entries 中选择一个条目。被熔断的条目不参与选择；
+        所有条目都被熔断时，选择最早被熔断的条目（它最有可能已经恢复）。
+        """
+        if len(entries) == 1:
+            return entries[0]
+        now = time.monotonic()
+        scored = [(entry, self._get(endpoint_key(model, entry))) for entry in entries]
+        candidates = [(entry, stats) for entry, stats in scored if self._available(stats, now)]
+        if not candidates:
+            entry, stats = min(scored, key=lambda item: item[1].opened_at)
+            logger.warning(f"模型 '{model}' 的所有会话都已被熔断，尝试最早熔断的会话 ...{str(entry.get('session_id'))[-6:]}。")
+        elif self.strategy == "random" or len(candidates) == 1:
+            entry, stats = random.choice(candidates)
+        else:
+            first, second = random.sample(candidates, 2)
+            entry, stats = min(first, second, key=lambda item: item[1].expected_cost(now, self.cooldown))
+        if stats.state == HALF_OPEN:
+            stats.probing = True
+            stats.probe_pending = True
+            stats.probe_started_at = now
+            logger.info(f"模型 '{model}' 的会话 ...{str(entry.get('session_id'))[-6:]} 冷却结束，发送探测请求。")
+        return entry
+
+    def release_probe(self, model: str, entry):
+        """
+        select() 选出的请求在进入 observe() 之前就结束时调用（被拒绝、设置失败等），
+        释放它可能持有的探测名额。已经进入 observe() 的请求由 observe() 自己结算，这里不做任何事。
+        """
+        stats = self._stats.get(endpoint_key(model, entry))
+        if stats is not None and stats.probe_pending:
+            stats.probe_pending = False
+            stats.probing = False
+
+    def _ewma(self, old, value):
+        return value if old is None else old + self.alpha * (value - old)
+
+    def _update_error_rate(self, stats: EndpointStats, value: float):
+        now = time.monotonic()
+        stats.error_rate = self._ewma(stats.current_error_rate(now, self.cooldown), value)
+        stats.error_updated_at = now
+
+    def _record_success(self, key: str, stats: EndpointStats):
+        self._update_error_rate(stats, 0.0)
+        stats.consecutive_failures = 0
+        if stats.state != CLOSED:
+            logger.info(f"ENDPOINT [{key}]: 探测成功，会话已恢复。")
+        stats.state = CLOSED
+        stats.probing = False
+
+    def _record_failure(self, key: str, stats: EndpointStats):
+        stats.failures += 1
+        self._update_error_rate(stats, 1.0)
+        stats.consecutive_failures += 1
+        stats.probing = False
+        if stats.state == HALF_OPEN or stats.consecutive_failures >= self.failure_threshold:
+            if stats.state != OPEN:
+                logger.warning(f"ENDPOINT [{key}]: 连续失败 {stats.consecutive_failures} 次，熔断 {self.cooldown:.0f} 秒。")
+            stats.state = OPEN
+            stats.opened_at = time.monotonic()
+
+    async def observe(self, events, model: str, entry, started_at: float | None = None,
+                      is_session_error: Callable[[object], bool] | None = None):
+        """
+        透传内部事件流，并记录该条目的首字延迟、生成速度和结果。
+        客户端中途断开（事件流抛出异常）的请求既不算成功也不算失败；
+        is_session_error 返回 False 的错误（与会话本身无关，例如本地拒绝的附件）同样不计入。
+        """
+        key = endpoint_key(model, entry)
+        stats = self._get(key)
+        started_at = started_at or time.monotonic()
+        first_at = None
+        chars = 0
+        outcome = None
+        unrelated_error = False
+        stats.in_flight += 1
+        stats.requests += 1
+        stats.probe_pending = False # 探测（如果是）由这里结算
+        try:
+            async for event_type, data in events:
+                if event_type == 'content':
+                    if first_at is None:
+                        first_at = time.monotonic()
+                        stats.ttfb = self._ewma(stats.ttfb, first_at - started_at)
+                    chars += len(data)
+                elif event_type == 'error':
+                    if is_session_error is None or is_session_error(data):
+                        outcome = False
+                    else:
+                        unrelated_error = True
+                yield event_type, data
+            if outcome is None and not unrelated_error:
+                outcome = True
+        finally:
+            stats.in_flight -= 1
+            if outcome is True:
+                duration = time.monotonic() - first_at if first_at else 0.0
+                if chars and duration > 0.05:
+                    stats.tokens_per_second = self._ewma(stats.tokens_per_second, chars / 4 / duration)
+                self._record_success(key, stats)
+            elif outcome is False:
+                self._record_failure(key, stats)
+            elif stats.state == HALF_OPEN:
+                # 探测请求被取消或没有得出结论，允许下一个请求继续探测
+                stats.probing = False
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        return {
+            key: {
+                "state": s.state,
+                "ttfb_ms": round(s.ttfb * 1000) if s.ttfb is not None else None,
+                "tokens_per_second": round(s.tokens_per_second, 1) if s.tokens_per_second else None,
+                "error_rate": round(s.current_error_rate(now, self.cooldown), 3),
+                "in_flight": s.in_flight,
+                "requests": s.requests,
+                "failures": s.failures,
+            }
+            for key, s in self._stats.items()
+        }
@@ -0,0 +1,244 @@
+# modules/image_cache.py
+# 生成图片的本地缓存。
+#
+# LMArena 返回的图片 URL 会被客户端一次又一次地重新下载。ImageFetchCache 用一个共享的
+# aiohttp 连接池下载图片，分块写入磁盘（不在内存中缓存整个文件），按 URL 的哈希保存，
+# 目录总大小超过上限时淘汰最久未使用的图片。缓存用于：
+#   - response_format=b64_json：从缓存读取图片并以 base64 返回；
+#   - 本地代理端点 GET /v1/images/files/{key}：直接从磁盘发送缓存的图片，
+#     第一次访问时才下载（相同图片的并发下载会被合并）。
+# aiohttp 在第一次下载时才导入，不拖慢服务器启动。
+
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+_SUFFIX = ".img"
+_CHUNK_SIZE = 1 << 16
+
+# 文件头 -> Content-Type
+_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+
+def image_key(url: str) -> str:
+    """图片 URL 的缓存键。"""
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()[:32]
+
+
+def sniff_content_type(head: bytes) -> str:
+    for signature, content_type in _SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+
+class ImageFetchError(Exception):
+    """图片下载失败。"""
+
+
+class ImageFetchCache:
+    """缓存键 -> 磁盘上的图片文件。所有方法都应在主事件循环中调用。"""
+
+    def __init__(self, directory: str, max_bytes: int = 512 << 20, max_file_bytes: int = 50 << 20,
+                 timeout: float = 60.0, max_connections: int = 16, max_urls: int = 10000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.max_urls = max_urls
+        self._index: OrderedDict[str, int] = OrderedDict() # 缓存键 -> 文件大小，按最近使用排序
+        self._bytes = 0
+        self._urls: OrderedDict[str, str] = OrderedDict() # 缓存键 -> 原始 URL（供代理端点按需下载）
+        self._pending: dict[str, asyncio.Future] = {}
+        self._session = None # aiohttp.ClientSession，第一次下载时创建
+        self._index_loaded: asyncio.Task | None = None
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + _SUFFIX)
+
+    async def _ensure_index(self):
+        """第一次使用时在线程中扫描缓存目录（不拖慢服务器启动）。"""
+        if self._index_loaded is None:
+            self._index_loaded = asyncio.create_task(self._load_index())
+        await asyncio.shield(self._index_loaded)
+
+    async def _load_index(self):
+        entries = await asyncio.to_thread(self._scan)
+        for _mtime, key, size in sorted(entries):
+            if key not in self._index:
+                self._index[key] = size
+                self._bytes += size
+        if entries:
+            logger.info(f"图片缓存: 已索引 {len(entries)} 个文件 ({self._bytes / 1048576:.1f} MB)。")
+
+    def _scan(self) -> list:
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(_SUFFIX):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, name[:-len(_SUFFIX)], st.st_size))
+        return entries
+
+    def _get_session(self):
+        import aiohttp
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    def remember(self, url: str) -> str:
+        """登记一个图片 URL 并返回其缓存键（不下载），代理端点之后可以按键下载。"""
+        key = image_key(url)
+        self._urls[key] = url
+        self._urls.move_to_end(key)
+        while len(self._urls) > self.max_urls:
+            self._urls.popitem(last=False)
+        return key
+
+    def url_of(self, key: str) -> str | None:
+        return self._urls.get(key)
+
+    async def contains(self, key: str) -> bool:
+        await self._ensure_index()
+        return key in self._index
+
+    async def fetch(self, url: str) -> str:
+        """确保图片已在缓存中并返回缓存键。相同图片的并发请求只下载一次。失败时抛出 ImageFetchError。"""
+        key = self.remember(url)
+        await self._ensure_index()
+        if key in self._index:
+            self._index.move_to_end(key)
+            self.hits += 1
+            return key
+        pending = self._pending.get(key)
+        if pending is None:
+            self.misses += 1
+            pending = self._pending[key] = asyncio.ensure_future(self._download(key, url))
+            pending.add_done_callback(lambda f: self._download_done(key, f))
+        await asyncio.shield(pending)
+        return key
+
+    def _download_done(self, key: str, future: asyncio.Future):
+        self._pending.pop(key, None)
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning(f"IMAGE CACHE: 图片 {key[:8]} 下载失败: {future.exception()}")
+
+    async def _download(self, key: str, url: str):
+        import aiohttp
+        tmp_path = self.path(key) + f".{os.getpid()}.tmp"
+        size = 0
+        try:
+            async with self._get_session().get(url) as resp:
+                if resp.status != 200:
+                    raise ImageFetchError(f"下载图片失败: HTTP {resp.status}")
+                if (resp.content_length or 0) > self.max_file_bytes:
+                    raise ImageFetchError(f"图片过大: {resp.content_length} 字节")
+                f = await asyncio.to_thread(open, tmp_path, 'wb')
+                try:
+                    async for chunk in resp.content.iter_chunked(_CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > self.max_file_bytes:
+                            raise ImageFetchError(f"图片超过 {self.max_file_bytes} 字节")
+                        await asyncio.to_thread(f.write, chunk)
+                finally:
+                    await asyncio.to_thread(f.close)
+            await asyncio.to_thread(os.replace, tmp_path, self.path(key))
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            await asyncio.to_thread(self._remove, tmp_path)
+            raise ImageFetchError(f"下载图片失败: {e}") from e
+        except BaseException:
+            await asyncio.shield(asyncio.to_thread(self._remove, tmp_path))
+            raise
+        self._index[key] = size
+        self._bytes += size
+        doomed = []
+        while self._bytes > self.max_bytes and len(self._index) > 1:
+            old_key, old_size = self._index.popitem(last=False)
+            self._bytes -= old_size
+            doomed.append(self.path(old_key))
+        if doomed:
+            asyncio.get_running_loop().run_in_executor(None, self._remove, *doomed)
+        logger.info(f"IMAGE CACHE: 已缓存图片 {key[:8]} ({size / 1024:.0f} KB)。")
+
+    @staticmethod
+    def _remove(*paths: str):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    async def open_cached(self, key: str) -> tuple[str, str] | None:
+        """
+        返回缓存图片的 (文件路径, Content-Type)。不在缓存中但 URL 已登记时先下载，
+        未知的键返回 None。
+        """
+        await self._ensure_index()
+        if key not in self._index:
+            url = self._urls.get(key)
+            if url is None:
+                return None
+            await self.fetch(url)
+        else:
+            self._index.move_to_end(key)
+            self.hits += 1
+        path = self.path(key)
+        head = await asyncio.to_thread(self._read_head, path)
+        if head is None:
+            # 文件已被外部删除
+            self._bytes -= self._index.pop(key, 0)
+            return None
+        return path, sniff_content_type(head)
+
+    @staticmethod
+    def _read_head(path: str) -> bytes | None:
+        try:
+            with open(path, 'rb') as f:
+                return f.read(16)
+        except OSError:
+            return None
+
+    async def read_b64(self, key: str) -> str:
+        """在线程中读取缓存的图片并编码为 base64。"""
+        def encode():
+            with open(self.path(key), 'rb') as f:
+                return base64.b64encode(f.read()).decode('ascii')
+        try:
+            return await asyncio.to_thread(encode)
+        except OSError as e:
+            raise ImageFetchError(f"读取缓存图片失败: {e}") from e
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def stats(self) -> dict:
+        return {
+            "files": len(self._index),
+            "bytes": self._bytes,
+            "downloading": len(self._pending),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -5,24 +5,38 @@ import json
 import re
 import time
 import uuid
+from collections.abc import Mapping
 from typing import AsyncGenerator
 
+from modules.image_cache import ImageFetchError
+
 # 全局变量，之后会从主服务传入
 logger = None
-response_channels = None
-CONFIG = None
-MODEL_NAME_TO_ID_MAP = None
+response_channels = None # ChannelRegistry，与主服务共享
+config_store = None # 配置快照存储，每次使用时读取最新快照
 DEFAULT_MODEL_ID = None
+browser_pool = None
+metrics = None # BridgeMetrics，与主服务共享（可选）
+stream_recorder = None # StreamRecorder，与主服务共享（可选）
+image_scheduler = None # ImageJobScheduler，控制图片任务的并发并分配会话（可选）
+image_cache = None # ImageFetchCache，b64_json 与本地图片代理使用的磁盘缓存（可选）
+_background_tasks: set[asyncio.Task] = set() # 持有预下载、abort 指令等后台任务的引用，防止被垃圾回收
 
 
-def initialize_image_module(app_logger, channels, app_config, model_map, default_model_id):
+def initialize_image_module(app_logger, channels, store, default_model_id, pool, app_metrics=None, recorder=None,
+                            scheduler=None, fetch_cache=None):
     """初始化模块所需的全局变量。"""
-    global logger, response_channels, CONFIG, MODEL_NAME_TO_ID_MAP, DEFAULT_MODEL_ID
+    global logger, response_channels, config_store, DEFAULT_MODEL_ID, browser_pool, metrics, stream_recorder, image_scheduler
+    global image_cache
     logger = app_logger
     response_channels = channels
-    CONFIG = app_config
-    MODEL_NAME_TO_ID_MAP = model_map
+    config_store = store
     DEFAULT_MODEL_ID = default_model_id
+    browser_pool = pool
+    metrics = app_metrics
+    stream_recorder = recorder
+    image_scheduler = scheduler
+    image_cache = fetch_cache
     logger.info("文生图模块已成功初始化。")
 
 def convert_to_lmarena_image_payload(prompt: str, model_id: str, session_id: str, message_id: str) -> dict:
@@ -40,8 +54,32 @@ def convert_to_lmarena_image_payload(prompt: str, model_id: str, session_id: str
         "message_id": message_id
     }
 
+def _run_in_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def _abort_browser_fetch(request_id: str):
+    """通知负责该请求的标签页中止仍在进行的 fetch（在后台发送，可以在 finally 中安全调用）。"""
+    worker = browser_pool.owner_of(request_id)
+    if worker is None or not worker.is_healthy():
+        return
+
+    async def send():
+        try:
+            await worker.send_command("abort", request_id=request_id)
+        except Exception as e:
+            logger.warning(f"IMAGE PROCESSOR [ID: {request_id[:8]}]: 发送中止指令失败: {e}")
+    _run_in_background(send())
+
+
 async def _process_image_stream(request_id: str) -> AsyncGenerator[tuple[str, str], None]:
-    """处理来自浏览器的图片生成数据流，并产生结构化事件。"""
+    """
+    处理来自浏览器的图片生成数据流，并产生结构化事件。
+    解析到图片 URL 后立即产出并结束，不再等待 [DONE]；此时浏览器端的 fetch 会被中止，标签页随即释放。
+    """
     queue = response_channels.get(request_id)
     if not queue:
         logger.error(f"IMAGE PROCESSOR [ID: {request_id[:8]}]: 无法找到响应通道。")
@@ -49,14 +87,14 @@ async def _process_image_stream(request_id: str) -> AsyncGenerator[tuple[str, st
         return
 
     buffer = ""
-    timeout = CONFIG.get("stream_response_timeout_seconds", 360)
+    timeout = config_store.config.get("stream_response_timeout_seconds", 360)
     # 通用化正则表达式以匹配 a 或 b 前缀
     image_pattern = re.compile(r'[ab]2:(\[.*?\])')
     finish_pattern = re.compile(r'[ab]d:(\{.*?"finishReason".*?\})')
     # 通用错误匹配，可以捕获包含 "error" 或 "context_file" 的 JSON 对象
     error_pattern = re.compile(r'(\{\s*".*?"\s*:\s*".*?"(error|context_file).*?"\s*\})', re.DOTALL | re.IGNORECASE)
     
-    found_image_url = None # 用于存储找到的 URL
+    browser_finished = False # 浏览器是否已经结束了它的 fetch（收到 [DONE] 或错误）
 
     try:
         while True:
@@ -64,19 +102,20 @@ async def _process_image_stream(request_id: str) -> AsyncGenerator[tuple[str, st
                 raw_data = await asyncio.wait_for(queue.get(), timeout=timeout)
             except asyncio.TimeoutError:
                 logger.warning(f"IMAGE PROCESSOR [ID: {request_id[:8]}]: 等待浏览器数据超时（{timeout}秒）。")
-                # 如果超时但已收到图片，则认为是成功
-                if found_image_url:
-                    yield 'image_url', found_image_url
-                else:
-                    yield 'error', f'Response timed out after {timeout} seconds.'
+                if metrics is not None:
+                    metrics.upstream_errors.inc("timeout")
+                yield 'error', f'Response timed out after {timeout} seconds.'
                 return
+            response_channels.touch(request_id)
 
             if isinstance(raw_data, dict) and 'error' in raw_data:
+                browser_finished = True
                 yield 'error', raw_data.get('error', 'Unknown browser error')
                 return
             
             # [DONE] 是流的结束信号
             if raw_data == "[DONE]":
+                browser_finished = True
                 break
 
             buffer += "".join(str(item) for item in raw_data) if isinstance(raw_data, list) else raw_data
@@ -88,21 +127,18 @@ async def _process_image_stream(request_id: str) -> AsyncGenerator[tuple[str, st
                     return
                 except json.JSONDecodeError: pass
 
-            # 只在尚未找到 URL 时才进行匹配
-            if not found_image_url:
-                while (match := image_pattern.search(buffer)):
-                    try:
-                        image_data_list = json.loads(match.group(1))
-                        if isinstance(image_data_list, list) and image_data_list:
-                            image_info = image_data_list[0]
-                            if image_info.get("type") == "image" and "image" in image_info:
-                                found_image_url = image_info["image"]
-                                # 找到后不再从此 buffer 中继续查找图片
-                                buffer = buffer[match.end():]
-                                break
-                    except (json.JSONDecodeError, IndexError) as e:
-                        logger.error(f"解析图片URL时出错: {e}, buffer: {buffer}")
-                    buffer = buffer[match.end():]
+            while (match := image_pattern.search(buffer)):
+                try:
+                    image_data_list = json.loads(match.group(1))
+                    if isinstance(image_data_list, list) and image_data_list:
+                        image_info = image_data_list[0]
+                        if image_info.get("type") == "image" and "image" in image_info:
+                            # 找到图片后立即返回，之后的数据（结束行、[DONE]）不再需要
+                            yield 'image_url', image_info["image"]
+                            return
+                except (json.JSONDecodeError, IndexError) as e:
+                    logger.error(f"解析图片URL时出错: {e}, buffer: {buffer}")
+                buffer = buffer[match.end():]
 
             if (finish_match := finish_pattern.search(buffer)):
                 try:
@@ -111,45 +147,90 @@ async def _process_image_stream(request_id: str) -> AsyncGenerator[tuple[str, st
                 except (json.JSONDecodeError, IndexError): pass
                 buffer = buffer[finish_match.end():]
         
-        # 循环结束后，根据是否找到了 URL 来 yield 最终结果
-        if found_image_url:
-            yield 'image_url', found_image_url
-        # 如果没有图片URL，但有结束原因，则不发送错误，让调用者决定
-        elif not any(e[0] == 'finish' for e in locals().get('_debug_events', [])):
-             # 如果流结束了但还是没找到图片，报告错误
-            yield 'error', 'Stream ended without providing an image URL.'
+        # 流结束了但还是没找到图片
+        yield 'error', 'Stream ended without providing an image URL.'
 
     except asyncio.CancelledError:
         logger.info(f"IMAGE PROCESSOR [ID: {request_id[:8]}]: 任务被取消。")
+        raise
     finally:
-        if request_id in response_channels:
-            del response_channels[request_id]
+        if not browser_finished:
+            # 已拿到图片、超时或被取消：让浏览器停止读取上游的流
+            _abort_browser_fetch(request_id)
+        browser_pool.release(request_id)
+        if stream_recorder is not None:
+            stream_recorder.end(request_id)
+        if response_channels.close(request_id):
             logger.info(f"IMAGE PROCESSOR [ID: {request_id[:8]}]: 响应通道已清理。")
 
 
-async def generate_single_image(prompt: str, model_name: str, browser_ws) -> str | dict:
+def _is_valid_session(entry) -> bool:
+    session_id = entry.get("session_id")
+    message_id = entry.get("message_id")
+    return bool(session_id and message_id and "YOUR_" not in session_id and "YOUR_" not in message_id)
+
+
+def resolve_image_sessions(model_name: str) -> list:
     """
-    执行单次文生图请求，并返回图片 URL 或错误字典。
+    返回可用于该模型的会话列表：model_endpoint_map.json 中为该模型配置的全部有效映射，
+    没有映射时（且允许回退）使用 config.jsonc 中的全局会话。
     """
-    if not browser_ws:
+    snapshot = config_store.snapshot
+    mapping = snapshot.model_endpoint_map.get(model_name)
+    if isinstance(mapping, Mapping):
+        mapping = [mapping]
+    entries = [entry for entry in mapping or () if isinstance(entry, Mapping) and _is_valid_session(entry)]
+    if not entries and snapshot.config.get("use_default_ids_if_mapping_not_found", True):
+        default = {"session_id": snapshot.config.get("session_id"), "message_id": snapshot.config.get("message_id")}
+        if _is_valid_session(default):
+            entries = [default]
+    return entries
+
+
+async def generate_single_image(prompt: str, model_name: str, sessions: list) -> str | dict:
+    """在调度器分配的会话上执行单次文生图请求，并记录结果与耗时。"""
+    if image_scheduler is None:
+        return await _timed_generate(prompt, model_name, sessions[0])
+    async with image_scheduler.slot(sessions) as session:
+        return await _timed_generate(prompt, model_name, session)
+
+
+async def _timed_generate(prompt: str, model_name: str, session) -> str | dict:
+    started_at = time.monotonic()
+    result = await _generate_single_image(prompt, model_name, session)
+    if metrics is not None:
+        metrics.image_requests.inc("success" if isinstance(result, str) else "error")
+        metrics.image_duration.observe(time.monotonic() - started_at)
+    return result
+
+
+async def _generate_single_image(prompt: str, model_name: str, session) -> str | dict:
+    """
+    在指定的会话上执行单次文生图请求，并返回图片 URL 或错误字典。
+    请求会被分发给工作池中负载最低的健康标签页。
+    """
+    if not browser_pool.has_healthy_worker():
         return {"error": "Browser client not connected."}
 
     target_model_id = None # 强制 modelId 为 null
-    session_id = CONFIG.get("session_id")
-    message_id = CONFIG.get("message_id")
-
-    if not session_id or not message_id or "YOUR_" in session_id or "YOUR_" in message_id:
-        return {"error": "Session ID or Message ID is not configured."}
+    session_id = session.get("session_id")
+    message_id = session.get("message_id")
 
     request_id = str(uuid.uuid4())
-    response_channels[request_id] = asyncio.Queue()
+    worker = browser_pool.acquire(request_id)
+    if not worker:
+        return {"error": "Browser client not connected."}
+    response_channels.open(request_id)
+    if stream_recorder is not None:
+        stream_recorder.begin(request_id, "image", model_name)
 
     try:
         lmarena_payload = convert_to_lmarena_image_payload(prompt, target_model_id, session_id, message_id)
         message_to_browser = {"request_id": request_id, "payload": lmarena_payload}
         
-        logger.info(f"IMAGE GEN (SINGLE) [ID: {request_id[:8]}]: 正在发送请求...")
-        await browser_ws.send_text(json.dumps(message_to_browser))
+        logger.info(f"IMAGE GEN (SINGLE) [ID: {request_id[:8]}]: 正在发送请求到标签页 #{worker.worker_id} "
+                    f"(会话 ...{session_id[-6:]})...")
+        await worker.send_text(json.dumps(message_to_browser))
 
         # _process_image_stream 现在只会 yield 'image_url' 或 'error' 或 'finish'
         async for event_type, data in _process_image_stream(request_id):
@@ -167,15 +248,31 @@ async def generate_single_image(prompt: str, model_name: str, browser_ws) -> str
         # 如果循环正常结束但没有任何返回（例如，只收到了 finish:stop），则报告错误。
         return {"error": "Image generation stream ended without a result."}
 
+    except asyncio.CancelledError:
+        # 例如到达 deadline_seconds 时被取消；已开始读取的流由 _process_image_stream 自己清理
+        _release_request(request_id)
+        raise
     except Exception as e:
         logger.error(f"IMAGE GEN (SINGLE) [ID: {request_id[:8]}]: 处理时发生致命错误: {e}", exc_info=True)
-        if request_id in response_channels:
-            del response_channels[request_id]
+        _release_request(request_id)
         return {"error": "An internal server error occurred."}
 
 
-async def handle_image_generation_request(request, browser_ws):
-    """处理文生图API端点请求，支持并行生成。"""
+def _release_request(request_id: str):
+    """释放请求占用的标签页、录制与响应通道，可以重复调用。"""
+    browser_pool.release(request_id)
+    if stream_recorder is not None:
+        stream_recorder.end(request_id)
+    response_channels.close(request_id)
+
+
+async def handle_image_generation_request(request):
+    """
+    处理文生图API端点请求，支持并行生成。
+    返回 (响应数据, 状态码)。stream=true 时响应数据是一个产生 SSE 字节的异步生成器：
+    每张图片一生成好就作为一个事件发出，不必等待最慢的那一张。
+    deadline_seconds 限制等待时间：到期时返回已经生成的图片，其余任务被取消。
+    """
     try:
         req_body = await request.json()
     except json.JSONDecodeError:
@@ -191,12 +288,38 @@ async def handle_image_generation_request(request, browser_ws):
 
     model_name = req_body.get("model", "dall-e-3")
 
-    logger.info(f"收到文生图请求: n={n}, prompt='{prompt[:30]}...'")
+    response_format = req_body.get("response_format") or "url"
+    if response_format not in ("url", "b64_json"):
+        return {"error": "Parameter 'response_format' must be 'url' or 'b64_json'."}, 400
+    if response_format == "b64_json" and image_cache is None:
+        return {"error": "response_format 'b64_json' is not available: image cache is not initialized."}, 500
+
+    deadline = req_body.get("deadline_seconds")
+    if deadline is not None and (isinstance(deadline, bool) or not isinstance(deadline, (int, float)) or deadline <= 0):
+        return {"error": "Parameter 'deadline_seconds' must be a positive number."}, 400
+
+    sessions = resolve_image_sessions(model_name)
+    if not sessions:
+        return {"error": "Session ID or Message ID is not configured."}, 500
+
+    logger.info(f"收到文生图请求: n={n}, 可用会话 {len(sessions)} 个, prompt='{prompt[:30]}...'")
 
-    # 创建 n 个并行任务
-    tasks = [generate_single_image(prompt, model_name, browser_ws) for _ in range(n)]
-    results = await asyncio.gather(*tasks)
+    def start_tasks() -> list[asyncio.Task]:
+        # 创建 n 个任务，由调度器控制并发并分散到各个会话
+        return [asyncio.create_task(generate_single_image(prompt, model_name, sessions)) for _ in range(n)]
+
+    if req_body.get("stream"):
+        return _stream_images(request, start_tasks, response_format, deadline), 200
+
+    tasks = start_tasks()
+    try:
+        done, pending = await asyncio.wait(tasks, timeout=deadline)
+    finally:
+        await _cancel_tasks([task for task in tasks if not task.done()])
+    if pending:
+        logger.warning(f"文生图请求在 {deadline} 秒的期限内完成了 {len(done)}/{n} 个任务，其余任务已取消。")
 
+    results = [task.result() for task in tasks if task in done]
     successful_urls = [res for res in results if isinstance(res, str)]
     errors = [res['error'] for res in results if isinstance(res, dict)]
 
@@ -204,17 +327,97 @@ async def handle_image_generation_request(request, browser_ws):
         logger.error(f"文生图请求中有 {len(errors)} 个任务失败: {errors}")
     
     if not successful_urls:
+        if pending and not errors:
+            return {"error": f"No image was generated within {deadline} seconds."}, 504
          # 如果所有任务都失败了，返回一个错误
         error_message = f"All {n} image generation tasks failed. Last error: {errors[-1] if errors else 'Unknown error'}"
         return {"error": error_message}, 500
 
     # 格式化为 OpenAI 响应
+    formatted = await asyncio.gather(*(_format_image(request, url, response_format) for url in successful_urls))
+    data = [item for item in formatted if item is not None]
+    if not data:
+        return {"error": "All generated images failed to download."}, 502
     response_data = {
         "created": int(time.time()),
-        "data": [
-            {
-                "url": url,
-            } for url in successful_urls
-        ]
+        "data": data
     }
-    return response_data, 200
\ No newline at end of file
+    if pending:
+        response_data["incomplete"] = len(pending) # 在期限内未完成而被取消的图片数量
+    return response_data, 200
+
+
+async def _cancel_tasks(tasks: list):
+    """取消任务并等待它们清理完毕（释放调度器的空位、中止浏览器端的请求）。"""
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _sse(event: dict) -> bytes:
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode('utf-8')
+
+
+async def _stream_images(request, start_tasks, response_format: str, deadline: float | None):
+    """
+    文生图的 SSE 流：每张图片完成时发出 {"type": "image_generation.completed", "index": i, "url" | "b64_json": ...}，
+    失败时发出 {"type": "error", "index": i, "error": {...}}，最后发出 [DONE]。
+    客户端断开时，尚未完成的任务会被取消。
+    """
+    tasks = start_tasks()
+    index_of = {task: i for i, task in enumerate(tasks)}
+    pending = set(tasks)
+    created = int(time.time())
+    loop = asyncio.get_running_loop()
+    expires_at = loop.time() + deadline if deadline else None
+    try:
+        while pending:
+            timeout = max(0.0, expires_at - loop.time()) if expires_at is not None else None
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break # 到达期限
+            for task in sorted(done, key=index_of.get):
+                index = index_of[task]
+                result = task.result()
+                item = await _format_image(request, result, response_format) if isinstance(result, str) else None
+                if item is not None:
+                    yield _sse({"type": "image_generation.completed", "index": index, "created": created, **item})
+                else:
+                    message = result["error"] if isinstance(result, dict) else "Failed to download the generated image."
+                    yield _sse({"type": "error", "index": index, "error": {"message": message}})
+        for task in sorted(pending, key=index_of.get):
+            yield _sse({"type": "error", "index": index_of[task],
+                        "error": {"message": f"Image was not generated within {deadline} seconds."}})
+        yield b"data: [DONE]\n\n"
+    finally:
+        await _cancel_tasks([task for task in tasks if not task.done()])
+
+
+def _public_url(request, url: str) -> str:
+    """启用本地图片代理时，返回指向 /v1/images/files/{key} 的地址，否则返回原始 URL。"""
+    if image_cache is None or not config_store.config.get("image_proxy_enabled", False):
+        return url
+    key = image_cache.remember(url)
+    if config_store.config.get("image_proxy_prefetch", True):
+        # 提前下载，客户端第一次访问代理地址时通常已经命中缓存
+        _run_in_background(_prefetch(url))
+    return str(request.url_for("image_file", key=key))
+
+
+async def _prefetch(url: str):
+    try:
+        await image_cache.fetch(url)
+    except ImageFetchError:
+        pass # 已在缓存中记录日志，代理端点被访问时会重试
+
+
+async def _format_image(request, url: str, response_format: str) -> dict | None:
+    """按 response_format 格式化一张图片。b64_json 时下载（或从缓存读取）图片，下载失败返回 None。"""
+    if response_format != "b64_json":
+        return {"url": _public_url(request, url)}
+    try:
+        return {"b64_json": await image_cache.read_b64(await image_cache.fetch(url))}
+    except ImageFetchError as e:
+        logger.error(f"文生图: 下载图片失败 ({url[:60]}...): {e}")
+        return None
\ No newline at end of file
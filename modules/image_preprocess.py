@@ -0,0 +1,141 @@
+# modules/image_preprocess.py
+# 上传前的图片预处理（可选，需要 Pillow）。
+#
+# LMArena 会拒绝过大的附件 (413)，而这个错误只能在整个上传失败之后才能发现。
+# ImagePreprocessor 在请求发送给浏览器之前，把超过大小或尺寸上限的图片缩小并重新编码。
+# 解码和编码都在 ProcessPoolExecutor 中进行，不会阻塞事件循环；
+# 结果按原图的内容哈希和处理参数缓存，对话历史中重复出现的图片只需处理一次；
+# 通过 config.jsonc 修改大小、尺寸或质量上限后，旧参数下的结果不会再被使用。
+# Pillow 只在子进程中导入，服务器进程启动时只检查它是否已安装。
+
+import asyncio
+import base64
+import binascii
+import importlib.util
+import io
+import logging
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+_PIL_AVAILABLE = importlib.util.find_spec("PIL") is not None
+
+logger = logging.getLogger(__name__)
+
+# 可以重新编码的图片类型（动图等其他类型保持原样）
+_SUPPORTED_TYPES = {"image/jpeg", "image/jpg", "image/png", "image/webp", "image/bmp", "image/tiff"}
+
+
+def _shrink_image(data_uri: str, max_bytes: int, max_dimension: int, quality: int) -> str | None:
+    """
+    在子进程中运行：把 data URI 中的图片缩小/重新编码到 max_bytes 以内。
+    不需要处理或处理后没有变小时返回 None。
+    """
+    from PIL import Image
+
+    header, _, encoded = data_uri.partition(',')
+    try:
+        raw = base64.b64decode(encoded, validate=False)
+    except (binascii.Error, ValueError):
+        return None
+
+    with Image.open(io.BytesIO(raw)) as image:
+        if getattr(image, "is_animated", False):
+            return None
+        too_large = max_dimension and max(image.size) > max_dimension
+        if len(raw) <= max_bytes and not too_large:
+            return None
+
+        image.load()
+        if max_dimension:
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        image = image.convert("RGBA" if has_alpha else "RGB")
+        # 有透明通道的图片使用 WebP 以保留透明度，其余使用 JPEG
+        fmt, mime = ("WEBP", "image/webp") if has_alpha else ("JPEG", "image/jpeg")
+
+        # 逐步降低质量，必要时再缩小尺寸，直到满足大小上限
+        for _ in range(8):
+            buffer = io.BytesIO()
+            image.save(buffer, format=fmt, quality=quality, optimize=True)
+            output = buffer.getvalue()
+            if len(output) <= max_bytes:
+                break
+            if quality > 60:
+                quality -= 10
+            else:
+                image = image.resize((max(1, int(image.width * 0.8)), max(1, int(image.height * 0.8))), Image.LANCZOS)
+
+    if len(output) >= len(raw) and not too_large:
+        return None
+    return f"data:{mime};base64,{base64.b64encode(output).decode('ascii')}"
+
+
+class ImagePreprocessor:
+    """按内容哈希与处理参数缓存的图片缩放器。所有方法都应在主事件循环中调用。"""
+
+    def __init__(self, max_workers: int = 2, cache_bytes: int = 64 << 20):
+        self.max_workers = max_workers
+        self.cache_bytes = cache_bytes
+        self._executor: ProcessPoolExecutor | None = None
+        self._cache: OrderedDict[tuple, str | None] = OrderedDict() # (原图哈希, 处理参数) -> 处理后的 data URI（None 表示保持原样）
+        self._cache_size = 0
+        self._inflight: dict[tuple, asyncio.Future] = {}
+
+    @property
+    def available(self) -> bool:
+        return _PIL_AVAILABLE
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def _remember(self, key: tuple, result: str | None):
+        self._cache[key] = result
+        self._cache_size += len(result or "")
+        while self._cache_size > self.cache_bytes and len(self._cache) > 1:
+            _, old = self._cache.popitem(last=False)
+            self._cache_size -= len(old or "")
+
+    async def process(self, digest: str, load_data_uri, max_bytes: int, max_dimension: int = 0,
+                      quality: int = 85) -> str | None:
+        """
+        返回处理后的 data URI；图片不需要处理、无法处理或 Pillow 不可用时返回 None。
+        load_data_uri 是一个协程函数，只有在缓存未命中时才会被调用来取得原图。
+        """
+        if not self.available:
+            return None
+        key = (digest, max_bytes, max_dimension, quality)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        if key in self._inflight:
+            # 同一张图片正在以相同的参数被其他请求处理，直接等待其结果
+            return await asyncio.shield(self._inflight[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        result = None
+        try:
+            data_uri = await load_data_uri()
+            result = await asyncio.get_running_loop().run_in_executor(
+                self._get_executor(), _shrink_image, data_uri, max_bytes, max_dimension, quality
+            )
+            if result:
+                logger.info(f"图片预处理: {len(data_uri) / 1024:.0f} KB -> {len(result) / 1024:.0f} KB (data URI)。")
+        except Exception as e:
+            logger.warning(f"图片预处理失败，将上传原图: {e}")
+        finally:
+            del self._inflight[key]
+            future.set_result(result)
+        self._remember(key, result)
+        return result
+
+    @staticmethod
+    def supports(content_type: str) -> bool:
+        return content_type.lower() in _SUPPORTED_TYPES
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,149 @@
+# modules/image_scheduler.py
+# 文生图任务调度。
+#
+# 一个 n=10 的文生图请求会产生 10 个单张图片任务。如果它们同时发往同一个会话，
+# 很容易触发 LMArena 的频率限制，而 model_endpoint_map.json 中为该模型配置的其他会话却闲着。
+# ImageJobScheduler 为图片任务提供：
+#   - 全局并发上限：同时进行的图片任务总数；
+#   - 单会话并发上限：同一个会话上同时进行的任务数；
+#   - 先进先出的等待队列：按到达顺序放行，某个任务的候选会话都已满时，
+#     不会挡住后面可以使用其他会话的任务；
+#   - 会话分散：在有空位的候选会话中选择进行中任务最少（其次是最久未使用）的会话。
+
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+
+def session_key(entry) -> str:
+    return f"{entry.get('session_id')}|{entry.get('message_id')}"
+
+
+class _Job:
+    __slots__ = ("candidates", "future", "queued_at")
+
+    def __init__(self, candidates: list):
+        self.candidates = candidates
+        self.future = asyncio.get_running_loop().create_future()
+        self.queued_at = time.monotonic()
+
+
+class ImageJobScheduler:
+    """图片任务的并发控制与会话分配。除 configure 外，所有方法都应在主事件循环中调用。"""
+
+    def __init__(self, max_concurrent: int = 4, per_session_limit: int = 2):
+        self.max_concurrent = max_concurrent
+        self.per_session_limit = per_session_limit
+        self._queue: deque[_Job] = deque()
+        self._running = 0
+        self._per_session: dict[str, int] = {} # 会话 -> 进行中的任务数
+        self._last_used: dict[str, float] = {}
+        self._loop: asyncio.AbstractEventLoop | None = None # 等待中的任务所属的事件循环
+        self.completed = 0
+
+    def configure(self, max_concurrent: int, per_session_limit: int):
+        """
+        更新并发上限（0 表示不限制）。上限提高时立即放行等待中的任务。
+        可以在任意线程中调用：不在事件循环中时，会被转交给事件循环执行。
+        """
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            try:
+                on_loop = asyncio.get_running_loop() is loop
+            except RuntimeError:
+                on_loop = False
+            if not on_loop:
+                loop.call_soon_threadsafe(self._configure, max_concurrent, per_session_limit)
+                return
+        self._configure(max_concurrent, per_session_limit)
+
+    def _configure(self, max_concurrent: int, per_session_limit: int):
+        self.max_concurrent = max_concurrent
+        self.per_session_limit = per_session_limit
+        if self._queue:
+            self._dispatch()
+
+    def _pick(self, candidates: list):
+        """在有空位的候选会话中选择负载最低的一个，没有空位时返回 None。"""
+        best, best_rank = None, None
+        for entry in candidates:
+            key = session_key(entry)
+            load = self._per_session.get(key, 0)
+            if self.per_session_limit > 0 and load >= self.per_session_limit:
+                continue
+            rank = (load, self._last_used.get(key, 0.0))
+            if best_rank is None or rank < best_rank:
+                best, best_rank = entry, rank
+        return best
+
+    def _grant(self, entry):
+        key = session_key(entry)
+        self._running += 1
+        self._per_session[key] = self._per_session.get(key, 0) + 1
+        self._last_used[key] = time.monotonic()
+
+    def _release(self, entry):
+        key = session_key(entry)
+        self._running -= 1
+        self.completed += 1
+        remaining = self._per_session.get(key, 1) - 1
+        if remaining > 0:
+            self._per_session[key] = remaining
+        else:
+            self._per_session.pop(key, None)
+        self._dispatch()
+
+    def _dispatch(self):
+        """按先进先出的顺序放行等待中的任务，直到全局空位用完。"""
+        for job in list(self._queue):
+            if self.max_concurrent > 0 and self._running >= self.max_concurrent:
+                return
+            if job.future.done():
+                self._queue.remove(job)
+                continue
+            entry = self._pick(job.candidates)
+            if entry is not None:
+                self._queue.remove(job)
+                self._grant(entry)
+                job.future.set_result(entry)
+
+    @asynccontextmanager
+    async def slot(self, candidates: list):
+        """
+        等待一个空位并分配会话：async with scheduler.slot(entries) as entry: ...
+        candidates 为该模型可用的映射条目（至少包含 session_id 和 message_id）。
+        """
+        self._loop = asyncio.get_running_loop()
+        job = _Job(list(candidates))
+        self._queue.append(job)
+        self._dispatch()
+        try:
+            entry = await job.future
+        except asyncio.CancelledError:
+            if job.future.done() and not job.future.cancelled():
+                # 刚被放行就被取消：归还空位
+                self._release(job.future.result())
+            elif job in self._queue:
+                self._queue.remove(job)
+            raise
+        waited = time.monotonic() - job.queued_at
+        if waited > 1:
+            logger.info(f"IMAGE SCHEDULER: 任务排队 {waited:.1f} 秒后被分配到会话 ...{str(entry.get('session_id'))[-6:]}。")
+        try:
+            yield entry
+        finally:
+            self._release(entry)
+
+    def stats(self) -> dict:
+        return {
+            "running": self._running,
+            "queued": len(self._queue),
+            "completed": self.completed,
+            "max_concurrent": self.max_concurrent,
+            "per_session_limit": self.per_session_limit,
+            "sessions": dict(self._per_session),
+        }
@@ -0,0 +1,189 @@
+# modules/metrics.py
+# Prometheus 文本格式的指标。
+#
+# 为了不增加依赖，这里实现了一个极简的指标注册表（计数器、直方图和按需计算的回调指标），
+# 由 /metrics 端点以 Prometheus 文本格式 (text/plain; version=0.0.4) 输出。
+# 热路径上的开销只有一次字典查找和加法（直方图另加一次二分查找），
+# 存活通道数、标签页数量等状态则在抓取时才通过回调计算。
+
+import bisect
+import math
+import time
+from typing import Callable
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 默认的时间直方图分桶（秒）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 21, 34, 60, 120, 300)
+GAP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+TOKEN_BUCKETS = (16, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: tuple = LATENCY_BUCKETS,
+                 labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple, list] = {} # 标签 -> [各分桶计数..., +Inf 计数, 总和]
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), series):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(series[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class CallbackMetric:
+    """抓取时才调用 fn 计算的指标。fn 返回一个数值，或 {标签值元组: 数值} 字典。"""
+
+    def __init__(self, name: str, documentation: str, fn: Callable, kind: str = "gauge",
+                 labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.fn = fn
+        self.kind = kind
+        self.labelnames = labelnames
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        value = self.fn()
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        for labels, v in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(v)}")
+        return lines
+
+
+class BridgeMetrics:
+    """桥接服务的全部指标。所有方法都应在主事件循环中调用。"""
+
+    def __init__(self):
+        self._metrics: list = []
+        self.chat_requests = self.counter(
+            "bridge_chat_requests_total", "聊天补全请求数，按模型和（等效的）HTTP 状态码统计。", ("model", "status"))
+        self.time_to_first_token = self.histogram(
+            "bridge_chat_time_to_first_token_seconds", "从收到请求到产生第一个内容块的时间。", LATENCY_BUCKETS, ("model",))
+        self.duration = self.histogram(
+            "bridge_chat_duration_seconds", "聊天补全请求的总耗时。", LATENCY_BUCKETS, ("model",))
+        self.chunk_gap = self.histogram(
+            "bridge_chat_chunk_gap_seconds", "相邻两个内容块之间的间隔。", GAP_BUCKETS)
+        self.response_tokens = self.histogram(
+            "bridge_chat_response_tokens", "每个响应的 token 数（按字符数 / 4 估算）。", TOKEN_BUCKETS, ("model",))
+        self.upstream_errors = self.counter(
+            "bridge_upstream_errors_total", "上游错误数，按类型统计 (cloudflare / attachment_too_large / timeout / other)。", ("kind",))
+        self.ws_frames = self.counter(
+            "bridge_ws_frames_total", "从油猴脚本收到的 WebSocket 帧数，按协议统计。", ("protocol",))
+        self.ws_records = self.counter(
+            "bridge_ws_records_total", "从油猴脚本收到的响应数据块数。")
+        self.browser_connections = self.counter(
+            "bridge_browser_connections_total", "油猴脚本 WebSocket 连接次数。")
+        self.browser_disconnections = self.counter(
+            "bridge_browser_disconnections_total", "油猴脚本 WebSocket 断开次数。")
+        self.image_requests = self.counter(
+            "bridge_image_requests_total", "文生图的单张图片请求数，按结果统计。", ("status",))
+        self.image_duration = self.histogram(
+            "bridge_image_duration_seconds", "单张图片生成的耗时。", LATENCY_BUCKETS)
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, buckets: tuple = LATENCY_BUCKETS,
+                  labelnames: tuple = ()) -> Histogram:
+        metric = Histogram(name, documentation, buckets, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def callback(self, name: str, documentation: str, fn: Callable, kind: str = "gauge",
+                 labelnames: tuple = ()) -> CallbackMetric:
+        metric = CallbackMetric(name, documentation, fn, kind, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    async def observe_chat(self, events, model: str, started_at: float):
+        """
+        透传一个聊天响应的内部事件流，并记录首字延迟、块间隔、token 数、总耗时和结果。
+        结果按客户端实际收到的等效状态码统计：200 正常结束，413/500 出错（与非流式响应一致），
+        499 客户端在结束前断开。
+        """
+        first_at = last_at = None
+        chars = 0
+        status = "499"
+        try:
+            async for event_type, data in events:
+                if event_type == 'content':
+                    now = time.monotonic()
+                    if first_at is None:
+                        first_at = now
+                        self.time_to_first_token.observe(now - started_at, model)
+                    else:
+                        self.chunk_gap.observe(now - last_at)
+                    last_at = now
+                    chars += len(data)
+                elif event_type == 'error':
+                    status = "413" if "附件大小超过了" in str(data) else "500"
+                yield event_type, data
+            if status == "499":
+                status = "200"
+        finally:
+            self.chat_requests.inc(model, status)
+            self.duration.observe(time.monotonic() - started_at, model)
+            if status == "200":
+                self.response_tokens.observe(chars / 4, model)
@@ -0,0 +1,98 @@
+# modules/model_catalog.py
+# 预先构建的 /v1/models 响应。
+#
+# 有些客户端每隔几秒就请求一次模型列表。ModelCatalog 只在配置快照中的 models.json、
+# models_metadata.json 或 model_endpoint_map.json 变化时重新构建响应，
+# 把序列化好的字节和对应的 ETag 一起发布；请求时直接返回这些字节，
+# 带有匹配 If-None-Match 的请求返回 304，不需要任何序列化。
+#
+# models_metadata.json 由 /update_models 根据页面中提取到的模型数据生成（组织、提供方、能力、
+# 首次出现的时间），没有元数据的模型只输出基本字段。
+
+import hashlib
+import logging
+import os
+import time
+from dataclasses import dataclass
+
+from modules.config_store import thaw
+from modules.streaming import dumps_bytes
+
+logger = logging.getLogger(__name__)
+
+# 参与构建 /v1/models 的快照字段
+CATALOG_FIELDS = {"models", "model_metadata", "model_endpoint_map"}
+
+
+@dataclass(frozen=True)
+class ModelList:
+    """序列化好的 /v1/models 响应。"""
+    body: bytes
+    etag: str
+    count: int
+
+
+def model_metadata_entry(model: dict, created: int) -> dict:
+    """从页面提取到的模型数据中取出 /v1/models 需要的字段。"""
+    entry = {"created": created}
+    for key in ("organization", "provider", "capabilities"):
+        if model.get(key) is not None:
+            entry[key] = model[key]
+    return entry
+
+
+def build_model_list(snapshot, created_fallback: int) -> ModelList | None:
+    """根据配置快照构建模型列表，模型列表为空时返回 None。"""
+    if not snapshot.models:
+        return None
+    data = []
+    for model_name, model_id in snapshot.models.items():
+        metadata = snapshot.model_metadata.get(model_name) or {}
+        item = {
+            "id": model_name,
+            "object": "model",
+            "created": metadata.get("created") or created_fallback,
+            "owned_by": metadata.get("organization") or "LMArenaBridge",
+            "lmarena_id": model_id,
+            "mapped": model_name in snapshot.model_endpoint_map,
+        }
+        for key in ("organization", "provider", "capabilities"):
+            if metadata.get(key) is not None:
+                item[key] = thaw(metadata[key]) # 快照中的值是只读映射，转换后才能序列化
+        data.append(item)
+    body = dumps_bytes({"object": "list", "data": data})
+    etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+    return ModelList(body=body, etag=etag, count=len(data))
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """判断 If-None-Match 请求头是否包含 etag（忽略弱校验前缀 W/）。"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.removeprefix('W/') == etag:
+            return True
+    return False
+
+
+class ModelCatalog:
+    """持有当前的 /v1/models 响应，在相关快照字段变化时重新构建。"""
+
+    def __init__(self, models_path: str = "models.json"):
+        self.models_path = models_path
+        self.current: ModelList | None = None
+        self.builds = 0
+
+    def on_snapshot(self, snapshot, changed: set[str]):
+        """配置快照监听器（在事件循环中调用）。"""
+        if self.current is not None and not (changed & CATALOG_FIELDS):
+            return
+        try:
+            created_fallback = int(os.stat(self.models_path).st_mtime)
+        except OSError:
+            created_fallback = int(time.time())
+        self.current = build_model_list(snapshot, created_fallback)
+        self.builds += 1
+        if self.current is not None:
+            logger.info(f"模型列表: 已构建 /v1/models 响应，包含 {self.current.count} 个模型。")
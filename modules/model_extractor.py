@@ -0,0 +1,181 @@
+# modules/model_extractor.py
+# 从 LMArena 页面 HTML 中提取模型列表。
+#
+# 页面由 Next.js 渲染，模型数据位于某个 <script>self.__next_f.push([1,"..."])</script> 中
+# 以 JS 字符串转义的 RSC 载荷里：...\"initialState\":[{\"id\":...,\"publicName\":...}, ...]...
+# 旧的做法是用 DOTALL 正则遍历整个文档的每一个 <script>，再解析整行 JSON 并递归查找。
+# extract_models 直接定位 "initialState" 出现的位置，只解码包含它的那一个 push 字符串，
+# 再用 raw_decode 只解析 initialState 的数组本身。定位失败时退回到旧的完整解析。
+#
+# 这些函数都是同步的 CPU 密集型操作。放在工作线程中并不能让出事件循环：解码、查找与 JSON 解析
+# 都在持有 GIL 的 C 代码中进行，对几 MB 的页面来说事件循环仍会停顿数毫秒。
+# ModelExtractionPool 在子进程中提取，页面通过临时文件传递，服务器进程不需要序列化几 MB 的数据。
+
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+_ANCHOR = 'initialState'
+_PUSH_PREFIX = 'self.__next_f.push([1,"'
+# JS 字符串字面量的内容（展开的循环写法，对几 MB 的字符串也是线性时间）
+_JS_STRING_BODY = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+_DECODER = json.JSONDecoder()
+
+
+def _is_model_list(value) -> bool:
+    return isinstance(value, list) and bool(value) and isinstance(value[0], dict) and 'publicName' in value[0]
+
+
+def _find_in_payload(payload: str):
+    """在解码后的 RSC 载荷中查找 "initialState":[...]，只解析这个数组。"""
+    key = f'"{_ANCHOR}":'
+    position = 0
+    while (found := payload.find(key, position)) != -1:
+        position = found + len(key)
+        start = position
+        while start < len(payload) and payload[start] in ' \t\r\n':
+            start += 1
+        try:
+            value, _end = _DECODER.raw_decode(payload, start)
+        except ValueError:
+            continue
+        if _is_model_list(value):
+            return value
+    return None
+
+
+def _scan(html: str):
+    """定位包含 initialState 的 push 字符串并从中提取模型列表。"""
+    position = 0
+    while (anchor := html.find(_ANCHOR, position)) != -1:
+        start = html.rfind(_PUSH_PREFIX, 0, anchor)
+        if start == -1:
+            position = anchor + len(_ANCHOR)
+            continue
+        start += len(_PUSH_PREFIX)
+        body = _JS_STRING_BODY.match(html, start)
+        end = body.end()
+        position = max(end, anchor + len(_ANCHOR))
+        if end < anchor:
+            continue # 该 initialState 不在这个 push 字符串中
+        try:
+            payload = json.loads('"' + body.group() + '"')
+        except ValueError:
+            continue
+        models = _find_in_payload(payload)
+        if models:
+            return models
+    return None
+
+
+def _find_initial_state(obj):
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if key == _ANCHOR and _is_model_list(value):
+                return value
+            result = _find_initial_state(value)
+            if result is not None:
+                return result
+    elif isinstance(obj, list):
+        for item in obj:
+            result = _find_initial_state(item)
+            if result is not None:
+                return result
+    return None
+
+
+def extract_models_legacy(html_content: str):
+    """旧版的完整解析：正则遍历每个 <script>，解析整行 JSON 后递归查找 initialState。"""
+    script_contents = re.findall(r'<script>(.*?)</script>', html_content, re.DOTALL)
+
+    for script_content in script_contents:
+        if 'self.__next_f.push' in script_content and 'initialState' in script_content and 'publicName' in script_content:
+            match = re.search(r'self\.__next_f\.push\(\[1,"(.*?)"\]\)', script_content, re.DOTALL)
+            if not match:
+                continue
+
+            payload_string = match.group(1).split('\\n')[0]
+            json_start_index = payload_string.find(':')
+            if json_start_index == -1:
+                continue
+
+            json_string = payload_string[json_start_index + 1:].replace('\\"', '"')
+            try:
+                models = _find_initial_state(json.loads(json_string))
+                if models:
+                    return models
+            except json.JSONDecodeError as e:
+                logger.error(f"解析提取的JSON字符串时出错: {e}")
+                continue
+    return None
+
+
+def extract_models(html) -> list | None:
+    """从页面 HTML（str 或 bytes）中提取模型列表，找不到时返回 None。"""
+    if isinstance(html, (bytes, bytearray)):
+        html = html.decode('utf-8', errors='replace')
+    models = _scan(html)
+    if models is None and _ANCHOR in html:
+        models = extract_models_legacy(html)
+        if models:
+            logger.warning("模型提取: 快速定位失败，已通过完整解析提取到模型。")
+    if models:
+        logger.info(f"成功从页面中提取到 {len(models)} 个模型。")
+    else:
+        logger.error("错误：在HTML响应中找不到包含有效模型数据的脚本块。")
+    return models
+
+
+def _extract_models_from_file(path: str) -> list | None:
+    """在子进程中运行：读取临时文件中的页面并提取模型列表。"""
+    with open(path, 'rb') as f:
+        return extract_models(f.read())
+
+
+class ModelExtractionPool:
+    """在子进程中提取模型列表。extract() 是阻塞的，应当在工作线程中调用。"""
+
+    def __init__(self):
+        self._executor: ProcessPoolExecutor | None = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # 在调用 extract() 的工作线程中第一次启动子进程，不占用事件循环
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=1)
+            return self._executor
+
+    def extract(self, chunks: list[bytes]) -> list | None:
+        """
+        把页面的各个分块写入临时文件，在子进程中提取模型列表。
+        子进程不可用时（例如异常退出）在当前线程中提取。
+        """
+        fd, path = tempfile.mkstemp(prefix="lmarena-page-", suffix=".html")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            try:
+                return self._get_executor().submit(_extract_models_from_file, path).result()
+            except Exception as e:
+                logger.warning(f"模型提取: 子进程提取失败，改为在当前线程中提取: {e}")
+                self.shutdown()
+                return extract_models(b"".join(chunks))
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
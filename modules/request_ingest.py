@@ -0,0 +1,214 @@
+# modules/request_ingest.py
+# 大型多模态请求体的流式解析。
+#
+# `await request.json()` 需要先把整个请求体读入内存再解析，几张 5MB 的图片就会在内存中
+# 同时存在多份副本。SpoolingJSONReader 按块读取请求体：所有以 "data:" 开头的 JSON 字符串
+# （即 base64 data URI）在到达时就被写入临时文件 (SpooledData)，并顺带计算内容哈希；
+# 剩余的小体积 JSON 才会被解析为字典。解析完成后，messages[].content[].image_url.url
+# 是一个 SpooledData 对象，其他位置的 data: 字符串会被还原为普通字符串。
+
+import codecs
+import hashlib
+import json
+import tempfile
+import uuid
+
+_DATA_PREFIX = b'data:'
+_OUTSIDE, _IN_STRING, _IN_SPOOL = 0, 1, 2
+
+
+class SpooledData:
+    """一个被暂存到临时文件（小于阈值时在内存中）的 data URI 字符串。"""
+
+    def __init__(self, max_memory: int = 1 << 20):
+        self._file = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        self._hash = hashlib.sha256()
+        self._head = b""
+        self.size = 0 # 字节数（data URI 是 ASCII，因此也等于字符数）
+        self.has_escapes = False
+        self.digest = None # 与 attachment_cache.attachment_hash 相同的 SHA-256 十六进制摘要
+
+    def write(self, segment: bytes):
+        if not segment:
+            return
+        if b'\\' in segment:
+            self.has_escapes = True
+        self._file.write(segment)
+        self._hash.update(segment)
+        self.size += len(segment)
+        if len(self._head) < 256:
+            self._head += segment[:256 - len(self._head)]
+
+    def finish(self):
+        """字符串结束：处理 JSON 转义（极少见，例如 "\\/"）并计算最终摘要。"""
+        if self.has_escapes:
+            self._file.seek(0)
+            text = json.loads(b'"' + self._file.read() + b'"')
+            raw = text.encode('utf-8')
+            self._file.seek(0)
+            self._file.truncate()
+            self._file.write(raw)
+            self._hash = hashlib.sha256(raw)
+            self.size = len(raw)
+            self._head = raw[:256]
+        self.digest = self._hash.hexdigest()
+
+    @property
+    def head(self) -> str:
+        """data URI 的开头部分，用于解析 MIME 类型（如 "data:image/png;base64,..."）。"""
+        return self._head.decode('utf-8', 'replace')
+
+    def read_text(self) -> str:
+        """读取完整内容（会阻塞，请在线程中调用）。"""
+        self._file.seek(0)
+        return self._file.read().decode('utf-8')
+
+    def iter_text(self, chunk_size: int):
+        """按块读取内容，不会把多字节字符截断在块边界上（会阻塞）。"""
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        self._file.seek(0)
+        while True:
+            raw = self._file.read(chunk_size)
+            text = decoder.decode(raw, final=not raw)
+            if text:
+                yield text
+            if not raw:
+                break
+
+    def close(self):
+        self._file.close()
+
+    def __repr__(self):
+        return f"<SpooledData {self.head[:32]}... size={self.size}>"
+
+
+class SpoolingJSONReader:
+    """增量读取 JSON 请求体，将 data: 字符串暂存到临时文件。"""
+
+    def __init__(self, spool_max_memory: int = 1 << 20):
+        self.spool_max_memory = spool_max_memory
+        self.spooled: list[SpooledData] = []
+        self._token = uuid.uuid4().hex
+        self._out = bytearray() # 去掉了 data: 字符串的 JSON 文本
+        self._pending = b"" # 还不足以判断字符串类型的尾部字节
+        self._state = _OUTSIDE
+        self._backslashes = 0 # 跨块的连续反斜杠数量
+        self._current: SpooledData | None = None
+
+    def _placeholder(self, index: int) -> bytes:
+        return f'"\\u0000spool:{self._token}:{index}"'.encode('ascii')
+
+    def _find_string_end(self, data: bytes, pos: int) -> int:
+        """查找字符串中下一个未被转义的引号，找不到时返回 -1 并记录尾部的反斜杠数量。"""
+        carried = self._backslashes
+        while True:
+            quote = data.find(b'"', pos)
+            if quote < 0:
+                stripped = data[pos:].rstrip(b'\\')
+                trailing = len(data) - pos - len(stripped)
+                self._backslashes = carried + trailing if not stripped else trailing
+                return -1
+            segment = data[pos:quote]
+            stripped = segment.rstrip(b'\\')
+            count = len(segment) - len(stripped)
+            if not stripped:
+                count += carried
+            if count % 2 == 0:
+                self._backslashes = 0
+                return quote
+            carried = 0
+            pos = quote + 1
+
+    def feed(self, chunk: bytes, final: bool = False):
+        data = self._pending + chunk if self._pending else chunk
+        self._pending = b""
+        pos, end = 0, len(data)
+        while pos < end:
+            if self._state == _OUTSIDE:
+                quote = data.find(b'"', pos)
+                if quote < 0:
+                    self._out += data[pos:]
+                    return
+                self._out += data[pos:quote]
+                if end - quote - 1 < len(_DATA_PREFIX) and not final:
+                    # 需要更多字节才能判断这是不是一个 data: 字符串
+                    self._pending = data[quote:]
+                    return
+                if data.startswith(_DATA_PREFIX, quote + 1):
+                    self._current = SpooledData(self.spool_max_memory)
+                    self._state = _IN_SPOOL
+                else:
+                    self._out += b'"'
+                    self._state = _IN_STRING
+                self._backslashes = 0
+                pos = quote + 1
+                continue
+
+            close = self._find_string_end(data, pos)
+            segment = data[pos:close if close >= 0 else end]
+            if self._state == _IN_STRING:
+                self._out += segment
+            else:
+                self._current.write(segment)
+            if close < 0:
+                return
+            if self._state == _IN_STRING:
+                self._out += b'"'
+            else:
+                self._current.finish()
+                self._out += self._placeholder(len(self.spooled))
+                self.spooled.append(self._current)
+                self._current = None
+            self._state = _OUTSIDE
+            pos = close + 1
+
+    def close(self) -> dict:
+        """结束读取并返回解析后的对象。JSON 无效时抛出 ValueError。"""
+        if self._pending:
+            self.feed(b"", final=True)
+        if self._state != _OUTSIDE:
+            raise ValueError("请求体中的 JSON 字符串没有结束。")
+        result = json.loads(self._out)
+        self._out = bytearray()
+        return self._restore(result, None, None)
+
+    def _restore(self, obj, key, parent_key):
+        """把占位符替换回来：image_url.url 保留为 SpooledData，其他位置还原为字符串。"""
+        if isinstance(obj, dict):
+            restored = {}
+            for k, v in obj.items():
+                k = self._restore(k, None, None) # 对象的键也可能恰好以 "data:" 开头
+                restored[k] = self._restore(v, k, key)
+            return restored
+        if isinstance(obj, list):
+            return [self._restore(item, key, parent_key) for item in obj]
+        if isinstance(obj, str) and obj.startswith("\x00spool:"):
+            _, token, index = obj.split(":", 2)
+            if token == self._token:
+                spooled = self.spooled[int(index)]
+                if key == "url" and parent_key == "image_url":
+                    return spooled
+                return spooled.read_text()
+        return obj
+
+    def discard(self):
+        """释放所有临时文件。"""
+        if self._current:
+            self._current.close()
+        for spooled in self.spooled:
+            spooled.close()
+
+
+async def read_json_body(request, spool_max_memory: int = 1 << 20) -> tuple[dict, list[SpooledData]]:
+    """
+    以流的方式读取并解析请求体。返回 (解析后的对象, 暂存的附件列表)。
+    调用方用完后应当对暂存的附件调用 close()。JSON 无效时抛出 ValueError。
+    """
+    reader = SpoolingJSONReader(spool_max_memory)
+    try:
+        async for chunk in request.stream():
+            reader.feed(chunk)
+        return reader.close(), reader.spooled
+    except BaseException:
+        reader.discard()
+        raise
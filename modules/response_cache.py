@@ -0,0 +1,185 @@
+# modules/response_cache.py
+# 精确匹配的响应缓存。
+#
+# 对于完全相同的请求（评测脚本、重试等），没有必要再经过浏览器和 LMArena 走一遍。
+# 缓存键是 convert_openai_to_lmarena_payload 输出的规范化形式加上模型名称：
+# 附件只以内容哈希参与计算，自动生成的随机文件名不参与计算。
+# 命中时，事件流 ('content', ...), ('finish', ...) 会被原样重放给
+# stream_generator / non_stream_response，因此客户端看到的格式与正常响应完全相同。
+# 客户端可以通过 Cache-Control 请求头绕过缓存：
+#   no-cache  不读取缓存，但会用新的响应更新缓存
+#   no-store  既不读取也不写入缓存
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+
+from modules.attachment_cache import attachment_hash
+from modules.request_ingest import SpooledData
+
+logger = logging.getLogger(__name__)
+
+MODE_DEFAULT = "default"
+MODE_NO_CACHE = "no-cache"
+MODE_NO_STORE = "no-store"
+
+
+def cache_mode(cache_control: str | None) -> str:
+    """解析请求的 Cache-Control 头。"""
+    directives = {d.strip().lower() for d in (cache_control or "").split(",")}
+    if "no-store" in directives:
+        return MODE_NO_STORE
+    if "no-cache" in directives or "max-age=0" in directives:
+        return MODE_NO_CACHE
+    return MODE_DEFAULT
+
+
+def _attachment_key(attachment: dict) -> dict:
+    url = attachment.get("url")
+    if isinstance(url, SpooledData):
+        digest = url.digest
+    elif isinstance(url, str):
+        digest = attachment_hash(url)
+    else:
+        digest = attachment.get("hash") or attachment.get("ref")
+    return {"contentType": attachment.get("contentType"), "digest": digest}
+
+
+def make_cache_key(model: str, lmarena_payload: dict) -> str:
+    """根据模型名称和转换后的 LMArena 载荷计算缓存键。"""
+    normalized = {
+        "model": model,
+        "target_model_id": lmarena_payload.get("target_model_id"),
+        "session_id": lmarena_payload.get("session_id"),
+        "message_id": lmarena_payload.get("message_id"),
+        "messages": [
+            {
+                "role": template.get("role"),
+                "content": template.get("content"),
+                "participantPosition": template.get("participantPosition"),
+                "attachments": [_attachment_key(a) for a in template.get("attachments") or ()],
+            }
+            for template in lmarena_payload.get("message_templates", [])
+        ],
+    }
+    encoded = json.dumps(normalized, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+@dataclass
+class CachedResponse:
+    content: str
+    finish_reason: str = "stop"
+    model: str = ""
+    created_at: float = field(default_factory=time.time)
+
+
+async def replay(entry: CachedResponse):
+    """将缓存的响应重放为内部事件流，与 _process_lmarena_stream 的输出格式相同。"""
+    yield 'content', entry.content
+    yield 'finish', entry.finish_reason
+
+
+class ResponseCache:
+    """LRU + TTL 的响应缓存，可选地持久化到磁盘。所有方法都应在主事件循环中调用。"""
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600.0, disk_dir: str | None = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_dir = disk_dir or None
+        self._entries: OrderedDict[str, CachedResponse] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _expired(self, entry: CachedResponse, now: float) -> bool:
+        return now - entry.created_at > self.ttl
+
+    def _read_disk(self, key: str) -> CachedResponse | None:
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                return CachedResponse(**json.load(f))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(f"读取响应缓存文件失败: {e}")
+            return None
+
+    def _write_disk(self, key: str, entry: CachedResponse):
+        try:
+            tmp_path = self._path(key) + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(asdict(entry), f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            logger.warning(f"写入响应缓存文件失败: {e}")
+
+    def _remove_disk(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    async def get(self, key: str) -> CachedResponse | None:
+        """查找缓存。内存命中不涉及任何 I/O；启用磁盘缓存时，内存未命中会再查找磁盘。"""
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is None and self.disk_dir:
+            entry = await asyncio.to_thread(self._read_disk, key)
+            if entry is not None and not self._expired(entry, now):
+                self._store_memory(key, entry)
+        if entry is not None and self._expired(entry, now):
+            self._entries.pop(key, None)
+            if self.disk_dir:
+                asyncio.get_running_loop().run_in_executor(None, self._remove_disk, key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def _store_memory(self, key: str, entry: CachedResponse):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def put(self, key: str, entry: CachedResponse):
+        self._store_memory(key, entry)
+        if self.disk_dir:
+            asyncio.get_running_loop().run_in_executor(None, self._write_disk, key, entry)
+
+    async def record(self, events, key: str, model: str):
+        """
+        透传内部事件流，并在流完整、成功地结束后把响应写入缓存。
+        出错、被内容审查终止或客户端中途断开的响应不会被缓存。
+        """
+        parts: list[str] = []
+        finish_reason = "stop"
+        cacheable = True
+        async for event_type, data in events:
+            if event_type == 'content':
+                parts.append(data)
+            elif event_type == 'finish':
+                finish_reason = data
+                if data == 'content-filter':
+                    cacheable = False
+            elif event_type == 'error':
+                cacheable = False
+            yield event_type, data
+        if cacheable and parts:
+            self.put(key, CachedResponse("".join(parts), finish_reason, model))
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
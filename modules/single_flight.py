@@ -0,0 +1,143 @@
+# modules/single_flight.py
+# 相同请求的合并 (single-flight)。
+#
+# 多个客户端几乎同时发送完全相同的请求时（例如并行的评测 worker），
+# 没有必要让每个请求都占用一个标签页、各自请求一次上游。SingleFlight 按请求键
+# 记录正在进行的上游流：第一个请求（leader）启动上游，之后到达的相同请求只订阅它的事件。
+# 每个订阅者都从头开始收到完整的事件序列，由各自的 stream_generator / non_stream_response
+# 独立格式化；订阅者可以单独取消（其事件流以 ClientDisconnected 结束），
+# 只有当所有订阅者都离开时，上游流才会被取消。
+
+import asyncio
+import logging
+
+from modules.channels import ClientDisconnected
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """一个订阅者。events() 产出上游的全部事件；cancel() 让该订阅者的 events() 立即抛出 ClientDisconnected。"""
+
+    def __init__(self, flight: "Flight"):
+        self._flight = flight
+        self._cancelled = False
+        self._active = True
+        flight.subscribers += 1
+
+    @property
+    def leader_id(self) -> str:
+        """启动上游流的请求 ID。"""
+        return self._flight.request_id
+
+    def _leave(self):
+        if self._active:
+            self._active = False
+            self._flight._unsubscribe()
+
+    def cancel(self):
+        """客户端已断开：停止接收事件。如果这是最后一个订阅者，上游流会被取消。"""
+        self._cancelled = True
+        self._leave()
+        self._flight._wake()
+
+    async def events(self):
+        flight = self._flight
+        index = 0
+        try:
+            while not self._cancelled:
+                while index < len(flight.events):
+                    yield flight.events[index]
+                    index += 1
+                if flight.done:
+                    return
+                await flight._changed.wait()
+            raise ClientDisconnected("客户端已断开连接")
+        finally:
+            self._leave()
+
+
+class Flight:
+    """一个正在进行的上游流及其已产生的事件。"""
+
+    def __init__(self, key: str, request_id: str):
+        self.key = key
+        self.request_id = request_id
+        self.events: list[tuple[str, object]] = []
+        self.done = False
+        self.subscribers = 0
+        self.joined = 0 # 合并到此上游流的后续请求数
+        self.task: asyncio.Task | None = None
+        self._changed = asyncio.Event()
+
+    def _wake(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _unsubscribe(self):
+        self.subscribers -= 1
+        if self.subscribers <= 0 and not self.done and self.task is not None:
+            logger.info(f"SINGLE-FLIGHT [ID: {self.request_id[:8]}]: 所有订阅者都已离开，取消上游流。")
+            self.task.cancel()
+
+    async def _pump(self, source):
+        try:
+            async for event in source:
+                self.events.append(event)
+                self._wake()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"SINGLE-FLIGHT [ID: {self.request_id[:8]}]: 上游流出错: {e}", exc_info=True)
+            self.events.append(('error', str(e)))
+        finally:
+            self.done = True
+            self._wake()
+
+
+class SingleFlight:
+    """按请求键登记正在进行的上游流。所有方法都应在主事件循环中调用。"""
+
+    def __init__(self):
+        self._flights: dict[str, Flight] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    def join(self, key: str) -> Subscription | None:
+        """如果相同的请求正在进行，订阅它并返回订阅；否则返回 None。"""
+        flight = self._flights.get(key)
+        if flight is None or flight.done:
+            return None
+        flight.joined += 1
+        self.coalesced += 1
+        return Subscription(flight)
+
+    def start(self, key: str, request_id: str, source) -> Subscription:
+        """
+        以 source（内部事件流）启动一个新的上游流，并返回 leader 的订阅。
+        上游流在独立的任务中运行，不受任何单个订阅者被取消的影响。
+        """
+        flight = Flight(key, request_id)
+        subscription = Subscription(flight)
+        self._flights[key] = flight
+        self.started += 1
+        flight.task = asyncio.create_task(flight._pump(source))
+        flight.task.add_done_callback(lambda _: self._finish(flight))
+        return subscription
+
+    def _finish(self, flight: Flight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+        if flight.joined:
+            logger.info(f"SINGLE-FLIGHT [ID: {flight.request_id[:8]}]: 上游流结束，共有 {flight.joined} 个相同请求被合并。")
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._flights),
+            "started": self.started,
+            "coalesced": self.coalesced,
+            "flights": [
+                {"request_id": f.request_id, "subscribers": f.subscribers, "joined": f.joined, "events": len(f.events)}
+                for f in self._flights.values()
+            ],
+        }
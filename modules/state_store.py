@@ -0,0 +1,240 @@
+# modules/state_store.py
+# config.jsonc / models.json 等状态文件的原子写入。
+#
+# 服务器（config_store）和 id_updater.py 会随时读取这些文件。直接用 open(..., 'w') 覆盖时，
+# 读取方可能恰好读到被截断或只写了一半的文件。这里的写入总是：
+#   写入同目录下的临时文件 -> fsync -> os.replace 替换原文件 -> fsync 目录，
+# 读取方只会看到完整的旧文件或完整的新文件。
+#
+# 在事件循环中使用 StateWriter：写入在工作线程中进行，短时间内对同一个文件的多次修改
+# 会被合并为一次读取-修改-写入（按提交顺序依次应用每个修改）。
+
+import asyncio
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# 同一进程内对同一文件的读取-修改-写入互斥
+_path_locks: dict[str, threading.Lock] = {}
+_path_locks_guard = threading.Lock()
+
+
+def _lock_for(path: str) -> threading.Lock:
+    with _path_locks_guard:
+        lock = _path_locks.get(path)
+        if lock is None:
+            lock = _path_locks[path] = threading.Lock()
+        return lock
+
+
+def _replace(src: str, dst: str, attempts: int = 5):
+    # Windows 上目标文件正被其他进程读取时 os.replace 会短暂失败，稍后重试
+    for attempt in range(attempts):
+        try:
+            os.replace(src, dst)
+            return
+        except PermissionError:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(0.05 * (attempt + 1))
+
+
+def _fsync_directory(directory: str):
+    if os.name == 'nt':
+        return # Windows 不支持对目录 fsync
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write_text(path: str, text: str):
+    """原子地用 text 替换文件内容（保留原文件的权限）。会做阻塞 I/O。"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+        except OSError:
+            pass # 原文件不存在时使用默认权限
+        _replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    _fsync_directory(directory)
+
+
+def atomic_write_json(path: str, data, indent: int = 4):
+    atomic_write_text(path, json.dumps(data, indent=indent, ensure_ascii=False))
+
+
+def update_text_file(path: str, transform: Callable[[str], str]) -> bool:
+    """
+    读取-修改-原子写入。transform 接收当前内容（文件不存在时为空字符串）并返回新内容。
+    内容没有变化时不写入并返回 False。会做阻塞 I/O。
+    """
+    with _lock_for(os.path.abspath(path)):
+        try:
+            with open(path, 'r', encoding='utf-8', newline='') as f:
+                content = f.read()
+        except FileNotFoundError:
+            content = ""
+        new_content = transform(content)
+        if new_content == content:
+            return False
+        atomic_write_text(path, new_content)
+        return True
+
+
+def _jsonc_value_pattern(key: str) -> re.Pattern:
+    # "key": 后面的一个 JSON 字符串，或直到逗号 / 换行 / 右花括号的标量值
+    return re.compile(rf'("{re.escape(key)}"\s*:\s*)(?:"(?:[^"\\\n]|\\.)*"|[^,\n}}]+)')
+
+
+def set_jsonc_values(content: str, values: dict, add_missing: bool = True) -> str:
+    """
+    在 JSONC 文本中替换各键的值，保留注释与格式。值按 JSON 编码。
+    找不到的键在 add_missing 为 True 时追加到最外层对象末尾，否则抛出 KeyError。
+    """
+    for key, value in values.items():
+        encoded = json.dumps(value, ensure_ascii=False)
+        content, count = _jsonc_value_pattern(key).subn(lambda m: m.group(1) + encoded, content, 1)
+        if count:
+            continue
+        if not add_missing:
+            raise KeyError(key)
+        end = content.rfind('}')
+        if end == -1:
+            content = f'{{\n  "{key}": {encoded}\n}}\n'
+            continue
+        body = content[:end].rstrip()
+        separator = "" if body.endswith(('{', ',')) else ","
+        content = f'{body}{separator}\n  "{key}": {encoded}\n{content[end:]}'
+    return content
+
+
+def update_jsonc_values(path: str, values: dict, add_missing: bool = True) -> bool:
+    """原子地更新 JSONC 文件中的若干个键。会做阻塞 I/O。"""
+    return update_text_file(path, lambda content: set_jsonc_values(content, values, add_missing))
+
+
+class _PendingWrite:
+    __slots__ = ("transforms", "future", "handle")
+
+    def __init__(self, future: asyncio.Future):
+        self.transforms: list[Callable[[str], str]] = []
+        self.future = future
+        self.handle: asyncio.TimerHandle | None = None
+
+
+class StateWriter:
+    """
+    在事件循环中提交状态文件的修改：等待 delay 秒收集同一文件的后续修改，
+    然后在工作线程中一次性应用并原子写入。同一文件的写入按提交顺序串行进行。
+    所有方法都应在主事件循环中调用。
+    """
+
+    def __init__(self, delay: float = 0.2):
+        self.delay = delay
+        self._pending: dict[str, _PendingWrite] = {}
+        self._writing: dict[str, asyncio.Task] = {}
+        self.writes = 0
+        self.coalesced = 0
+        self.failures = 0
+
+    def update(self, path: str, transform: Callable[[str], str]) -> asyncio.Future:
+        """
+        提交一个修改（当前内容 -> 新内容）。返回的 Future 在包含该修改的写入完成后
+        得到是否实际写入了文件，写入失败时带有对应的异常。
+        """
+        path = os.path.abspath(path)
+        pending = self._pending.get(path)
+        if pending is None:
+            loop = asyncio.get_running_loop()
+            pending = self._pending[path] = _PendingWrite(loop.create_future())
+            pending.handle = loop.call_later(self.delay, self._start, path)
+        else:
+            self.coalesced += 1
+        pending.transforms.append(transform)
+        return asyncio.shield(pending.future)
+
+    def write_text(self, path: str, text: str) -> asyncio.Future:
+        return self.update(path, lambda _content: text)
+
+    def write_json(self, path: str, data, indent: int = 4) -> asyncio.Future:
+        text = json.dumps(data, indent=indent, ensure_ascii=False)
+        return self.update(path, lambda _content: text)
+
+    def update_jsonc_values(self, path: str, values: dict, add_missing: bool = True) -> asyncio.Future:
+        values = dict(values)
+        return self.update(path, lambda content: set_jsonc_values(content, values, add_missing))
+
+    def _start(self, path: str):
+        pending = self._pending.pop(path, None)
+        if pending is None:
+            return
+        if pending.handle is not None:
+            pending.handle.cancel()
+        previous = self._writing.get(path)
+        task = asyncio.create_task(self._write(path, pending, previous))
+        self._writing[path] = task
+        task.add_done_callback(lambda t: self._writing.pop(path, None) if self._writing.get(path) is t else None)
+
+    async def _write(self, path: str, pending: _PendingWrite, previous: asyncio.Task | None):
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+
+        def apply(content: str) -> str:
+            for transform in pending.transforms:
+                content = transform(content)
+            return content
+
+        try:
+            written = await asyncio.to_thread(update_text_file, path, apply)
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"STATE STORE: 写入 '{os.path.basename(path)}' 失败: {e}")
+            if not pending.future.done():
+                pending.future.set_exception(e)
+                pending.future.exception() # 没有调用方等待时也不报 "exception was never retrieved"
+            return
+        if written:
+            self.writes += 1
+        if not pending.future.done():
+            pending.future.set_result(written)
+
+    async def flush(self):
+        """立即开始所有等待中的写入，并等待全部写入完成（关闭服务器前调用）。"""
+        for path in list(self._pending):
+            self._start(path)
+        if self._writing:
+            await asyncio.gather(*self._writing.values(), return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "writing": len(self._writing),
+            "writes": self.writes,
+            "coalesced": self.coalesced,
+            "failures": self.failures,
+        }
@@ -0,0 +1,141 @@
+# modules/stream_parser.py
+# LMArena 流式响应的增量解析器。
+#
+# LMArena 返回的是按行分隔的 `prefix:payload` 协议，例如：
+#   a0:"文本片段"
+#   a2:[{"type":"image","image":"https://..."}]
+#   ad:{"finishReason":"stop"}
+# 解析器只保留当前未完成的一行，每个字符最多被扫描常数次，
+# 每个 a0 字符串只解码一次，因此内存占用与响应总长度无关。
+
+import json
+from json.decoder import scanstring
+
+# 事件类型
+TEXT = 'text'             # a0/b0 文本片段，值为 str
+IMAGE = 'image'           # a2/b2 数据列表，值为 list
+FINISH = 'finish'         # ad/bd 结束信息，值为 finishReason 字符串
+ERROR = 'error'           # 独立的 {"error": ...} JSON 对象，值为错误信息
+CLOUDFLARE = 'cloudflare' # 检测到 Cloudflare 人机验证页面，值为 None
+
+# 单行的最大字符数。超过此长度的行会被丢弃（只做 Cloudflare 检测），保证内存有界。
+MAX_LINE_CHARS = 1 << 20
+
+_CLOUDFLARE_MARKERS = ('<title>just a moment...</title>', 'enable javascript and cookies to continue')
+_TEXT_PREFIXES = frozenset(('a0', 'b0'))
+_IMAGE_PREFIXES = frozenset(('a2', 'b2'))
+_FINISH_PREFIXES = frozenset(('ad', 'bd'))
+
+
+def _is_cloudflare(text: str) -> bool:
+    lowered = text.lower()
+    return any(marker in lowered for marker in _CLOUDFLARE_MARKERS)
+
+
+class LMArenaStreamParser:
+    """
+    LMArena `prefix:payload` 行协议的增量分词器。
+    调用 feed() 传入任意切分的数据块，返回解析出的 (事件类型, 值) 列表；
+    流结束时调用 close() 处理最后一行（可能没有换行符）。
+    """
+
+    def __init__(self, max_line_chars: int = MAX_LINE_CHARS):
+        self.max_line_chars = max_line_chars
+        self._pending: list[str] = [] # 当前未完成行的片段
+        self._pending_len = 0
+        self._skipping = False # 当前行过长，正在丢弃直到下一个换行符
+
+    def feed(self, chunk: str) -> list[tuple[str, object]]:
+        events = []
+        lines = chunk.split('\n')
+        tail = lines.pop()
+
+        if lines:
+            first = lines[0]
+            if self._skipping:
+                self._skipping = False
+                if _is_cloudflare(first):
+                    events.append((CLOUDFLARE, None))
+                lines = lines[1:]
+            elif self._pending:
+                self._pending.append(first)
+                lines[0] = "".join(self._pending)
+                self._pending.clear()
+                self._pending_len = 0
+            for line in lines:
+                self._parse_line(line, events)
+
+        if tail:
+            if self._skipping:
+                if _is_cloudflare(tail):
+                    events.append((CLOUDFLARE, None))
+            else:
+                self._pending.append(tail)
+                self._pending_len += len(tail)
+                if self._pending_len > self.max_line_chars:
+                    # 超长行不可能是正常的协议行，检查后直接丢弃
+                    line = "".join(self._pending)
+                    self._pending.clear()
+                    self._pending_len = 0
+                    self._skipping = True
+                    if _is_cloudflare(line):
+                        events.append((CLOUDFLARE, None))
+        return events
+
+    def close(self) -> list[tuple[str, object]]:
+        """流结束时处理缓冲区中剩余的最后一行。"""
+        events = []
+        if self._pending:
+            line = "".join(self._pending)
+            self._pending.clear()
+            self._pending_len = 0
+            self._parse_line(line, events)
+        self._skipping = False
+        return events
+
+    def _parse_line(self, line: str, events: list):
+        colon = line.find(':', 0, 3)
+        prefix = line[:colon] if colon != -1 else None
+
+        if prefix in _TEXT_PREFIXES:
+            # 直接调用 JSON 的 C 字符串扫描器，每个片段只解码一次
+            if line[3:4] != '"':
+                return
+            try:
+                text, end = scanstring(line, 4)
+            except ValueError:
+                return
+            if text and not line[end:].strip():
+                events.append((TEXT, text))
+            return
+
+        if prefix in _FINISH_PREFIXES:
+            try:
+                finish_data = json.loads(line[colon + 1:])
+            except ValueError:
+                return
+            if isinstance(finish_data, dict) and "finishReason" in finish_data:
+                events.append((FINISH, finish_data.get("finishReason", "stop")))
+            return
+
+        if prefix in _IMAGE_PREFIXES:
+            try:
+                image_data = json.loads(line[colon + 1:])
+            except ValueError:
+                return
+            if isinstance(image_data, list):
+                events.append((IMAGE, image_data))
+            return
+
+        # 非文本协议行：检查错误对象和 Cloudflare 页面
+        payload = line[colon + 1:].lstrip() if prefix is not None else line.lstrip()
+        if payload.startswith('{') and '"error"' in payload:
+            try:
+                error_json = json.loads(payload)
+            except ValueError:
+                error_json = None
+            if isinstance(error_json, dict) and "error" in error_json:
+                events.append((ERROR, error_json.get("error", "来自 LMArena 的未知错误")))
+                return
+        if _is_cloudflare(line):
+            events.append((CLOUDFLARE, None))
@@ -0,0 +1,140 @@
+# modules/stream_recorder.py
+# 浏览器原始数据流的录制（可选）。
+#
+# 开启后，服务器按采样率挑选请求，把油猴脚本发回的每个原始数据块连同到达时间
+# （相对于请求发出的毫秒数）记录下来，请求结束时作为一条 JSON 记录追加写入语料文件：
+#   {"request_id": ..., "kind": "chat" | "image", "model": ..., "started_at": ..., "complete": true,
+#    "frames": [[offset_ms, data], ...]}
+# 每条记录单独压缩为一个 gzip 成员追加到 <目录>/streams-YYYYMMDD.jsonl.gz，
+# 整个文件仍可以被 gzip.open 按行读取。语料目录总大小达到上限后停止录制。
+# benchmarks/bench_stream_replay.py 用这些真实流量回放并检验解析器的性能与输出。
+
+import asyncio
+import gzip
+import json
+import logging
+import os
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _corpus_files(directory: str) -> list[str]:
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.startswith("streams-") and name.endswith(".jsonl.gz")
+    )
+
+
+def load_corpus(path: str):
+    """逐条读取语料。path 可以是单个语料文件，也可以是语料目录。"""
+    files = _corpus_files(path) if os.path.isdir(path) else [path]
+    for file in files:
+        with gzip.open(file, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+class _Recording:
+    __slots__ = ("request_id", "kind", "model", "started_at", "wall_start", "frames")
+
+    def __init__(self, request_id: str, kind: str, model: str | None):
+        self.request_id = request_id
+        self.kind = kind
+        self.model = model
+        self.started_at = time.monotonic()
+        self.wall_start = time.time()
+        self.frames: list = []
+
+
+class StreamRecorder:
+    """按请求录制浏览器原始数据流。所有方法都应在主事件循环中调用。"""
+
+    def __init__(self, directory: str | None = None, sample_rate: float = 1.0, max_bytes: int = 200 * 1048576):
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self._active: dict[str, _Recording] = {}
+        self._bytes_written = 0
+        self._full_logged = False
+        self.recorded = 0
+        self.directory = None
+        self.set_directory(directory)
+
+    def set_directory(self, directory: str | None):
+        directory = directory or None
+        if directory == self.directory:
+            return
+        self.directory = directory
+        self._full_logged = False
+        self._bytes_written = sum(os.path.getsize(f) for f in _corpus_files(directory)) if directory else 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None and self._bytes_written < self.max_bytes
+
+    def begin(self, request_id: str, kind: str, model: str | None = None):
+        """请求发往浏览器之前调用，按采样率决定是否录制该请求。"""
+        if not self.enabled:
+            if self.directory and not self._full_logged:
+                self._full_logged = True
+                logger.warning(f"流录制语料已达到上限 ({self.max_bytes // 1048576} MB)，停止录制。")
+            return
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        self._active[request_id] = _Recording(request_id, kind, model)
+
+    def record(self, request_id: str, data):
+        """WebSocket 端点收到一个数据块。未被采样的请求只有一次字典查找的开销。"""
+        recording = self._active.get(request_id)
+        if recording is None:
+            return
+        recording.frames.append((round((time.monotonic() - recording.started_at) * 1000, 1), data))
+        if data == "[DONE]" or (isinstance(data, dict) and 'error' in data):
+            self._flush(self._active.pop(request_id), complete=True)
+
+    def end(self, request_id: str):
+        """请求结束（通常在流处理器的 finally 中调用）。浏览器没有发出结束信号的流按未完成记录。"""
+        recording = self._active.pop(request_id, None)
+        if recording is not None:
+            self._flush(recording, complete=False)
+
+    def _flush(self, recording: _Recording, complete: bool):
+        if not recording.frames or self.directory is None:
+            return
+        line = json.dumps({
+            "request_id": recording.request_id,
+            "kind": recording.kind,
+            "model": recording.model,
+            "started_at": round(recording.wall_start, 3),
+            "complete": complete,
+            "frames": recording.frames,
+        }, ensure_ascii=False)
+        self.recorded += 1
+        path = os.path.join(self.directory, time.strftime("streams-%Y%m%d.jsonl.gz"))
+        try:
+            asyncio.get_running_loop().run_in_executor(None, self._append, path, line)
+        except RuntimeError:
+            self._append(path, line)
+
+    def _append(self, path: str, line: str):
+        data = gzip.compress((line + "\n").encode('utf-8'))
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'ab') as f:
+                f.write(data)
+            self._bytes_written += len(data)
+        except OSError as e:
+            logger.warning(f"写入流录制语料失败: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "directory": self.directory,
+            "recording": len(self._active),
+            "recorded": self.recorded,
+            "bytes_written": self._bytes_written,
+        }
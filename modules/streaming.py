@@ -0,0 +1,128 @@
+# modules/streaming.py
+# OpenAI 兼容 SSE 流式输出的编码工具。
+#
+# 每个流的 id、model、created 等字段在整个流中保持不变，
+# 因此 ChunkEncoder 只在流开始时构建一次 chunk 的固定前缀/后缀字节，
+# 之后每个 token 只需对 delta 文本做一次 JSON 转义。
+# 如果安装了 orjson，会自动使用它作为更快的 JSON 后端（可选依赖）。
+# coalesce_content 用于在高频 token 场景下合并相邻的内容事件。
+
+import asyncio
+import json
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps_bytes(obj) -> bytes:
+    """将对象序列化为 UTF-8 JSON 字节（不转义非 ASCII 字符）。"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except (TypeError, orjson.JSONEncodeError):
+            # 例如包含孤立代理字符的字符串，回退到标准库
+            pass
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+class ChunkEncoder:
+    """为单个流式响应编码 OpenAI `chat.completion.chunk` SSE 事件，直接产出 bytes。"""
+
+    def __init__(self, response_id: str, model: str, created: int | None = None):
+        self.response_id = response_id
+        self.model = model
+        self.created = int(time.time()) if created is None else created
+        head = json.dumps({
+            "id": response_id, "object": "chat.completion.chunk",
+            "created": self.created, "model": model,
+        }, ensure_ascii=False)
+        # head[:-1] 去掉末尾的 '}'，以便继续拼接 choices 字段
+        self._head = b"data: " + head[:-1].encode('utf-8')
+        self._content_prefix = self._head + b', "choices": [{"index": 0, "delta": {"content": '
+        self._content_suffix = b'}, "finish_reason": null}]}\n\n'
+
+    def content(self, text: str) -> bytes:
+        """编码一个内容增量块。"""
+        return self._content_prefix + dumps_bytes(text) + self._content_suffix
+
+    def finish(self, reason: str = 'stop') -> bytes:
+        """编码结束块，并附带 `data: [DONE]` 终止标记。"""
+        return (self._head + b', "choices": [{"index": 0, "delta": {}, "finish_reason": '
+                + dumps_bytes(reason) + b'}]}\n\ndata: [DONE]\n\n')
+
+    def error(self, error_message: str) -> bytes:
+        """将错误信息编码为一个内容块，以便客户端能直接显示。"""
+        return self.content(f"\n\n[LMArena Bridge Error]: {error_message}")
+
+
+async def coalesce_content(events, flush_interval: float, max_chars: int):
+    """
+    合并内部事件流 (event_type, data) 中相邻的 'content' 事件。
+    - 第一个内容事件立即发出，保证首字延迟 (TTFT) 不变。
+    - 之后的内容会累积，直到距上次发出超过 flush_interval 秒，或累积超过 max_chars 个字符。
+    - 其他类型的事件会先冲刷已累积的内容，再原样发出。
+    """
+    iterator = events.__aiter__()
+    loop = asyncio.get_running_loop()
+    pending: list[str] = []
+    pending_len = 0
+    first_sent = False
+    last_flush = 0.0
+    next_task = None # 有累积内容时，在后台等待下一个事件，以便按时冲刷
+
+    try:
+        while True:
+            try:
+                if pending:
+                    if next_task is None:
+                        next_task = asyncio.ensure_future(iterator.__anext__())
+                    timeout = flush_interval - (loop.time() - last_flush)
+                    if timeout > 0:
+                        await asyncio.wait((next_task,), timeout=timeout)
+                    if not next_task.done():
+                        # 窗口到期但上游还没有新事件：先把累积的内容发出去
+                        yield 'content', "".join(pending)
+                        pending.clear()
+                        pending_len = 0
+                        last_flush = loop.time()
+                        continue
+                    task, next_task = next_task, None
+                    event_type, data = task.result()
+                elif next_task is not None:
+                    task, next_task = next_task, None
+                    event_type, data = await task
+                else:
+                    event_type, data = await iterator.__anext__()
+            except StopAsyncIteration:
+                break
+
+            if event_type == 'content':
+                if not first_sent:
+                    first_sent = True
+                    last_flush = loop.time()
+                    yield event_type, data
+                    continue
+                pending.append(data)
+                pending_len += len(data)
+                if pending_len >= max_chars or loop.time() - last_flush >= flush_interval:
+                    yield 'content', "".join(pending)
+                    pending.clear()
+                    pending_len = 0
+                    last_flush = loop.time()
+                continue
+
+            if pending:
+                yield 'content', "".join(pending)
+                pending.clear()
+                pending_len = 0
+                last_flush = loop.time()
+            yield event_type, data
+
+        if pending:
+            yield 'content', "".join(pending)
+    finally:
+        if next_task is not None:
+            next_task.cancel()
@@ -0,0 +1,180 @@
+# modules/tracing.py
+# 单个请求的阶段追踪。
+#
+# 一个慢请求的时间可能花在载荷转换、WebSocket 发送、浏览器的 fetch、等待第一行 a0:、
+# 或者客户端读取 SSE 上。RequestTrace 记录请求各阶段的区间 (span) 与时间点 (mark)：
+#   read_body / preprocess / convert / attachments / ws_send   区间
+#   first_chunk    WebSocket 端点收到浏览器发回的第一个数据块
+#   first_content  第一个内容块交给响应格式化
+#   finish         响应结束（流式响应时即客户端读完最后一个块）
+# Tracer 保存正在进行的请求和最近结束的请求（环形缓冲区），通过 /debug/requests 查看，
+# 并可以把结束的请求以 OTLP/JSON 格式（每行一个 TracesData）追加写入文件。
+
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class RequestTrace:
+    """一个请求的追踪记录。时间均为相对于请求开始的秒数。"""
+
+    def __init__(self, request_id: str, attributes: dict, started_at: float | None = None):
+        self.request_id = request_id
+        self.attributes = attributes
+        self.started_at = started_at or time.monotonic()
+        self.wall_start = time.time() - (time.monotonic() - self.started_at)
+        self.spans: list[tuple[str, float, float]] = [] # (名称, 开始, 结束)
+        self.marks: dict[str, float] = {} # 名称 -> 第一次发生的时间
+        self.status: str | None = None
+        self.duration: float | None = None
+
+    def _now(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def mark(self, name: str):
+        """记录一个时间点（同名的时间点只记录第一次）。"""
+        if name not in self.marks:
+            self.marks[name] = self._now()
+
+    def add_span(self, name: str, start: float, end: float):
+        self.spans.append((name, start, end))
+
+    @contextmanager
+    def span(self, name: str):
+        """记录一个区间：with trace.span("convert"): ..."""
+        start = self._now()
+        try:
+            yield
+        finally:
+            self.spans.append((name, start, self._now()))
+
+    def to_dict(self) -> dict:
+        elapsed = self.duration if self.duration is not None else self._now()
+        return {
+            "request_id": self.request_id,
+            "attributes": self.attributes,
+            "status": self.status or "in_progress",
+            "started_at": round(self.wall_start, 3),
+            "elapsed_ms": round(elapsed * 1000, 1),
+            "spans": [
+                {"name": name, "start_ms": round(start * 1000, 1), "duration_ms": round((end - start) * 1000, 1)}
+                for name, start, end in self.spans
+            ],
+            "marks": {name: round(offset * 1000, 1) for name, offset in self.marks.items()},
+        }
+
+    def to_otlp(self) -> dict:
+        """转换为 OTLP/JSON 的 TracesData：一个根区间，各阶段为子区间，时间点为根区间的事件。"""
+        trace_id = self.request_id.replace("-", "")[:32].ljust(32, "0")
+        root_id = os.urandom(8).hex()
+
+        def nanos(offset: float) -> str:
+            return str(int((self.wall_start + offset) * 1e9))
+
+        def attributes(values: dict) -> list:
+            return [{"key": k, "value": {"stringValue": str(v)}} for k, v in values.items()]
+
+        spans = [{
+            "traceId": trace_id,
+            "spanId": root_id,
+            "name": self.attributes.get("kind", "request"),
+            "kind": 2, # SPAN_KIND_SERVER
+            "startTimeUnixNano": nanos(0),
+            "endTimeUnixNano": nanos(self.duration or 0),
+            "attributes": attributes({**self.attributes, "request_id": self.request_id, "status": self.status}),
+            "events": [{"name": name, "timeUnixNano": nanos(offset)} for name, offset in self.marks.items()],
+            "status": {"code": 1 if self.status == "ok" else 2},
+        }]
+        for name, start, end in self.spans:
+            spans.append({
+                "traceId": trace_id,
+                "spanId": os.urandom(8).hex(),
+                "parentSpanId": root_id,
+                "name": name,
+                "kind": 1, # SPAN_KIND_INTERNAL
+                "startTimeUnixNano": nanos(start),
+                "endTimeUnixNano": nanos(end),
+            })
+        return {"resourceSpans": [{
+            "resource": {"attributes": attributes({"service.name": "lmarena-bridge"})},
+            "scopeSpans": [{"scope": {"name": "lmarena-bridge.tracing"}, "spans": spans}],
+        }]}
+
+
+class Tracer:
+    """正在进行与最近结束的请求追踪。所有方法都应在主事件循环中调用。"""
+
+    def __init__(self, capacity: int = 200, export_path: str | None = None):
+        self._live: dict[str, RequestTrace] = {}
+        self._recent: deque[RequestTrace] = deque(maxlen=capacity)
+        self.export_path = export_path or None
+
+    @property
+    def capacity(self) -> int:
+        return self._recent.maxlen
+
+    @capacity.setter
+    def capacity(self, value: int):
+        if value != self._recent.maxlen:
+            self._recent = deque(self._recent, maxlen=value)
+
+    def start(self, request_id: str, started_at: float | None = None, **attributes) -> RequestTrace:
+        trace = RequestTrace(request_id, attributes, started_at)
+        self._live[request_id] = trace
+        return trace
+
+    def mark(self, request_id: str, name: str):
+        """按 request_id 记录时间点（用于只知道 request_id 的 WebSocket 端点）。"""
+        trace = self._live.get(request_id)
+        if trace is not None and name not in trace.marks:
+            trace.mark(name)
+
+    def finish(self, trace: RequestTrace, status: str):
+        """结束一个追踪，可以重复调用（只有第一次生效）。"""
+        if trace.status is not None:
+            return
+        trace.status = status
+        trace.duration = trace._now()
+        trace.mark("finish")
+        self._live.pop(trace.request_id, None)
+        self._recent.append(trace)
+        if self.export_path:
+            line = json.dumps(trace.to_otlp(), ensure_ascii=False)
+            try:
+                asyncio.get_running_loop().run_in_executor(None, self._append, line)
+            except RuntimeError:
+                self._append(line)
+
+    def _append(self, line: str):
+        try:
+            with open(self.export_path, 'a', encoding='utf-8') as f:
+                f.write(line + "\n")
+        except OSError as e:
+            logger.warning(f"写入请求追踪文件失败: {e}")
+
+    async def observe(self, events, trace: RequestTrace):
+        """透传内部事件流，记录第一个内容块的时间，并在响应结束时结束追踪。"""
+        status = "cancelled"
+        try:
+            async for event_type, data in events:
+                if event_type == 'content':
+                    trace.mark("first_content")
+                elif event_type == 'error':
+                    status = "error"
+                yield event_type, data
+            if status == "cancelled":
+                status = "ok"
+        finally:
+            self.finish(trace, status)
+
+    def snapshot(self) -> dict:
+        return {
+            "live": [trace.to_dict() for trace in self._live.values()],
+            "recent": [trace.to_dict() for trace in reversed(self._recent)],
+        }
@@ -0,0 +1,87 @@
+# modules/ws_protocol.py
+# 油猴脚本 -> 服务器 的紧凑二进制帧协议 ("lmab1")。
+#
+# 连接建立后，油猴脚本发送 {"command": "hello", "protocols": ["lmab1", "json"]}，
+# 服务器如果支持并启用了二进制协议，会回复 {"command": "protocol", "protocol": "lmab1"}。
+# 之后油猴脚本把多个数据块批量打包进一个二进制帧，每条记录的格式为：
+#
+#   16 字节 request_id (UUID 原始字节) | 1 字节类型 | 4 字节负载长度 (大端) | UTF-8 负载
+#
+# 类型: 0 = 原始数据块, 1 = 流结束 ([DONE]，无负载), 2 = 错误 (负载为 JSON 对象)。
+# 未协商或不支持二进制协议时，双方继续使用原有的 JSON 文本帧 {"request_id": ..., "data": ...}。
+
+import json
+import struct
+import uuid
+
+PROTOCOL_BINARY = "lmab1"
+PROTOCOL_JSON = "json"
+
+KIND_CHUNK = 0
+KIND_DONE = 1
+KIND_ERROR = 2
+
+_RECORD_HEADER = struct.Struct(">16sBI")
+
+
+class ProtocolError(ValueError):
+    """二进制帧格式错误。"""
+
+
+def negotiate(offered, binary_enabled: bool = True) -> str:
+    """根据油猴脚本提供的协议列表选择本次连接使用的协议。"""
+    if binary_enabled and isinstance(offered, (list, tuple)) and PROTOCOL_BINARY in offered:
+        return PROTOCOL_BINARY
+    return PROTOCOL_JSON
+
+
+def decode_frame(frame: bytes) -> list[tuple[str, object]]:
+    """
+    将一个二进制帧解码为 (request_id, data) 列表。
+    data 与 JSON 协议中的 data 字段含义相同：数据块字符串、"[DONE]" 或错误字典。
+    """
+    view = memoryview(frame)
+    records = []
+    request_ids: dict[bytes, str] = {} # 同一帧中同一请求的记录通常是连续的，缓存 UUID 字符串
+    offset = 0
+    end = len(view)
+    while offset < end:
+        if end - offset < _RECORD_HEADER.size:
+            raise ProtocolError(f"记录头不完整 (偏移 {offset})。")
+        raw_id, kind, length = _RECORD_HEADER.unpack_from(view, offset)
+        offset += _RECORD_HEADER.size
+        if offset + length > end:
+            raise ProtocolError(f"记录负载被截断 (偏移 {offset}，长度 {length})。")
+
+        request_id = request_ids.get(raw_id)
+        if request_id is None:
+            request_id = request_ids[raw_id] = str(uuid.UUID(bytes=raw_id))
+
+        if kind == KIND_CHUNK:
+            data = str(view[offset:offset + length], 'utf-8')
+        elif kind == KIND_DONE:
+            data = "[DONE]"
+        elif kind == KIND_ERROR:
+            data = json.loads(str(view[offset:offset + length], 'utf-8'))
+            if not isinstance(data, dict):
+                data = {"error": str(data)}
+        else:
+            raise ProtocolError(f"未知的记录类型: {kind}")
+        offset += length
+        records.append((request_id, data))
+    return records
+
+
+def encode_frame(records) -> bytes:
+    """将 (request_id, data) 列表编码为一个二进制帧（与油猴脚本中的实现对应）。"""
+    parts = []
+    for request_id, data in records:
+        if data == "[DONE]":
+            kind, payload = KIND_DONE, b""
+        elif isinstance(data, dict):
+            kind, payload = KIND_ERROR, json.dumps(data, ensure_ascii=False).encode('utf-8')
+        else:
+            kind, payload = KIND_CHUNK, str(data).encode('utf-8')
+        parts.append(_RECORD_HEADER.pack(uuid.UUID(request_id).bytes, kind, len(payload)))
+        parts.append(payload)
+    return b"".join(parts)